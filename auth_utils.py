@@ -3,21 +3,35 @@ import hashlib
 import time
 import json
 import base64
-import datetime
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库 json
+    orjson = None
+
+def dumps_body(payload) -> bytes:
+    """
+    把请求体序列化为紧凑的 UTF-8 字节，每个请求只序列化一次：
+    签名与发送使用同一份字节，大段 Prompt 不会被重复编码
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 def generate_hmac_headers(api_key, api_user, payload):
     """
     通用型 HMAC-SHA256 签名 (适用于大多数现代标准)
+    payload 可以是 dumps_body 得到的字节（推荐，发送时必须使用同一份字节），也可以是字典
     """
     timestamp = str(int(time.time()))
-    body_str = json.dumps(payload, separators=(',', ':'))
-    sign_str = f"{timestamp}{api_user}{body_str}"
-    
-    signature = hmac.new(
-        api_key.encode('utf-8'),
-        sign_str.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
+    body = payload if isinstance(payload, (bytes, bytearray)) else dumps_body(payload)
+
+    mac = hmac.new((api_key or "").encode('utf-8'), digestmod=hashlib.sha256)
+    mac.update(f"{timestamp}{api_user}".encode('utf-8'))
+    mac.update(body)
+    signature = mac.hexdigest()
 
     return {
         "X-Timestamp": timestamp,
@@ -25,19 +39,70 @@ def generate_hmac_headers(api_key, api_user, payload):
         "X-Signature": signature
     }
 
+# v2.03 私有协议的固定请求头
+HMAC_SOURCE = "test_api"
+HMAC_API_VERSION = "v2.03"
+
+class HmacSigner:
+    """
+    v2.03 私有协议签名器，每组凭据一个实例（通过 get_signer 获取）
+    签名只依赖秒级的 Date 字符串：同一秒内的请求直接复用上次的签名与请求头，
+    换秒时从预先装好密钥的 hmac 对象 copy() 计算，不再重复处理密钥
+    """
+
+    def __init__(self, api_key, api_user):
+        self.api_user = api_user
+        self._mac = hmac.new((api_key or "").encode(), digestmod=hashlib.sha1)
+        # (秒级时间戳, Authorization, Date)；整体替换，读取无需加锁
+        self._cached = None
+
+    def sign(self):
+        """返回 (Authorization 头, Date 头)"""
+        now = int(time.time())
+        cached = self._cached
+        if cached is not None and cached[0] == now:
+            return cached[1], cached[2]
+        dt = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now))
+        mac = self._mac.copy()
+        mac.update(f"date: {dt}\nsource: {HMAC_SOURCE}".encode())
+        signature_b64 = base64.b64encode(mac.digest()).decode()
+        auth_header = f'hmac id="{self.api_user}", algorithm="hmac-sha1", headers="date source", signature="{signature_b64}"'
+        self._cached = (now, auth_header, dt)
+        return auth_header, dt
+
+    def headers(self) -> dict:
+        """完整的请求头（每次返回新字典，调用方可以自行修改）"""
+        auth_header, dt = self.sign()
+        return {
+            'Authorization': auth_header,
+            'Date': dt,
+            'Source': HMAC_SOURCE,
+            'Apiversion': HMAC_API_VERSION,
+            'Content-Type': 'application/json'
+        }
+
+# 缓存的签名器数量上限：接口探测可以传入任意凭据，超出后淘汰最久未使用的
+MAX_SIGNERS = 64
+
+_signers = OrderedDict()
+_signers_lock = threading.Lock()
+
+def get_signer(api_key, api_user) -> HmacSigner:
+    """按凭据取共享签名器（LRU 缓存）；同一 ApiConfig 的所有请求（含接口探测）共用一个实例"""
+    key = (api_user, api_key)
+    with _signers_lock:
+        signer = _signers.get(key)
+        if signer is None:
+            signer = _signers[key] = HmacSigner(api_key, api_user)
+            while len(_signers) > MAX_SIGNERS:
+                _signers.popitem(last=False)
+        else:
+            _signers.move_to_end(key)
+    return signer
+
 def get_hmac_auth(api_key, api_user):
     """
     专为你提到的 v2.03 私有协议设计的签名逻辑 (SHA1)
+    返回 (Authorization 头, Date 头)，同一秒内复用缓存的签名
     """
-    # 必须使用 datetime 模块
-    dt = datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-    sign_str = f"date: {dt}\nsource: test_api"
-    
-    # 按照你之前的逻辑使用 sha1
-    sign = hmac.new(api_key.encode(), sign_str.encode(), hashlib.sha1).digest()
-    
-    # 必须使用 base64 模块
-    signature_b64 = base64.b64encode(sign).decode()
-    
-    auth_header = f'hmac id="{api_user}", algorithm="hmac-sha1", headers="date source", signature="{signature_b64}"'
-    return auth_header, dt
\ No newline at end of file
+    return get_signer(api_key, api_user).sign()
\ No newline at end of file
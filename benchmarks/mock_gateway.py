@@ -0,0 +1,202 @@
+# benchmarks/mock_gateway.py
+"""
+本地模拟网关：同时支持标准 OpenAI 协议与私有 HMAC v2.03 协议，供基准测试使用
+
+- 标准协议：Bearer 鉴权，返回 choices[0].message.content / usage.total_tokens
+- HMAC 协议：校验 Authorization / Date / Source / Apiversion 头与 SHA1 签名，
+  返回 answer[0].value / cost_info.total_tokens
+- 签名请求体：校验 X-Timestamp / X-User / X-Signature（对收到的原始字节做 HMAC-SHA256），返回格式同标准协议
+- 请求体带 stream: true 时以 SSE 分块返回
+
+延迟、错误率、429 比例与回答大小均可配置：
+
+    python -m benchmarks.mock_gateway --port 8765 --latency-ms 300 --throttle-rate 0.1
+"""
+import sys
+import json
+import time
+import base64
+import hmac
+import hashlib
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# HMAC 协议使用的测试凭据，基准测试创建的 ApiConfig 与之保持一致
+HMAC_USER = "bench-user"
+HMAC_SECRET = "bench-secret"
+
+class GatewayConfig:
+    def __init__(self, latency_ms=200, jitter_ms=50, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, payload_bytes=800, stream_chunks=8, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.payload_bytes = payload_bytes
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "throttled": 0, "unauthorized": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+def _answer_text(prompt: str, size: int) -> str:
+    text = f"Echo: {prompt}\n\n"
+    filler = "The quick brown fox jumps over the lazy dog. "
+    return text + (filler * (size // len(filler) + 1))[:max(0, size - len(text))]
+
+def _check_signed_body(headers, raw: bytes) -> bool:
+    """按 auth_utils.generate_hmac_headers 的规则，对收到的原始请求体字节重新计算签名"""
+    if headers.get("X-User") != HMAC_USER:
+        return False
+    mac = hmac.new(HMAC_SECRET.encode(), digestmod=hashlib.sha256)
+    mac.update(f"{headers.get('X-Timestamp', '')}{HMAC_USER}".encode())
+    mac.update(raw)
+    return hmac.compare_digest(mac.hexdigest(), headers.get("X-Signature", ""))
+
+def _check_hmac(headers) -> bool:
+    """按 auth_utils.get_hmac_auth 的规则重新计算签名"""
+    auth, date = headers.get("Authorization", ""), headers.get("Date", "")
+    if headers.get("Apiversion") != "v2.03" or f'id="{HMAC_USER}"' not in auth:
+        return False
+    sign_str = f"date: {date}\nsource: {headers.get('Source', '')}"
+    expected = base64.b64encode(hmac.new(HMAC_SECRET.encode(), sign_str.encode(), hashlib.sha1).digest()).decode()
+    return f'signature="{expected}"' in auth
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: GatewayConfig = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, body, extra_headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        cfg = self.config
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        body = json.loads(raw or b"{}")
+        cfg.count("requests")
+        is_hmac = "request_id" in body
+
+        if "X-Signature" in self.headers and not _check_signed_body(self.headers, raw):
+            cfg.count("unauthorized")
+            return self._send_json(401, {"error": "invalid body signature"})
+        if is_hmac and not _check_hmac(self.headers):
+            cfg.count("unauthorized")
+            return self._send_json(401, {"error": "invalid signature"})
+        if cfg.roll() < cfg.throttle_rate:
+            cfg.count("throttled")
+            return self._send_json(429, {"error": "rate limited"}, {"Retry-After": str(cfg.retry_after)})
+        time.sleep(cfg.delay())
+        if cfg.roll() < cfg.error_rate:
+            cfg.count("errors")
+            return self._send_json(500, {"error": "upstream error"})
+
+        messages = body.get("messages") or [{}]
+        content = messages[-1].get("content", "")
+        prompt = content[0].get("value", "") if isinstance(content, list) and content else str(content)
+        answer = _answer_text(prompt[-60:], cfg.payload_bytes)
+        input_tokens, output_tokens = len(prompt) // 4, len(answer) // 4
+        tokens = input_tokens + output_tokens
+        cfg.count("ok")
+
+        if body.get("stream"):
+            return self._stream(answer, input_tokens, output_tokens, is_hmac)
+        if is_hmac:
+            return self._send_json(200, {
+                "request_id": body["request_id"],
+                "answer": [{"type": "text", "value": answer}],
+                "cost_info": {"total_tokens": tokens, "input_tokens": input_tokens, "output_tokens": output_tokens},
+            })
+        return self._send_json(200, {
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens, "total_tokens": tokens},
+        })
+
+    def _stream(self, answer, input_tokens, output_tokens, is_hmac):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = max(1, len(answer) // self.config.stream_chunks)
+        for i in range(0, len(answer), step):
+            piece = answer[i:i + step]
+            delta = {"content": [{"type": "text", "value": piece}]} if is_hmac else {"content": piece}
+            self._send_chunk(f"data: {json.dumps({'choices': [{'index': 0, 'delta': delta}]})}\n\n".encode())
+        usage = {"prompt_tokens": input_tokens, "completion_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+        self._send_chunk(f"data: {json.dumps(final)}\n\n".encode())
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+def start_gateway(config: GatewayConfig, host: str = "127.0.0.1", port: int = 0):
+    """在后台线程中启动网关，返回 (server, 实际端口)"""
+    handler = type("Handler", (GatewayHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-gateway", daemon=True).start()
+    return server, server.server_address[1]
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=200, help="平均响应延迟（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="延迟抖动范围（毫秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--retry-after", type=int, default=1, help="429 响应的 Retry-After 秒数")
+    parser.add_argument("--payload-bytes", type=int, default=800, help="回答文本的大小（字节）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，固定后错误与限流序列可复现")
+
+def config_from_args(args) -> GatewayConfig:
+    return GatewayConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        payload_bytes=args.payload_bytes, seed=args.seed,
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟 Gemini / HMAC 网关")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口，0 表示随机端口")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server, port = start_gateway(config_from_args(args), args.host, args.port)
+    # 第一行输出实际端口，供基准测试脚本读取
+    print(port, flush=True)
+    print(f"🧪 模拟网关已启动: http://{args.host}:{port}/v1 (HMAC 用户: {HMAC_USER})", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# benchmarks/run_benchmark.py
+"""
+端到端吞吐基准测试
+每个场景启动一个本地模拟网关 (benchmarks/mock_gateway.py)，在临时数据库中创建任务，
+通过 start_batch_task 完整执行（队列认领 → 限流 → 请求 → 解析 → 批量写库），并统计：
+
+  prompts/sec、单条请求耗时 p50/p95/p99、写库耗时、峰值 RSS
+
+    python -m benchmarks.run_benchmark                      # 运行全部场景并与基线对比
+    python -m benchmarks.run_benchmark --scenario hmac      # 只运行一个场景
+    python -m benchmarks.run_benchmark --save-baseline      # 把本次结果保存为新基线
+    python -m benchmarks.run_benchmark --max-regression 10  # 吞吐或 p95 退化超过 10% 时返回非零
+
+多个场景时每个场景在独立子进程中运行，峰值 RSS 互不影响。
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import resource
+import shutil
+import logging
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT_DIR, "benchmarks", "baseline.json")
+
+# 场景：协议、是否流式，以及网关参数（均可被命令行覆盖）
+SCENARIOS = {
+    "openai": {"platform_type": "official", "stream": False},
+    "hmac": {"platform_type": "api_hmac", "stream": False},
+    "signed": {"platform_type": "api_signed", "stream": False},
+    "openai_stream": {"platform_type": "official", "stream": True},
+    "throttled": {"platform_type": "official", "stream": False, "throttle_rate": 0.1, "error_rate": 0.02},
+}
+DEFAULTS = {
+    "prompts": 300, "concurrency": 16, "latency_ms": 200, "jitter_ms": 50, "error_rate": 0.0,
+    "throttle_rate": 0.0, "retry_after": 1, "payload_bytes": 800, "seed": 42,
+}
+GATEWAY_OPTIONS = ("latency_ms", "jitter_ms", "error_rate", "throttle_rate", "retry_after", "payload_bytes", "seed")
+# HMAC 网关的解析规则
+HMAC_RULES = {"answer": "answer.0.value", "tokens": "cost_info.total_tokens"}
+# --max-regression 检查的指标：(名称, 数值越大越好)
+REGRESSION_METRICS = (("prompts_per_sec", True), ("latency_p95_ms", False))
+
+def percentile(values, p):
+    """最近秩法百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+def _start_gateway(params):
+    args = [sys.executable, "-m", "benchmarks.mock_gateway", "--port", "0"]
+    for name in GATEWAY_OPTIONS:
+        if params.get(name) is not None:
+            args += [f"--{name.replace('_', '-')}", str(params[name])]
+    proc = subprocess.Popen(args, cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    port = int(proc.stdout.readline())
+    return proc, port
+
+def run_scenario(name: str, params: dict, verbose: bool = False) -> dict:
+    """在当前进程中运行一个场景，返回指标字典"""
+    scenario = SCENARIOS[name]
+    # 必须在导入 database 之前指定临时库
+    workdir = tempfile.mkdtemp(prefix="gemini_bench_")
+    os.environ["GEMINI_DB_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    import database as db
+    import log_utils
+    from services import job_queue, result_writer
+    from services.task_manager import start_batch_task
+    from benchmarks.mock_gateway import HMAC_USER, HMAC_SECRET
+
+    # 抓取过程的逐条日志会拖慢吞吐，默认只保留错误
+    if verbose:
+        log_utils.setup_logging()
+    else:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    gateway, port = _start_gateway(params)
+    try:
+        db.init_db()
+        s = db.SessionLocal()
+        config = db.ApiConfig(
+            name=f"bench-{name}", base_url=f"http://127.0.0.1:{port}/v1",
+            api_key=HMAC_SECRET, api_user=HMAC_USER, max_concurrency=params["concurrency"],
+        )
+        s.add(config)
+        template = None
+        if scenario["platform_type"] == "api_hmac":
+            template = db.ResponseTemplate(name="bench-hmac", mapping_rules=json.dumps(HMAC_RULES))
+            s.add(template)
+        s.flush()
+        task = db.ScrapeTask(
+            name=f"bench-{name}", platform_type=scenario["platform_type"], api_config_id=config.id,
+            template_id=template.id if template else None, model="gemini-3-flash-preview",
+            thinking_level="low", system_instruction="You are a benchmark. {{current_time}}",
+            status="pending", bypass_cache=True, stream_mode=scenario["stream"],
+        )
+        s.add(task)
+        s.flush()
+        job_queue.enqueue_prompts(s, task.id, [f"benchmark prompt #{i}" for i in range(params["prompts"])])
+        s.commit()
+        task_id = task.id
+        s.close()
+
+        writes_before = result_writer.totals()
+        started = time.perf_counter()
+        start_batch_task(task_id)
+        elapsed = time.perf_counter() - started
+        writes = result_writer.totals()
+
+        s = db.SessionLocal()
+        try:
+            rows = s.query(db.TaskEntry.status, db.TaskEntry.latency_ms, db.TaskEntry.ttft_ms).filter(
+                db.TaskEntry.task_id == task_id
+            ).all()
+        finally:
+            s.close()
+    finally:
+        gateway.terminate()
+        gateway.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [r.latency_ms for r in rows if r.latency_ms is not None]
+    ttfts = [r.ttft_ms for r in rows if r.ttft_ms is not None]
+    return {
+        "prompts": params["prompts"],
+        "concurrency": params["concurrency"],
+        "success": sum(1 for r in rows if r.status == "success"),
+        "failed": sum(1 for r in rows if r.status != "success"),
+        "wall_seconds": round(elapsed, 3),
+        "prompts_per_sec": round(len(rows) / elapsed, 2) if elapsed else None,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+        "ttft_p50_ms": percentile(ttfts, 50),
+        "db_write_seconds": round(writes["seconds"] - writes_before["seconds"], 3),
+        "db_flushes": writes["flushes"] - writes_before["flushes"],
+        # Linux 下 ru_maxrss 单位为 KB，macOS 为字节
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+def _run_in_subprocess(name: str, overrides: list) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run_benchmark", "--scenario", name, "--json", *overrides],
+        cwd=ROOT_DIR, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"场景 {name} 运行失败:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def _format(value):
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+def print_report(results: dict, baseline: dict = None):
+    for name, metrics in results.items():
+        base = (baseline or {}).get("scenarios", {}).get(name)
+        print(f"\n📊 场景 {name}（{metrics['prompts']} 条 Prompt，并发 {metrics['concurrency']}，"
+              f"成功 {metrics['success']} / 失败 {metrics['failed']}）")
+        print(f"   {'指标':<18}{'本次':>12}{'基线':>12}{'变化':>10}")
+        for key, value in metrics.items():
+            if key in ("prompts", "concurrency", "success", "failed"):
+                continue
+            base_value = base.get(key) if base else None
+            change = ""
+            if isinstance(value, (int, float)) and isinstance(base_value, (int, float)) and base_value:
+                change = f"{(value - base_value) / base_value * 100:+.1f}%"
+            print(f"   {key:<20}{_format(value):>12}{_format(base_value):>12}{change:>10}")
+
+def regressions(results: dict, baseline: dict, max_regression: float) -> list:
+    """返回超过允许退化幅度的 (场景, 指标, 变化百分比)"""
+    found = []
+    for name, metrics in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for key, higher_is_better in REGRESSION_METRICS:
+            if not base.get(key) or metrics.get(key) is None:
+                continue
+            change = (metrics[key] - base[key]) / base[key] * 100
+            if (-change if higher_is_better else change) > max_regression:
+                found.append((name, key, change))
+    return found
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端到端吞吐基准测试")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="要运行的场景，可重复；缺省运行全部")
+    parser.add_argument("--prompts", type=int, help=f"每个场景的 Prompt 数（默认 {DEFAULTS['prompts']}）")
+    parser.add_argument("--concurrency", type=int, help=f"ApiConfig 并发上限（默认 {DEFAULTS['concurrency']}）")
+    parser.add_argument("--latency-ms", type=float)
+    parser.add_argument("--jitter-ms", type=float)
+    parser.add_argument("--error-rate", type=float)
+    parser.add_argument("--throttle-rate", type=float)
+    parser.add_argument("--retry-after", type=int)
+    parser.add_argument("--payload-bytes", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写入基线文件")
+    parser.add_argument("--max-regression", type=float, default=None, help="允许的最大退化百分比，超过时返回 1")
+    parser.add_argument("--verbose", action="store_true", help="显示抓取过程日志")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    option_names = ("prompts", "concurrency") + GATEWAY_OPTIONS
+    overrides = {k: getattr(args, k) for k in option_names if getattr(args, k) is not None}
+    names = args.scenario or list(SCENARIOS)
+
+    if args.json:
+        # 子进程模式：只运行一个场景，最后一行输出 JSON 结果
+        params = {**DEFAULTS, **{k: v for k, v in SCENARIOS[names[0]].items() if k in DEFAULTS}, **overrides}
+        print(json.dumps(run_scenario(names[0], params, args.verbose)))
+        return
+
+    cli = [f"--{k.replace('_', '-')}={v}" for k, v in overrides.items()]
+    results = {}
+    for name in names:
+        print(f"🏃 运行场景 {name} ...", flush=True)
+        results[name] = _run_in_subprocess(name, cli + (["--verbose"] if args.verbose else []))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        data = {
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPU",
+            "scenarios": {**((baseline or {}).get("scenarios", {})), **results},
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 基线已保存: {args.baseline}")
+
+    if args.max_regression is not None and baseline:
+        found = regressions(results, baseline, args.max_regression)
+        for name, key, change in found:
+            print(f"❌ 场景 {name} 的 {key} 退化 {change:+.1f}%（允许 {args.max_regression}%）")
+        if found:
+            sys.exit(1)
+        print(f"\n✅ 与基线相比无超过 {args.max_regression}% 的退化")
+
+if __name__ == "__main__":
+    main()
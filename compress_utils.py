@@ -0,0 +1,121 @@
+# compress_utils.py
+"""
+原始响应压缩工具
+raw_response 以字节形式存储，首字节固定为 \\x00（合法的 JSON 文本不会以它开头），
+第二个字节标识编码方式：
+  R  未压缩的 UTF-8（内容过短，压缩不划算）
+  Z  zlib
+  S  zstd
+  D  zstd + 训练字典（帧头里带字典 ID，解压时按 ID 加载对应字典）
+旧数据仍是普通文本，读取时原样返回。
+"""
+import os
+import zlib
+import threading
+
+try:
+    import zstandard
+except ImportError:  # zstandard 为可选依赖，未安装时使用 zlib
+    zstandard = None
+
+MAGIC = b"\x00"
+RAW, ZLIB, ZSTD, ZSTD_DICT = b"R", b"Z", b"S", b"D"
+
+# 压缩算法：zstd / zlib / none，默认优先 zstd
+CODEC = os.getenv("GEMINI_RAW_CODEC", "zstd" if zstandard else "zlib").lower()
+LEVEL = int(os.getenv("GEMINI_RAW_CODEC_LEVEL", "6"))
+# 小于该字节数的内容不压缩
+MIN_COMPRESS_SIZE = 128
+# 训练好的 zstd 字典存放目录，ACTIVE 文件记录当前用于压缩的字典 ID
+DICT_DIR = "./data/zstd_dicts"
+DICT_SIZE = 112640
+
+_local = threading.local()
+_dict_lock = threading.Lock()
+_dicts = {}
+_active_dict_id = None
+# 每次切换字典递增，线程内缓存的压缩器据此判断是否需要重建
+_dict_generation = 0
+
+def _load_dict(dict_id: int):
+    with _dict_lock:
+        if dict_id not in _dicts:
+            path = os.path.join(DICT_DIR, f"{dict_id}.dict")
+            with open(path, "rb") as f:
+                _dicts[dict_id] = zstandard.ZstdCompressionDict(f.read())
+        return _dicts[dict_id]
+
+def _active_dict():
+    """当前用于压缩的字典；没有训练过字典时返回 None"""
+    global _active_dict_id
+    if _active_dict_id is None:
+        try:
+            with open(os.path.join(DICT_DIR, "ACTIVE")) as f:
+                _active_dict_id = int(f.read().strip())
+        except (OSError, ValueError):
+            _active_dict_id = 0
+    return _load_dict(_active_dict_id) if _active_dict_id else None
+
+def _compressor():
+    # zstd 压缩器不是线程安全的，每个线程各自持有一个
+    if getattr(_local, "generation", None) != _dict_generation:
+        dictionary = _active_dict()
+        _local.compressor = zstandard.ZstdCompressor(level=LEVEL, dict_data=dictionary)
+        _local.with_dict = dictionary is not None
+        _local.generation = _dict_generation
+    return _local.compressor, _local.with_dict
+
+def compress_text(text):
+    """把字符串编码为带标记的字节串"""
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    if CODEC == "none" or len(data) < MIN_COMPRESS_SIZE:
+        return MAGIC + RAW + data
+    if CODEC == "zstd" and zstandard is not None:
+        comp, with_dict = _compressor()
+        return MAGIC + (ZSTD_DICT if with_dict else ZSTD) + comp.compress(data)
+    return MAGIC + ZLIB + zlib.compress(data, LEVEL)
+
+def decompress_text(value):
+    """还原 compress_text 的结果；旧的纯文本数据原样返回"""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if not value.startswith(MAGIC) or len(value) < 2:
+        return value.decode("utf-8")
+    kind, body = value[1:2], value[2:]
+    if kind == RAW:
+        return body.decode("utf-8")
+    if kind == ZLIB:
+        return zlib.decompress(body).decode("utf-8")
+    if kind in (ZSTD, ZSTD_DICT):
+        if zstandard is None:
+            raise RuntimeError("该数据使用 zstd 压缩，请先安装 zstandard")
+        dictionary = None
+        if kind == ZSTD_DICT:
+            dictionary = _load_dict(zstandard.get_frame_parameters(body).dict_id)
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(body).decode("utf-8")
+    raise ValueError(f"未知的压缩标记: {kind!r}")
+
+def train_dictionary(samples, dict_size: int = DICT_SIZE) -> int:
+    """
+    用一批原始响应样本训练 zstd 字典并设为当前字典，返回字典 ID
+    重复的 JSON 结构（字段名、模板化的元数据）会被字典吸收，短响应的压缩率明显提升
+    """
+    global _active_dict_id, _dict_generation
+    if zstandard is None:
+        raise RuntimeError("训练字典需要安装 zstandard")
+    dictionary = zstandard.train_dictionary(dict_size, [s.encode("utf-8") for s in samples])
+    dict_id = dictionary.dict_id()
+    os.makedirs(DICT_DIR, exist_ok=True)
+    with open(os.path.join(DICT_DIR, f"{dict_id}.dict"), "wb") as f:
+        f.write(dictionary.as_bytes())
+    with open(os.path.join(DICT_DIR, "ACTIVE"), "w") as f:
+        f.write(str(dict_id))
+    with _dict_lock:
+        _dicts[dict_id] = dictionary
+    _active_dict_id = dict_id
+    # 各线程的压缩器在下次使用时按新字典重建
+    _dict_generation += 1
+    return dict_id
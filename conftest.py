@@ -0,0 +1,52 @@
+# conftest.py
+"""
+pytest 公共配置：测试使用临时 SQLite 库，不会读写 data/ 下的正式数据库
+GEMINI_DB_URL 必须在任何模块导入 database 之前设置，因此放在根目录的 conftest 中
+"""
+import os
+import shutil
+import tempfile
+import datetime
+
+_TMP_DIR = tempfile.mkdtemp(prefix="gemini_test_")
+os.environ["GEMINI_DB_URL"] = f"sqlite:///{os.path.join(_TMP_DIR, 'test.db')}"
+
+import pytest
+
+import database as db
+
+@pytest.fixture(scope="session", autouse=True)
+def _test_database():
+    db.init_db()
+    yield
+    db.engine.dispose()
+    shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+@pytest.fixture
+def session():
+    s = db.SessionLocal()
+    try:
+        yield s
+    finally:
+        s.close()
+
+@pytest.fixture
+def make_task(session):
+    """创建一个 ApiConfig + ScrapeTask，可选写入 entries 条结果；返回任务 id"""
+    def _make(name="test", status="pending", platform_type="official", entries=0, created_at=None, **fields):
+        config = db.ApiConfig(name=f"cfg-{name}-{datetime.datetime.now().timestamp()}", base_url="http://127.0.0.1:1/v1",
+                              api_key="k", api_user="u")
+        session.add(config)
+        session.flush()
+        task = db.ScrapeTask(name=name, status=status, platform_type=platform_type, api_config_id=config.id,
+                             model="gemini-3-flash", thinking_level="low",
+                             created_at=created_at or datetime.datetime.now(), **fields)
+        session.add(task)
+        session.flush()
+        for i in range(entries):
+            session.add(db.TaskEntry(task_id=task.id, prompt=f"{name} prompt {i}", prompt_index=i,
+                                     answer=f"{name} answer {i}", raw_response='{"ok": true}',
+                                     tokens_used=10, status="success"))
+        session.commit()
+        return task.id
+    return _make
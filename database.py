@@ -1,12 +1,31 @@
 import os
+import logging
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import relationship, sessionmaker, declarative_base
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Index, LargeBinary
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import relationship, sessionmaker, declarative_base, deferred
+
+from compress_utils import compress_text, decompress_text
 
 # 确保数据目录存在
 os.makedirs("./data", exist_ok=True)
 
 Base = declarative_base()
+logger = logging.getLogger(__name__)
+
+class CompressedText(TypeDecorator):
+    """
+    透明压缩的文本字段：写入时压缩为字节，读取时解压回字符串
+    旧库里未压缩的文本可以继续读取，由 migrate_tool 分批压缩
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
 
 class ApiConfig(Base):
     """API 配置池：管理不同的中转站或官方 Key"""
@@ -17,6 +36,11 @@ class ApiConfig(Base):
     api_key = Column(String(255), nullable=False)
     # 新增：适配 HMAC 接口需要的 User ID
     api_user = Column(String(100), nullable=True) 
+    # 并发上限：同一配置下允许同时在途的请求数
+    max_concurrency = Column(Integer, default=4)
+    # 限流额度：每分钟请求数 / 每分钟 Token 数，0 表示不限制
+    rpm_limit = Column(Integer, default=0)
+    tpm_limit = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.datetime.now)
 
 class ResponseTemplate(Base):
@@ -36,7 +60,8 @@ class ScrapeTask(Base):
     name = Column(String(100), nullable=False)
     
     # --- 平台适配扩展 ---
-    # 平台类型标识：'official' (官方SDK), 'api_openai' (OpenAI格式接口), 'api_hmac' (私有HMAC接口)
+    # 平台类型标识：'official' (官方SDK), 'api_openai' (OpenAI格式接口), 'api_hmac' (私有HMAC接口),
+    # 'api_signed' (标准格式请求体 + 对请求体字节的 HMAC-SHA256 签名)
     platform_type = Column(String(50), default="official") 
     
     # 关联具体的 API 配置
@@ -46,13 +71,21 @@ class ScrapeTask(Base):
     
     model = Column(String(50))           # 使用的模型名称
     thinking_level = Column(String(20))   # 思考等级
+    system_instruction = Column(Text, nullable=True)  # 创建时选定的系统指令，断点续跑时使用
+    bypass_cache = Column(Boolean, default=False)     # 为 True 时不读取响应缓存，总是请求上游
+    stream_mode = Column(Boolean, default=False)      # 为 True 时以 SSE 流式请求上游，记录首字耗时
+    # pending / running / paused / cancelled / completed / failed
     status = Column(String(20), default="pending") 
-    created_at = Column(DateTime, default=datetime.datetime.now)
+    created_at = Column(DateTime, default=datetime.datetime.now, index=True)
     
     # 建立关联
-    entries = relationship("TaskEntry", backref="task", cascade="all, delete-orphan")
+    entries = relationship(
+        "TaskEntry", backref="task", cascade="all, delete-orphan",
+        order_by="(TaskEntry.prompt_index, TaskEntry.id)"
+    )
     api_config = relationship("ApiConfig")
     template = relationship("ResponseTemplate")
+    queue_items = relationship("QueueItem", backref="task", cascade="all, delete-orphan")
 
 class TaskEntry(Base):
     """结果详情表：存储每一个具体的 Prompt 及其对应的返回结果"""
@@ -60,11 +93,84 @@ class TaskEntry(Base):
     id = Column(Integer, primary_key=True)
     task_id = Column(Integer, ForeignKey("scrape_tasks.id"))
     prompt = Column(Text, nullable=False)
+    prompt_index = Column(Integer, nullable=True)  # Prompt 在批次中的原始顺序，并发执行时用于稳定排序
     answer = Column(Text)          # 解析后的纯文本答案
-    raw_response = Column(Text)    # 原始完整 JSON 字符串（非常重要，用于后期重新解析）
+    # 原始完整 JSON 字符串（非常重要，用于后期重新解析）；压缩存储，且只在访问时才加载
+    raw_response = deferred(Column(CompressedText))
+    tokens_used = Column(Integer, default=0)
+    status = Column(String(20))    # success, failed, partial（流式响应中途超时，只保存了部分回答）
+    from_cache = Column(Boolean, default=False)  # 结果来自响应缓存，未实际请求上游
+    ttft_ms = Column(Integer, nullable=True)     # 流式请求的首字耗时（毫秒）
+    latency_ms = Column(Integer, nullable=True)  # 请求上游的总耗时（毫秒），含重试与限流等待
+    started_at = Column(DateTime, nullable=True)   # 开始请求上游的时间（缓存命中时为空）
+    finished_at = Column(DateTime, nullable=True)  # 拿到结果（或最终失败）的时间
+    attempts = Column(Integer, nullable=True)      # 实际发出的请求次数，含重试
+    http_status = Column(Integer, nullable=True)   # 最后一次请求的 HTTP 状态码
+    finish_reason = Column(String(32), nullable=True)  # stop / length / STOP / MAX_TOKENS 等
+    input_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    reasoning_tokens = Column(Integer, nullable=True)  # 思考（推理）消耗的 Token
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    # 最后修改时间（写入、重新解析），增量备份据此导出水位线以下被修改的行
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now, nullable=True)
+
+    __table_args__ = (
+        # 数据中心按任务筛选并按时间倒序；结果页按任务内的 Prompt 顺序展示
+        Index("ix_task_entries_task_created", "task_id", "created_at"),
+        Index("ix_task_entries_task_prompt", "task_id", "prompt_index"),
+        Index("ix_task_entries_created", "created_at"),
+        Index("ix_task_entries_status", "status"),
+        Index("ix_task_entries_updated", "updated_at"),
+    )
+
+class QueueItem(Base):
+    """持久化任务队列：每个待抓取的 Prompt 一行，进程重启后可继续执行"""
+    __tablename__ = "task_queue"
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey("scrape_tasks.id"), nullable=False, index=True)
+    prompt_index = Column(Integer, nullable=False)
+    prompt = Column(Text, nullable=False)
+    # pending / running / done / failed / cancelled
+    status = Column(String(20), default="pending", index=True)
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String(64), nullable=True)   # 认领该条目的工作者标识
+    claimed_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    # 最后一次状态变化的时间（认领、完成、重新排队、续约等），增量备份据此导出被修改的条目
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now, nullable=True)
+
+    __table_args__ = (
+        # 认领条目：WHERE task_id=? AND status='pending' ORDER BY prompt_index
+        Index("ix_task_queue_claim", "task_id", "status", "prompt_index"),
+        Index("ix_task_queue_updated", "updated_at"),
+    )
+
+class ResponseCache(Base):
+    """响应缓存：按规范化请求内容的哈希存储上游原始响应，重复请求直接复用"""
+    __tablename__ = "response_cache"
+    cache_key = Column(String(64), primary_key=True)  # 请求内容的 sha256
+    raw_response = Column(CompressedText, nullable=False)
     tokens_used = Column(Integer, default=0)
-    status = Column(String(20))    # success, failed
+    hit_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.datetime.now)
+    last_hit_at = Column(DateTime, default=datetime.datetime.now, index=True)  # 超出容量时按最近使用时间淘汰
+    expires_at = Column(DateTime, nullable=True, index=True)
+
+class ArchivedTask(Base):
+    """归档目录：已迁移到 Parquet 冷存储的任务，列表与查询时据此定位文件"""
+    __tablename__ = "archived_tasks"
+    id = Column(Integer, primary_key=True)            # 与原 ScrapeTask.id 相同
+    name = Column(String(100), nullable=False)
+    platform_type = Column(String(50))
+    model = Column(String(50))
+    thinking_level = Column(String(20))
+    status = Column(String(20))
+    entry_count = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    path = Column(String(255), nullable=False)       # 相对归档目录的文件路径
+    created_at = Column(DateTime, index=True)        # 原任务创建时间
+    archived_at = Column(DateTime, default=datetime.datetime.now)
 
 class TaskPreset(Base):
     """任务预设：存储 System Prompt 模板"""
@@ -75,11 +181,114 @@ class TaskPreset(Base):
     created_at = Column(DateTime, default=datetime.datetime.now)
 
 # --- 数据库连接配置 ---
-DB_URL = "sqlite:///./data/gemini_platform.db"
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+# 可用 GEMINI_DB_URL 指向其他库（例如基准测试使用的临时库）
+DB_URL = os.getenv("GEMINI_DB_URL", "sqlite:///./data/gemini_platform.db")
+# timeout: 写锁被占用时最多等待的秒数，多个 Worker 同时写入时避免直接报 database is locked
+engine = create_engine(DB_URL, connect_args={"check_same_thread": False, "timeout": 30})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# SQLite 性能参数：WAL 让读写互不阻塞，NORMAL 同步级别在 WAL 下仍能保证一致性
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 30000,          # 毫秒
+    "cache_size": -64000,           # 负数单位为 KB，约 64MB 页缓存
+    "mmap_size": 268435456,         # 256MB 内存映射读
+    "temp_store": "MEMORY",
+}
+
+@event.listens_for(engine, "connect")
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+# --- 全文检索 (SQLite FTS5) ---
+# 外部内容表：索引数据来自 task_entries，由触发器在增删改时同步
+FTS_TABLE = "task_entries_fts"
+# trigram 分词支持中文子串检索，老版本 SQLite 不支持时退回 unicode61
+FTS_TOKENIZERS = ("trigram", "unicode61")
+FTS_ENABLED = False
+FTS_TOKENIZER = None
+
+_FTS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON task_entries BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, prompt, answer) VALUES (new.id, new.prompt, new.answer);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON task_entries BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, prompt, answer) VALUES ('delete', old.id, old.prompt, old.answer);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF prompt, answer ON task_entries BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, prompt, answer) VALUES ('delete', old.id, old.prompt, old.answer);
+        INSERT INTO {FTS_TABLE}(rowid, prompt, answer) VALUES (new.id, new.prompt, new.answer);
+    END""",
+]
+
+def setup_fulltext(conn):
+    """创建 FTS5 索引表与同步触发器；首次创建时用现有数据重建索引"""
+    global FTS_ENABLED, FTS_TOKENIZER
+    if engine.dialect.name != "sqlite":
+        return
+    row = conn.execute(text("SELECT sql FROM sqlite_master WHERE type='table' AND name=:n"), {"n": FTS_TABLE}).first()
+    if row is None:
+        for tokenizer in FTS_TOKENIZERS:
+            try:
+                with conn.begin_nested():
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                        f"prompt, answer, content='task_entries', content_rowid='id', tokenize='{tokenizer}')"
+                    ))
+                break
+            except Exception:
+                continue
+        else:
+            logger.warning("⚠️ 当前 SQLite 不支持 FTS5，数据中心搜索将使用 LIKE 模糊匹配")
+            return
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        FTS_TOKENIZER = tokenizer
+    else:
+        FTS_TOKENIZER = "trigram" if "trigram" in (row[0] or "") else "unicode61"
+    for ddl in _FTS_TRIGGERS:
+        conn.execute(text(ddl))
+    FTS_ENABLED = True
+
+def upgrade_schema():
+    """
+    轻量级结构升级：create_all 不会给已存在的表补列，
+    这里对比模型定义，为旧数据库追加缺失的字段
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"
+                if column.default is not None and column.default.is_scalar:
+                    default = column.default.arg
+                    if isinstance(default, bool):
+                        default = int(default)
+                    ddl += f" DEFAULT {default!r}"
+                conn.execute(text(ddl))
+            # create_all 只在建表时创建索引，旧库需要单独补建
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        setup_fulltext(conn)
+        if engine.dialect.name == "sqlite":
+            # 让查询规划器拿到新索引的统计信息
+            conn.execute(text("PRAGMA optimize"))
+
 def init_db():
     """初始化数据库表结构"""
     Base.metadata.create_all(bind=engine)
-    print("✅ 数据库表结构更新成功！")
\ No newline at end of file
+    upgrade_schema()
+    logger.info("✅ 数据库表结构更新成功！")
\ No newline at end of file
@@ -0,0 +1,46 @@
+# log_utils.py
+"""
+分级异步日志
+业务代码通过 logging.getLogger(__name__) 记录日志；setup_logging 在根 logger 上挂一个 QueueHandler，
+由后台 QueueListener 线程负责格式化与写终端/文件，抓取线程写日志时只做一次入队，不会被 I/O 阻塞。
+
+    GEMINI_LOG_LEVEL=DEBUG   # 输出每次请求的重试、系统指令等细节
+    GEMINI_LOG_FILE=./data/gemini.log   # 同时写入按大小轮转的日志文件
+"""
+import os
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+
+LOG_LEVEL = os.getenv("GEMINI_LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("GEMINI_LOG_FILE", "")
+LOG_FORMAT = "%(asctime)s %(levelname)-7s [%(threadName)s] %(name)s: %(message)s"
+
+_listener = None
+
+def setup_logging(level: str = None):
+    """初始化根 logger（重复调用无副作用），返回后台监听器"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=20 * 1024 * 1024, backupCount=5, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level or LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # 进程退出前把队列中剩余的日志写完
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,4 +1,3 @@
-import pandas as pd
 import datetime
 import time
 import json
@@ -8,28 +7,58 @@ import hashlib
 import base64
 import requests
 import os
-from io import BytesIO
+import asyncio
+import logging
 from fastapi import FastAPI, Request, Form, Depends, Body, HTTPException, BackgroundTasks
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func
 
 import database as db
+import log_utils
 from services.scraper import run_single_scrape, GeminiModel, ThinkingLevel
-from services.task_manager import start_batch_task
+from services.task_manager import start_batch_task, resume_pending_tasks, request_shutdown
+from services import job_queue
+from services.data_query import list_entries, entry_stats, entry_analytics, task_timing_from_entries, PAGE_SIZE
+from services.exporter import stream_export, has_rows, EXPORT_FORMATS
 from database import engine, Base
 from parser_utils import get_value_by_path # 引用你刚创建的文件
-from auth_utils import get_hmac_auth  # 确保已经导入你之前写的工具函数
+from auth_utils import get_signer, generate_hmac_headers, dumps_body  # 与抓取共用同一套签名逻辑
+from services import http_client, response_cache, archive, progress, metrics, reparse
 
-# 初始化数据库表结构
-Base.metadata.create_all(bind=engine)
+# 日志经队列异步输出，级别由 GEMINI_LOG_LEVEL 控制
+log_utils.setup_logging()
+logger = logging.getLogger(__name__)
+
+# 初始化数据库表结构（含旧库补列）
+db.init_db()
 
 app = FastAPI(title="Gemini 抓取任务管理平台 (完整增强版)")
 
+# 是否在 Web 进程内直接执行抓取；设为 0 时 Web 只负责入队，
+# 由独立 Worker (python -m services.worker) 认领执行
+INLINE_WORKER = os.getenv("GEMINI_INLINE_WORKER", "1") != "0"
+# 启动时立即回收所有执行中的条目而不等租约过期；仅用于确认没有独立 Worker 在运行的单进程部署
+RECOVER_ALL_ON_START = os.getenv("GEMINI_RECOVER_ALL_ON_START", "0") == "1"
+
 # 配置模板目录
 templates = Jinja2Templates(directory="templates")
 
+@app.on_event("startup")
+def resume_unfinished_tasks():
+    # 清理过期的响应缓存
+    response_cache.evict()
+    # 进程重启后继续执行队列中尚未完成的 Prompt；外部 Worker 模式下由 Worker 负责
+    if INLINE_WORKER:
+        resume_pending_tasks(requeue_all=RECOVER_ALL_ON_START)
+
+@app.on_event("shutdown")
+def close_http_pools():
+    request_shutdown()
+    http_client.close_all()
+
 # --- 数据库依赖项 ---
 def get_db():
     session = db.SessionLocal()
@@ -40,73 +69,91 @@ def get_db():
 
 # --- 1. 数据管理中心 ---
 @app.get("/data_center")
-def data_center(request: Request, search: str = "", task_id: int = 0, s: Session = Depends(get_db)):
-    query = s.query(db.TaskEntry).join(db.ScrapeTask)
-    if search:
-        query = query.filter((db.TaskEntry.prompt.contains(search)) | (db.TaskEntry.answer.contains(search)))
-    if task_id > 0:
-        query = query.filter(db.TaskEntry.task_id == task_id)
-    
-    entries = query.order_by(db.TaskEntry.created_at.desc()).all()
-    tasks = s.query(db.ScrapeTask).all()
-
-    # 计算统计数据
-    total_tokens = sum(e.tokens_used for e in entries if e.tokens_used)
-    avg_tokens = round(total_tokens / len(entries), 1) if entries else 0
+def data_center(request: Request, search: str = "", task_id: int = 0, cursor: str = None,
+                limit: int = PAGE_SIZE, s: Session = Depends(get_db)):
+    # 只查询当前页需要的列；统计在 SQL 中聚合，翻页时不再重复计算
+    page = list_entries(s, search=search, task_id=task_id, cursor=cursor, limit=limit)
+    tasks = s.query(db.ScrapeTask.id, db.ScrapeTask.name).order_by(db.ScrapeTask.id.desc()).all()
+    response_templates = s.query(db.ResponseTemplate.id, db.ResponseTemplate.name).order_by(db.ResponseTemplate.id).all()
+    stats = entry_stats(s, search=search, task_id=task_id) if not cursor else None
 
     return templates.TemplateResponse("data_center.html", {
         "request": request,
-        "entries": entries,
+        "entries": page["items"],
+        "next_cursor": page["next_cursor"],
+        "is_first_page": not cursor,
         "tasks": tasks,
+        "response_templates": response_templates,
         "search": search,
         "current_task_id": task_id,
-        "stats": {
-            "total_count": len(entries),
-            "total_tokens": total_tokens,
-            "avg_tokens": avg_tokens
-        }
+        "stats": stats
     })
 
-# --- 2. Excel 导出接口 ---
+@app.get("/api/data_center")
+def data_center_api(search: str = "", task_id: int = 0, cursor: str = None,
+                    limit: int = PAGE_SIZE, s: Session = Depends(get_db)):
+    """数据中心 JSON 接口：与页面相同的筛选与 keyset 分页，首页附带统计信息"""
+    page = list_entries(s, search=search, task_id=task_id, cursor=cursor, limit=limit)
+    items = []
+    for item in page["items"]:
+        item = dict(item)
+        item["created_at"] = item["created_at"].isoformat() if item["created_at"] else None
+        if "snippet" in item:
+            item["snippet"] = str(item["snippet"])
+        items.append(item)
+    result = {"items": items, "next_cursor": page["next_cursor"], "ranked": page["ranked"]}
+    if not cursor:
+        result["stats"] = entry_stats(s, search=search, task_id=task_id)
+    return result
+
+@app.get("/api/data_center/analytics")
+def data_center_analytics(search: str = "", task_id: int = 0, group_by: str = "task", s: Session = Depends(get_db)):
+    """按任务或 模型 + 思考等级 汇总耗时分位数、重试与 Token 拆分（与列表使用相同的筛选条件）"""
+    try:
+        return {"group_by": group_by, "items": entry_analytics(s, search=search, task_id=task_id, group_by=group_by)}
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+
+@app.get("/data/entries/{entry_id}")
+def get_entry(entry_id: int, s: Session = Depends(get_db)):
+    """单条结果的完整回答（列表中只返回截断的预览）"""
+    entry = s.query(
+        db.TaskEntry.id, db.TaskEntry.task_id, db.TaskEntry.prompt, db.TaskEntry.answer,
+        db.TaskEntry.tokens_used, db.TaskEntry.status, db.TaskEntry.created_at
+    ).filter(db.TaskEntry.id == entry_id).first()
+    if not entry: return JSONResponse(status_code=404, content={"message": "记录不存在"})
+    data = dict(entry._mapping)
+    data["created_at"] = data["created_at"].isoformat() if data["created_at"] else None
+    return data
+
+@app.get("/data/entries/{entry_id}/raw")
+def get_entry_raw(entry_id: int, s: Session = Depends(get_db)):
+    """单条结果的原始响应：只在查看时读取并解压"""
+    row = s.query(db.TaskEntry.raw_response).filter(db.TaskEntry.id == entry_id).first()
+    if not row or row[0] is None: return JSONResponse(status_code=404, content={"message": "记录不存在"})
+    return Response(content=row[0], media_type="application/json")
+
+# --- 2. 数据导出接口 (流式) ---
 @app.get("/data/export")
-def export_data(task_id: int = 0, search: str = "", s: Session = Depends(get_db)):
+def export_data(task_id: int = 0, search: str = "", format: str = "xlsx", s: Session = Depends(get_db)):
     try:
-        query = s.query(db.TaskEntry).join(db.ScrapeTask)
-        if task_id > 0:
-            query = query.filter(db.TaskEntry.task_id == task_id)
-        if search:
-            query = query.filter((db.TaskEntry.prompt.contains(search)) | (db.TaskEntry.answer.contains(search)))
-        
-        entries = query.all()
-        if not entries:
+        if format not in EXPORT_FORMATS:
+            return JSONResponse(status_code=400, content={"message": f"不支持的导出格式: {format}"})
+        if not has_rows(s, search=search, task_id=task_id):
             return JSONResponse(status_code=400, content={"message": "无匹配数据可导出"})
 
-        data_list = []
-        for e in entries:
-            data_list.append({
-                "任务名称": e.task.name if e.task else "未归类",
-                "Prompt": e.prompt,
-                "AI结果": e.answer,
-                "Tokens": e.tokens_used,
-                "抓取时间": e.created_at.strftime("%Y-%m-%d %H:%M") if e.created_at else ""
-            })
-        
-        df = pd.DataFrame(data_list)
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='数据报表')
-        
-        output.seek(0)
+        media_type, ext = EXPORT_FORMATS[format]
         curr_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"export_{curr_time}.xlsx"
+        filename = f"export_{curr_time}.{ext}"
         
+        # 按批读取、边写边发送，内存占用与导出行数无关
         return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            stream_export(format, search=search, task_id=task_id),
+            media_type=media_type,
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
     except Exception as e:
-        print(f"Export Error: {str(e)}")
+        logger.exception("Export Error: %s", e)
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 # --- 3. 批量删除 ---
@@ -119,10 +166,102 @@ def batch_delete(entry_ids: list[int] = Body(...), s: Session = Depends(get_db))
     except Exception as e:
         return JSONResponse(status_code=500, content={"message": str(e)})
 
+# --- 3.1 按解析模板批量重新解析 ---
+@app.post("/data/reparse")
+def reparse_data(
+    template_id: int = Body(None),
+    task_id: int = Body(0),
+    search: str = Body(""),
+    dry_run: bool = Body(True)
+):
+    """用新模板重新解析已保存的 raw_response（后台执行），dry_run 时只返回差异不写库"""
+    try:
+        return JSONResponse(status_code=202, content=reparse.start_job(template_id, task_id=task_id, search=search, dry_run=dry_run))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    except Exception as e:
+        logger.exception("Reparse Error: %s", e)
+        return JSONResponse(status_code=500, content={"message": str(e)})
+
+@app.get("/data/reparse/{job_id}")
+def reparse_progress(job_id: str):
+    """重新解析后台任务的进度"""
+    job = reparse.get_job(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"message": "重新解析任务不存在或已过期"})
+    return job
+
+# --- 3.2 冷存储归档 ---
+@app.get("/archive")
+def archive_page(request: Request, search: str = "", task_id: int = 0, offset: int = 0,
+                 s: Session = Depends(get_db)):
+    archived_tasks = s.query(db.ArchivedTask).order_by(db.ArchivedTask.created_at.desc()).all()
+    entries, error = [], None
+    if search or task_id:
+        try:
+            entries = archive.query_entries(search=search, task_id=task_id, limit=PAGE_SIZE + 1, offset=offset)
+        except RuntimeError as e:
+            error = str(e)
+    return templates.TemplateResponse("archive.html", {
+        "request": request,
+        "archived_tasks": archived_tasks,
+        "entries": entries[:PAGE_SIZE],
+        "has_more": len(entries) > PAGE_SIZE,
+        "offset": offset,
+        "page_size": PAGE_SIZE,
+        "search": search,
+        "current_task_id": task_id,
+        "archive_available": archive.available(),
+        "archive_after_days": archive.ARCHIVE_AFTER_DAYS,
+        "error": error
+    })
+
+@app.get("/api/archive")
+def archive_api(search: str = "", task_id: int = 0, limit: int = PAGE_SIZE, offset: int = 0):
+    """归档结果 JSON 接口（不含原始响应）"""
+    try:
+        items = archive.query_entries(search=search, task_id=task_id, limit=min(limit, 500), offset=offset)
+    except RuntimeError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    for item in items:
+        item["created_at"] = item["created_at"].isoformat() if item["created_at"] else None
+    return {"items": items}
+
+@app.post("/archive/run")
+def run_archive(days: int = Form(...)):
+    """归档早于 days 天的已结束任务"""
+    try:
+        report = archive.archive_old_tasks(days)
+    except RuntimeError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    logger.info("🗄️ 归档完成：%d 个任务，%d 条结果", report["tasks"], report["entries"])
+    return RedirectResponse(url="/archive", status_code=303)
+
+@app.get("/archive/export")
+def export_archive(task_id: int = 0, search: str = "", format: str = "csv"):
+    if format not in EXPORT_FORMATS:
+        return JSONResponse(status_code=400, content={"message": f"不支持的导出格式: {format}"})
+    if not archive.available():
+        return JSONResponse(status_code=400, content={"message": "归档功能需要安装 pyarrow"})
+    media_type, ext = EXPORT_FORMATS[format]
+    filename = f"archive_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+    return StreamingResponse(
+        stream_export(format, search=search, task_id=task_id, archived=True),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 # --- 4. 首页 (任务列表) ---
 @app.get("/")
 def index(request: Request, s: Session = Depends(get_db)):
-    tasks = s.query(db.ScrapeTask).order_by(db.ScrapeTask.created_at.desc()).all()
+    tasks = (
+        s.query(db.ScrapeTask)
+        .options(joinedload(db.ScrapeTask.template))
+        .order_by(db.ScrapeTask.created_at.desc())
+        .all()
+    )
+    # 只为未结束的任务计算进度，之后由 /tasks/events 推送更新
+    active_ids = [t.id for t in tasks if t.status in progress.ACTIVE_STATUSES]
     api_configs = s.query(db.ApiConfig).all()
     presets = s.query(db.TaskPreset).all() 
     templates_list = s.query(db.ResponseTemplate).all() # 新增：解析模板
@@ -130,6 +269,7 @@ def index(request: Request, s: Session = Depends(get_db)):
     return templates.TemplateResponse("index.html", {
         "request": request, 
         "tasks": tasks, 
+        "progress": progress.initial_progress(s, active_ids),
         "apis": api_configs,
         "presets": presets,
         "templates": templates_list,
@@ -156,6 +296,9 @@ def add_api_config(
     base_url: str = Form(...), 
     api_key: str = Form(...), 
     api_user: str = Form(None), # HMAC 接口需要
+    max_concurrency: int = Form(4),
+    rpm_limit: int = Form(0),
+    tpm_limit: int = Form(0),
     s: Session = Depends(get_db)
 ):
     # 处理可能的空字符串，统一存储逻辑
@@ -165,7 +308,10 @@ def add_api_config(
         name=name, 
         base_url=base_url, 
         api_key=api_key, 
-        api_user=processed_user
+        api_user=processed_user,
+        max_concurrency=max(1, max_concurrency),
+        rpm_limit=max(0, rpm_limit),
+        tpm_limit=max(0, tpm_limit)
     )
     s.add(new_cfg)
     s.commit()
@@ -175,7 +321,11 @@ def add_api_config(
 def get_api_config(cfg_id: int, s: Session = Depends(get_db)):
     cfg = s.query(db.ApiConfig).filter(db.ApiConfig.id == cfg_id).first()
     if not cfg: return JSONResponse(status_code=404, content={"message": "Not found"})
-    return {"id": cfg.id, "name": cfg.name, "base_url": cfg.base_url, "api_key": cfg.api_key, "api_user": cfg.api_user}
+    return {
+        "id": cfg.id, "name": cfg.name, "base_url": cfg.base_url, "api_key": cfg.api_key,
+        "api_user": cfg.api_user, "max_concurrency": cfg.max_concurrency,
+        "rpm_limit": cfg.rpm_limit or 0, "tpm_limit": cfg.tpm_limit or 0
+    }
 
 @app.post("/api_config/update")
 def update_api_config(
@@ -184,11 +334,16 @@ def update_api_config(
     base_url: str = Form(...), 
     api_key: str = Form(...), 
     api_user: str = Form(None),
+    max_concurrency: int = Form(4),
+    rpm_limit: int = Form(0),
+    tpm_limit: int = Form(0),
     s: Session = Depends(get_db)
 ):
     cfg = s.query(db.ApiConfig).filter(db.ApiConfig.id == cfg_id).first()
     if cfg:
         cfg.name, cfg.base_url, cfg.api_key, cfg.api_user = name, base_url, api_key, api_user
+        cfg.max_concurrency = max(1, max_concurrency)
+        cfg.rpm_limit, cfg.tpm_limit = max(0, rpm_limit), max(0, tpm_limit)
         s.commit()
     return RedirectResponse(url="/api_config", status_code=303)
 
@@ -216,16 +371,8 @@ async def test_api_connection(
         test_prompt = "Hello, response with one word."
         
         if platform_type == "api_hmac":
-            # --- 使用 auth_utils 中的统一签名逻辑 ---
-            auth_header, dt = get_hmac_auth(api_key, api_user)
-            
-            headers = {
-                'Authorization': auth_header,
-                'Date': dt,
-                'Source': 'test_api',
-                'Apiversion': 'v2.03',
-                'Content-Type': 'application/json'
-            }
+            # --- 与抓取共用 auth_utils 中的签名器 ---
+            headers = get_signer(api_key, api_user).headers()
             # 私有协议特定的 Payload 结构
             payload = {
                 "request_id": f"test_{int(time.time())}",
@@ -249,9 +396,16 @@ async def test_api_connection(
                 "model": model, # 使用动态传入的模型名
                 "messages": [{"role": "user", "content": test_prompt}]
             }
-        
-        # 执行请求，设置 15 秒超时防止卡死
-        resp = requests.post(base_url, headers=headers, json=payload, timeout=15)
+
+        # 请求体只序列化一次；签名请求体模式对这份字节签名，发送的也是同一份字节
+        body = dumps_body(payload)
+        if platform_type == "api_signed":
+            headers = {**generate_hmac_headers(api_key, api_user, body), "Content-Type": "application/json"}
+
+        # 执行请求，设置 15 秒超时防止卡死；放到线程池中执行，避免阻塞事件循环
+        resp = await run_in_threadpool(
+            http_client.post, base_url, headers=headers, data=body, timeout=15
+        )
         
         # 尝试解析 JSON
         try:
@@ -301,6 +455,17 @@ def add_response_template(name: str = Form(...), mapping_rules: str = Form(...),
     s.commit()
     return RedirectResponse(url="/api_config#template-pane", status_code=303)
 
+# --- 7.1 响应缓存 ---
+@app.get("/api/cache")
+def cache_stats(s: Session = Depends(get_db)):
+    return {**response_cache.stats(s), "enabled": response_cache.enabled(),
+            "ttl_hours": response_cache.TTL_HOURS, "max_entries": response_cache.MAX_ENTRIES}
+
+@app.post("/cache/clear")
+def clear_cache():
+    removed = response_cache.clear()
+    return {"status": "success", "message": f"已清空 {removed} 条缓存"}
+
 # --- 8. 任务执行与结果浏览 ---
 @app.post("/tasks/create")
 async def create_scrape_task(
@@ -313,6 +478,8 @@ async def create_scrape_task(
     thinking: str = Form(...),
     prompts_text: str = Form(...),
     preset_id: int = Form(...),
+    bypass_cache: bool = Form(False),
+    stream_mode: bool = Form(False),
     s: Session = Depends(get_db)
 ):
     prompt_list = [p.strip() for p in prompts_text.split('\n') if p.strip()]
@@ -322,21 +489,108 @@ async def create_scrape_task(
     new_task = db.ScrapeTask(
         name=task_name, model=model, platform_type=platform_type,
         api_config_id=api_id, template_id=template_id,
-        thinking_level=thinking, status="pending"
+        thinking_level=thinking, system_instruction=system_instruction, status="pending",
+        bypass_cache=bypass_cache, stream_mode=stream_mode
     )
     s.add(new_task)
+    s.flush()
+    # Prompt 写入持久化队列，与任务同一事务提交
+    job_queue.enqueue_prompts(s, new_task.id, prompt_list)
     s.commit()
 
-    background_tasks.add_task(
-        start_batch_task, new_task.id, api_id, prompt_list, system_instruction, thinking
-    )
+    if INLINE_WORKER:
+        background_tasks.add_task(start_batch_task, new_task.id)
+    return RedirectResponse(url="/", status_code=303)
+
+@app.post("/tasks/{task_id}/pause")
+def pause_task(task_id: int, s: Session = Depends(get_db)):
+    task = s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).first()
+    if not task: raise HTTPException(status_code=404, detail="任务不存在")
+    job_queue.pause_task(s, task)
+    return RedirectResponse(url="/", status_code=303)
+
+@app.post("/tasks/{task_id}/resume")
+def resume_task(task_id: int, background_tasks: BackgroundTasks, s: Session = Depends(get_db)):
+    task = s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).first()
+    if not task: raise HTTPException(status_code=404, detail="任务不存在")
+    if job_queue.resume_task(s, task) and INLINE_WORKER:
+        background_tasks.add_task(start_batch_task, task.id)
+    return RedirectResponse(url="/", status_code=303)
+
+@app.post("/tasks/{task_id}/cancel")
+def cancel_task(task_id: int, s: Session = Depends(get_db)):
+    task = s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).first()
+    if not task: raise HTTPException(status_code=404, detail="任务不存在")
+    job_queue.cancel_task(s, task)
     return RedirectResponse(url="/", status_code=303)
 
 @app.get("/results/{task_id}")
 def view_results(task_id: int, request: Request, s: Session = Depends(get_db)):
     task = s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).first()
     if not task: raise HTTPException(status_code=404, detail="任务不存在")
-    return templates.TemplateResponse("results.html", {"request": request, "task": task})
+    # 首屏只渲染按主键分页的第一页，之后的结果（包括首屏之外的存量）由推送补上（页面按 id 去重）
+    entries = progress.entry_page(s, [task.id])
+    last_entry_id = entries[-1]["id"] if entries else s.query(func.coalesce(func.max(db.TaskEntry.id), 0)).scalar()
+    return templates.TemplateResponse("results.html", {
+        "request": request, "task": task, "entries": entries, "last_entry_id": last_entry_id,
+        "has_more": len(entries) == progress.ENTRY_PAGE_SIZE, "answer_chars": progress.ENTRY_ANSWER_CHARS,
+        "progress": progress.initial_progress(s, [task.id]).get(task.id),
+    })
+
+# --- 9. 进度推送 (SSE) ---
+async def _progress_stream(request: Request, tracker):
+    """每 POLL_INTERVAL 秒查询一次计数，只推送变化；跟踪的任务全部结束后发送 end 事件"""
+    idle_since = time.monotonic()
+    while not await request.is_disconnected():
+        changed, entries = await run_in_threadpool(progress.poll, tracker)
+        messages = [progress.format_event("entry", e) for e in entries]
+        messages += [progress.format_event("progress", p) for p in changed]
+        if messages:
+            yield "".join(messages)
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > progress.HEARTBEAT_INTERVAL:
+            yield ": ping\n\n"
+            idle_since = time.monotonic()
+        if tracker.finished():
+            yield progress.format_event("end", {})
+            return
+        # 还有未推送完的存量结果时立即读取下一批
+        if not tracker.entries_pending:
+            await asyncio.sleep(progress.POLL_INTERVAL)
+
+def _event_stream_response(generator):
+    return StreamingResponse(generator, media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # 关闭 Nginx 缓冲，事件立即送达
+    })
+
+@app.get("/tasks/events")
+def task_list_events(request: Request):
+    """任务列表订阅：推送所有未结束任务（含之后新建的任务）的进度"""
+    return _event_stream_response(_progress_stream(request, progress.ProgressTracker()))
+
+@app.get("/tasks/{task_id}/events")
+def task_events(task_id: int, request: Request, after: int = None):
+    """结果页订阅：推送单个任务的进度与主键大于 after 的结果（缺省为订阅时刻之后），存量分批推送"""
+    tracker = progress.ProgressTracker([task_id], with_entries=True, after_entry_id=after)
+    return _event_stream_response(_progress_stream(request, tracker))
+
+# --- 10. 运行指标 ---
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 抓取端点：请求次数、重试、Token、字节数与各阶段耗时直方图"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/tasks/{task_id}/timing")
+def task_timing(task_id: int, s: Session = Depends(get_db)):
+    """
+    单个任务各阶段的累计耗时：本进程执行过该任务时返回内存中的完整明细（source=process），
+    否则（独立 Worker 执行、或本进程已重启）从结果表持久化的请求元数据汇总（source=database）
+    """
+    breakdown = metrics.task_breakdown(task_id) or task_timing_from_entries(s, task_id)
+    if breakdown is None:
+        return JSONResponse(status_code=404, content={"message": "该任务还没有任何结果"})
+    return breakdown
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,100 +1,426 @@
 # migrate_tool.py
-import json
+import io
 import os
+import sys
+import gzip
+import json
+import time
+import argparse
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy import text, select, func, or_, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from database import SessionLocal, engine, Base
 import database as db  # 导入你的模型定义
+from compress_utils import compress_text, train_dictionary, zstandard
 
-def export_data():
-    """全自动备份：导出所有已定义的表数据"""
-    s = SessionLocal()
-    backup = {}
-    # 获取 Base 中注册的所有表名
-    tables = Base.metadata.tables.keys()
-    
+# 使用 CompressedText 存储的列：(表名, 主键, 列名)
+COMPRESSED_COLUMNS = [
+    ("task_entries", "id", "raw_response"),
+    ("response_cache", "cache_key", "raw_response"),
+]
+
+BACKUP_DIR = "./data"
+# 旧版本生成的整库 JSON 备份，恢复时仍然兼容
+LEGACY_BACKUP_PATH = "./data/full_system_backup.json"
+# 增量备份状态：当前备份链（全量 + 增量文件）与各表水位线
+BACKUP_STATE_PATH = "./data/backup_state.json"
+# 按水位线增量导出的大表：(自增主键, 记录“变动时间”的列)
+# 增量只包含新增的行与变动时间列有更新的行；删除无法增量表达，检测到删除时自动改为全量备份
+# 其余表数据量小且会被原地修改（如任务状态），每次都全量导出，恢复时按主键覆盖
+INCREMENTAL_TABLES = {
+    "task_entries": ("id", ["updated_at"]),
+    "task_queue": ("id", ["updated_at"]),
+}
+# 每批读取 / 写入的行数
+BATCH_SIZE = 1000
+# 每处理多少行打印一次进度
+PROGRESS_EVERY = 10000
+
+def _codec(path: str):
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+def _open_backup(path: str, mode: str, codec: str = None):
+    """按压缩方式打开备份文件：gzip、zstd（需安装 zstandard）或纯文本"""
+    if codec == "gzip":
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("读写 .zst 备份需要安装 zstandard")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor(level=6).stream_writer(raw, closefd=True)
+        else:
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _decode_row(table, columns, values):
+    """把一行备份数据还原为列字典：忽略当前表结构中已不存在的列，并把时间字符串转回 datetime"""
+    row = {}
+    for name, value in zip(columns, values):
+        column = table.columns.get(name)
+        if column is None:
+            continue
+        if isinstance(value, str) and isinstance(column.type, DateTime):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                # 兼容旧备份里 '2026-01-27 20:41:24.752971' 以外的异常格式
+                value = datetime.now()
+        row[name] = value
+    return row
+
+def _load_state():
     try:
-        print("🔍 开始扫描数据库表...")
-        for table_name in tables:
-            # 动态获取模型类
-            model = next((cls for cls in Base.__subclasses__() if cls.__tablename__ == table_name), None)
-            if model:
-                rows = s.query(model).all()
-                backup[table_name] = [
-                    {c.name: getattr(row, c.name) for c in row.__table__.columns} 
-                    for row in rows
-                ]
-                print(f" - [备份] 表 {table_name}: {len(rows)} 条记录")
-        
-        with open("./data/full_system_backup.json", "w", encoding="utf-8") as f:
-            json.dump(backup, f, ensure_ascii=False, indent=4, default=str)
-        print(f"\n✅ 导出成功！备份文件位于: ./data/full_system_backup.json")
+        with open(BACKUP_STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_state(state):
+    tmp_path = BACKUP_STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, BACKUP_STATE_PATH)
+
+def _table_query(conn, table, state):
+    """
+    构造单表的导出查询，并返回该表新的水位线
+    增量模式下大表只导出水位线之后新增的行（以及上次备份后有变动的行），其余小表全量导出
+    """
+    spec = INCREMENTAL_TABLES.get(table.name)
+    if spec is None:
+        return select(table), None
+    id_column, changed_columns = spec
+    pk = table.c[id_column]
+    # 在快照内确定本次的上界，备份过程中新写入的行留给下一次增量
+    high = conn.execute(select(func.max(pk))).scalar() or 0
+    query = select(table).where(pk <= high).order_by(pk)
+    if state is not None:
+        low = state["watermarks"].get(table.name, 0)
+        condition = pk > low
+        last_backup_at = datetime.fromisoformat(state["last_backup_at"])
+        for name in changed_columns:
+            condition = or_(condition, table.c[name] > last_backup_at)
+        query = query.where(condition)
+    return query, high
+
+def _row_count(conn, table, high):
+    """主键不超过 high 的行数：与上次备份时记录的行数比较即可发现删除"""
+    pk = table.c[INCREMENTAL_TABLES[table.name][0]]
+    return conn.execute(select(func.count()).select_from(table).where(pk <= high)).scalar()
+
+def _deleted_tables(conn, state):
+    """上次备份之后有行被删除（任务删除、归档、批量删除等）的增量表"""
+    counts = state.get("counts")
+    if counts is None:
+        return list(INCREMENTAL_TABLES)  # 旧版状态文件没有行数记录，无法判断
+    deleted = []
+    for name in INCREMENTAL_TABLES:
+        table = Base.metadata.tables[name]
+        if _row_count(conn, table, state["watermarks"].get(name, 0)) != counts.get(name, 0):
+            deleted.append(name)
+    return deleted
+
+def _default_backup_path(kind: str) -> str:
+    """data/backup_<时间>.<kind>.ndjson.gz；同一秒内的多次备份追加序号，不会覆盖备份链中的文件"""
+    stem = os.path.join(BACKUP_DIR, f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    path, seq = f"{stem}.{kind}.ndjson.gz", 1
+    while os.path.exists(path):
+        path, seq = f"{stem}_{seq}.{kind}.ndjson.gz", seq + 1
+    return path
+
+def export_data(path: str = None, incremental: bool = False):
+    """
+    流式备份：按表依赖顺序逐批读取，写成 NDJSON（默认 gzip 压缩）
+    每张表先写一行表头 {"table": ..., "columns": [...]}，随后每行一个 JSON 数组；
+    全部表在同一个读事务中导出，得到一致的快照，内存占用与数据量无关
+    incremental: 只导出上次备份（全量或增量）之后新增或修改过的行，需要先有一次全量备份；
+    增量无法表达删除，上次备份后大表有行被删除时自动改为全量备份
+    成功时返回备份文件路径；失败时返回 None，备份状态（水位线与备份链）保持不变
+    """
+    state = _load_state() if incremental else None
+    if incremental and state is None:
+        print("⚠️ 尚无全量备份记录，本次执行全量备份")
+        incremental = False
+    started = time.perf_counter()
+    db.init_db()
+    tmp_path = None
+    try:
+        watermarks, counts = {}, {}
+        # 变动时间水位线取在第一次读取之前：读取开始后才修改的行，时间一定晚于它，会进入下一次增量
+        snapshot = datetime.now()
+        with engine.connect() as conn, conn.begin():
+            # 删除检测与导出在同一个快照内进行，两者之间发生的删除留给下一次备份发现
+            deleted = _deleted_tables(conn, state) if incremental else []
+            if deleted:
+                print(f"⚠️ 上次备份后表 {', '.join(deleted)} 有记录被删除，本次执行全量备份")
+                incremental, state = False, None
+            kind = "incremental" if incremental else "full"
+            path = path or _default_backup_path(kind)
+            tmp_path = path + ".tmp"
+            print(f"🔍 开始流式备份数据库（{'增量' if incremental else '全量'}）...")
+            with _open_backup(tmp_path, "w", _codec(path)) as f:
+                f.write(json.dumps({"backup": kind, "created_at": snapshot.isoformat()}) + "\n")
+                for table in Base.metadata.sorted_tables:
+                    _export_table(conn, f, table, state, watermarks, counts)
+        # 文件完整写入并关闭后才替换到正式路径，之后才推进备份状态
+        os.replace(tmp_path, path)
+
+        # 全量备份开启新的备份链，增量备份追加到当前链的末尾
+        chain = (state["chain"] if incremental else []) + [os.path.abspath(path)]
+        _save_state({"chain": chain, "watermarks": watermarks, "counts": counts, "last_backup_at": snapshot.isoformat()})
+        print(f"\n✅ 导出成功！备份文件位于: {path}（耗时 {time.perf_counter() - started:.1f}s）")
+        return path
     except Exception as e:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
         print(f"❌ 导出失败: {e}")
-    finally:
-        s.close()
 
-def import_data():
-    """全自动恢复：增加日期字段的解析逻辑"""
-    backup_path = "./data/full_system_backup.json"
-    if not os.path.exists(backup_path):
-        print(f"❌ 找不到备份文件: {backup_path}")
-        return
+def _export_table(conn, f, table, state, watermarks, counts):
+    """导出单张表；增量表同时记录本次的水位线与水位线内的行数"""
+    query, high = _table_query(conn, table, state)
+    if high is not None:
+        watermarks[table.name] = high
+        counts[table.name] = _row_count(conn, table, high)
+    columns = [c.name for c in table.columns]
+    f.write(json.dumps({"table": table.name, "columns": columns}, ensure_ascii=False) + "\n")
+    result = conn.execution_options(yield_per=BATCH_SIZE).execute(query)
+    count = 0
+    for rows in result.partitions():
+        f.write("".join(
+            json.dumps([_encode(v) for v in row], ensure_ascii=False) + "\n" for row in rows
+        ))
+        count += len(rows)
+        if count % PROGRESS_EVERY < len(rows):
+            print(f"   ... {table.name}: {count} 条")
+    print(f" - [备份] 表 {table.name}: {count} 条记录")
 
-    s = SessionLocal()
-    try:
-        with open(backup_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        print("🚀 开始恢复数据并转换日期格式...")
-        
-        table_order = ["api_configs", "task_presets", "scrape_tasks", "task_entries"]
-        
-        for table_name in table_order:
-            if table_name not in data:
+def _iter_backup(path: str):
+    """逐行读取备份，产出 (表对象, 列名列表, 行值列表)"""
+    with _open_backup(path, "r", _codec(path)) as f:
+        table, columns = None, None
+        for line in f:
+            if not line.strip():
                 continue
-            
-            model = next((cls for cls in Base.__subclasses__() if cls.__tablename__ == table_name), None)
-            if not model:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                if "table" not in item:
+                    continue  # 文件头：备份类型与时间
+                table = Base.metadata.tables.get(item["table"])
+                columns = item["columns"]
+                if table is None:
+                    print(f"⚠️ 跳过当前版本不存在的表: {item['table']}")
                 continue
-            
-            inserted_count = 0
-            for item in data[table_name]:
-                valid_fields = {k: v for k, v in item.items() if k in model.__table__.columns}
-                
-                # --- 关键修复代码：处理日期字符串 ---
-                for key, value in valid_fields.items():
-                    # 如果字段名包含 'created_at' 或 'at'，且值是字符串，尝试转回 datetime
-                    if 'created_at' in key and isinstance(value, str) and value != "None":
-                        try:
-                            # 适配 JSON 导出的 '2026-01-27 20:41:24.752971' 格式
-                            valid_fields[key] = datetime.strptime(value.split('.')[0], '%Y-%m-%d %H:%M:%S')
-                        except:
-                            valid_fields[key] = datetime.now() # 如果解析失败，赋当前时间
-                # ----------------------------------
-
-                exists = s.query(model).filter(model.id == valid_fields['id']).first()
-                if not exists:
-                    s.add(model(**valid_fields))
-                    inserted_count += 1
-            
-            s.flush() 
-            print(f" - [恢复] 表 {table_name}: 已还原 {inserted_count} 条记录")
-            
-        s.commit()
-        print("\n✅ 数据恢复成功！日期格式已校正。")
+            if table is not None:
+                yield table, columns, item
+
+def _iter_legacy_backup(path: str):
+    """旧版整库 JSON 备份（{表名: [行字典, ...]}），按表依赖顺序产出"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    for table in Base.metadata.sorted_tables:
+        for item in data.get(table.name, []):
+            columns = list(item.keys())
+            yield table, columns, [None if item[c] == "None" else item[c] for c in columns]
+
+def _upsert(conn, table, rows):
+    """按主键批量 upsert：已存在的行用备份内容覆盖"""
+    stmt = sqlite_insert(table)
+    pk_names = [c.name for c in table.primary_key.columns]
+    updates = {c.name: stmt.excluded[c.name] for c in table.columns if c.name not in pk_names}
+    # 同一批的列集合必须一致，旧备份里缺失的列按批拆分
+    by_columns = {}
+    for row in rows:
+        by_columns.setdefault(tuple(row), []).append(row)
+    for keys, group in by_columns.items():
+        set_ = {k: v for k, v in updates.items() if k in keys}
+        upsert = stmt.on_conflict_do_update(index_elements=pk_names, set_=set_) if set_ else stmt.on_conflict_do_nothing()
+        conn.execute(upsert, group)
+
+def import_data(path: str = None):
+    """
+    流式恢复：逐行读取备份文件，每 BATCH_SIZE 行批量 upsert 一次并提交
+    不带参数时恢复 data 目录下最新的备份；返回是否完整恢复
+    """
+    path = path or _latest_backup()
+    if not path or not os.path.exists(path):
+        print(f"❌ 找不到备份文件: {path or BACKUP_DIR}")
+        return False
+
+    db.init_db()
+    rows_iter = _iter_legacy_backup(path) if path.endswith(".json") else _iter_backup(path)
+    started = time.perf_counter()
+    counts = {}
+    try:
+        print(f"🚀 开始恢复数据: {path}")
+        batch, batch_table = [], None
+        with engine.connect() as conn:
+            for table, columns, values in rows_iter:
+                if batch and table is not batch_table:
+                    _upsert(conn, batch_table, batch)
+                    conn.commit()
+                    batch = []
+                batch_table = table
+                batch.append(_decode_row(table, columns, values))
+                counts[table.name] = counts.get(table.name, 0) + 1
+                if len(batch) >= BATCH_SIZE:
+                    _upsert(conn, table, batch)
+                    conn.commit()
+                    batch = []
+                    if counts[table.name] % PROGRESS_EVERY == 0:
+                        print(f"   ... {table.name}: {counts[table.name]} 条")
+            if batch:
+                _upsert(conn, batch_table, batch)
+                conn.commit()
+        for name, count in counts.items():
+            print(f" - [恢复] 表 {name}: 已还原 {count} 条记录")
+        print(f"\n✅ 数据恢复成功！（耗时 {time.perf_counter() - started:.1f}s）")
+        return True
     except Exception as e:
-        s.rollback()
         print(f"❌ 导入失败: {e}")
+        return False
+
+def restore_chain():
+    """
+    按备份链恢复：先导入最近一次全量备份，再按时间顺序回放之后的增量备份
+    各表按主键 upsert，重复执行结果相同
+    任一文件恢复失败即停止，不会把后续增量叠加到不完整的数据上；返回是否完整恢复
+    """
+    state = _load_state()
+    if not state or not state.get("chain"):
+        print(f"❌ 找不到备份链记录: {BACKUP_STATE_PATH}")
+        return False
+    missing = [p for p in state["chain"] if not os.path.exists(p)]
+    if missing:
+        print(f"❌ 备份链不完整，缺少文件: {missing}")
+        return False
+    print(f"🔗 备份链共 {len(state['chain'])} 个文件（1 个全量 + {len(state['chain']) - 1} 个增量）")
+    for i, path in enumerate(state["chain"]):
+        if not import_data(path):
+            print(f"❌ 备份链恢复中止：第 {i + 1} 个文件 {path} 恢复失败，之后的 {len(state['chain']) - i - 1} 个增量未回放")
+            return False
+    return True
+
+def _latest_backup():
+    if not os.path.isdir(BACKUP_DIR):
+        return None
+    candidates = [
+        os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR)
+        if f.startswith("backup_") and ".tmp" not in f and f != os.path.basename(BACKUP_STATE_PATH)
+    ]
+    if not candidates:
+        return LEGACY_BACKUP_PATH if os.path.exists(LEGACY_BACKUP_PATH) else None
+    return max(candidates, key=os.path.getmtime)
+
+def _db_size_mb():
+    with engine.connect() as conn:
+        pages = conn.execute(text("PRAGMA page_count")).scalar()
+        size = conn.execute(text("PRAGMA page_size")).scalar()
+    return pages * size / 1024 / 1024
+
+def compress_raw_responses(batch_size: int = 500):
+    """把旧库中未压缩的原始响应分批压缩（按主键顺序，每批一个短事务，可随时中断后重跑）"""
+    db.init_db()
+    before = _db_size_mb()
+    for table, pk, column in COMPRESSED_COLUMNS:
+        last, total = (0 if pk == "id" else ""), 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(text(
+                    f"SELECT {pk}, {column} FROM {table} "
+                    f"WHERE {pk} > :last AND typeof({column}) = 'text' ORDER BY {pk} LIMIT :n"
+                ), {"last": last, "n": batch_size}).all()
+                if not rows:
+                    break
+                conn.execute(
+                    text(f"UPDATE {table} SET {column} = :value WHERE {pk} = :pk"),
+                    [{"pk": row[0], "value": compress_text(row[1])} for row in rows]
+                )
+            last = rows[-1][0]
+            total += len(rows)
+            print(f" - [压缩] 表 {table}: 已处理 {total} 条")
+        print(f"✅ 表 {table} 压缩完成，共 {total} 条")
+    # 压缩后释放的页需要 VACUUM 才会归还给文件系统
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    print(f"\n📦 数据库大小: {before:.1f} MB → {_db_size_mb():.1f} MB")
+
+def train_compression_dict(sample_size: int = 2000):
+    """抽样最近的原始响应训练 zstd 字典，之后写入的数据使用该字典压缩"""
+    s = SessionLocal()
+    try:
+        rows = (
+            s.query(db.TaskEntry.raw_response)
+            .filter(db.TaskEntry.status == "success")
+            .order_by(db.TaskEntry.id.desc())
+            .limit(sample_size)
+            .all()
+        )
     finally:
         s.close()
+    samples = [r[0] for r in rows if r[0]]
+    if len(samples) < 100:
+        print(f"❌ 样本不足（{len(samples)} 条），至少需要 100 条成功的原始响应")
+        return
+    dict_id = train_dictionary(samples)
+    print(f"✅ 字典训练完成 (ID: {dict_id})，已保存到 ./data/zstd_dicts/")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="数据库维护工具：备份 / 恢复 / 压缩")
+    sub = parser.add_subparsers(dest="command")
+    p_export = sub.add_parser("export", help="流式导出 NDJSON 备份")
+    p_export.add_argument("-o", "--output", default=None, help="备份文件路径，.gz / .zst 结尾时自动压缩")
+    p_export.add_argument("--incremental", action="store_true", help="只导出上次备份之后新增的数据")
+    p_import = sub.add_parser("import", help="从备份恢复（批量 upsert）")
+    p_import.add_argument("path", nargs="?", default=None, help="备份文件路径，缺省为 data 目录下最新的备份")
+    p_import.add_argument("--chain", action="store_true", help="按备份链恢复：全量备份 + 之后的全部增量")
+    sub.add_parser("compress", help="压缩旧的原始响应 (raw_response)")
+    sub.add_parser("train-dict", help="训练 zstd 压缩字典")
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        print("--- 数据库维护工具 (2026版) ---")
+        print("1. 导出备份 (保命第一步)")
+        print("2. 导入恢复 (重构后回灌)")
+        print("3. 压缩旧的原始响应 (raw_response)")
+        print("4. 训练 zstd 压缩字典 (需安装 zstandard)")
+        print("5. 增量备份 (只导出上次备份后的新数据)")
+        print("6. 按备份链恢复 (全量 + 增量)")
+        choice = input("请选择操作: ")
+        args.command = {
+            "1": "export", "2": "import", "3": "compress", "4": "train-dict", "5": "export", "6": "import",
+        }.get(choice)
+        args.output = args.path = None
+        args.incremental = choice == "5"
+        args.chain = choice == "6"
+
+    # 备份 / 恢复失败时以非零状态码退出，便于定时任务与脚本发现
+    if args.command == "export":
+        if not export_data(args.output, incremental=args.incremental):
+            sys.exit(1)
+    elif args.command == "import" and args.chain:
+        if not restore_chain():
+            sys.exit(1)
+    elif args.command == "import":
+        if not import_data(args.path):
+            sys.exit(1)
+    elif args.command == "compress":
+        compress_raw_responses()
+    elif args.command == "train-dict":
+        try:
+            train_compression_dict()
+        except RuntimeError as e:
+            print(f"❌ {e}")
 
 if __name__ == "__main__":
-    print("--- 数据库维护工具 (2026版) ---")
-    print("1. 导出备份 (保命第一步)")
-    print("2. 导入恢复 (重构后回灌)")
-    choice = input("请选择操作: ")
-    if choice == "1":
-        export_data()
-    elif choice == "2":
-        import_data()
\ No newline at end of file
+    main()
@@ -1,61 +1,267 @@
 # parser_utils.py
 import json
+import logging
+from functools import lru_cache
 
-def get_value_by_path(data, path):
+# 默认按标准 OpenAI/Gemini 格式解析
+DEFAULT_MAPPING_RULES = {"answer": "choices.0.message.content", "tokens": "usage.total_tokens"}
+# 请求元数据的默认路径（标准协议 / Gemini 原生 / HMAC 网关依次尝试），模板中同名字段优先
+USAGE_RULES = {
+    "finish_reason": ["choices.0.finish_reason", "candidates.0.finishReason", "answer.0.finish_reason", "finish_reason"],
+    "input_tokens": ["usage.prompt_tokens", "usage.input_tokens", "usageMetadata.promptTokenCount",
+                     "cost_info.prompt_tokens", "cost_info.input_tokens"],
+    "output_tokens": ["usage.completion_tokens", "usage.output_tokens", "usageMetadata.candidatesTokenCount",
+                      "cost_info.completion_tokens", "cost_info.output_tokens"],
+    "reasoning_tokens": ["usage.completion_tokens_details.reasoning_tokens", "usage.reasoning_tokens",
+                         "usageMetadata.thoughtsTokenCount", "cost_info.reasoning_tokens"],
+}
+# 通配符：对列表的每个元素（或字典的每个值）展开
+WILDCARD = "*"
+
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+class CompiledPath:
     """
-    核心解析引擎：支持点号路径抽取
-    支持格式：'choices.0.message.content' 或 'answer.0.value'
+    预编译的点号路径：路径只在编译时切分一次，之后可对任意多个响应重复取值
+    支持 'choices.0.message.content'，以及通配符展开 'candidates.*.content.parts.*.text'
     """
-    if not path or data is None:
-        return None
-    
-    try:
-        keys = path.split('.')
+    __slots__ = ("path", "steps", "fan_out")
+
+    def __init__(self, path: str):
+        self.path = path
+        # 每一步预先算好整数下标，取值时不再重复 int() 转换
+        self.steps = tuple(
+            (key, int(key) if key.lstrip("-").isdigit() else None)
+            for key in path.split(".")
+        )
+        self.fan_out = any(key == WILDCARD for key, _ in self.steps)
+
+    def resolve(self, data):
+        """按路径取值，路径不匹配时抛出异常；含通配符时返回展开后的列表"""
+        if self.fan_out:
+            return self._resolve_fan_out(data, 0)
         current = data
-        for key in keys:
+        for key, index in self.steps:
             if isinstance(current, list):
                 # 如果当前是列表，key 应该是索引数字
-                current = current[int(key)]
+                current = current[index if index is not None else int(key)]
             elif isinstance(current, dict):
                 # 如果当前是字典，正常取值
                 current = current.get(key)
             else:
                 return None
         return current
+
+    def _resolve_fan_out(self, current, start):
+        for pos in range(start, len(self.steps)):
+            key, index = self.steps[pos]
+            if key == WILDCARD:
+                if isinstance(current, dict):
+                    children = current.values()
+                elif isinstance(current, list):
+                    children = current
+                else:
+                    return []
+                results = []
+                for child in children:
+                    value = self._resolve_fan_out(child, pos + 1)
+                    if isinstance(value, list) and any(k == WILDCARD for k, _ in self.steps[pos + 1:]):
+                        results.extend(value)
+                    elif value is not None:
+                        results.append(value)
+                return results
+            if isinstance(current, list):
+                try:
+                    current = current[index if index is not None else int(key)]
+                except (IndexError, ValueError):
+                    return None
+            elif isinstance(current, dict):
+                current = current.get(key)
+            else:
+                return None
+        return current
+
+    def get(self, data, default=None):
+        """安全取值：路径不存在或取到 None 时返回 default"""
+        if data is None:
+            return default
+        try:
+            value = self.resolve(data)
+        except (IndexError, KeyError, ValueError, TypeError):
+            return default
+        if value is None or (self.fan_out and value == []):
+            return default
+        return value
+
+@lru_cache(maxsize=1024)
+def compile_path(path: str) -> CompiledPath:
+    """编译并缓存路径，相同路径字符串只切分一次"""
+    return CompiledPath(path)
+
+def get_value_by_path(data, path):
+    """
+    核心解析引擎：支持点号路径抽取
+    支持格式：'choices.0.message.content' 或 'answer.0.value'
+    """
+    if not path or data is None:
+        return None
+
+    try:
+        return compile_path(path).resolve(data)
     except (IndexError, KeyError, ValueError, TypeError) as e:
         # 这里可以记录日志，方便在调试中心查错
-        print(f"解析路径 [{path}] 出错: {e}")
+        logger.debug("解析路径 [%s] 出错: %s", path, e)
         return None
 
+def parse_mapping_rules(mapping_rules=None):
+    """把模板里的映射规则（JSON 字符串或字典）规范为字典，解析失败时回退到默认规则"""
+    if mapping_rules is None or mapping_rules == "":
+        return dict(DEFAULT_MAPPING_RULES)
+    if isinstance(mapping_rules, str):
+        try:
+            mapping_rules = json.loads(mapping_rules)
+        except (TypeError, ValueError):
+            return dict(DEFAULT_MAPPING_RULES)
+    if not isinstance(mapping_rules, dict):
+        return dict(DEFAULT_MAPPING_RULES)
+    return mapping_rules
+
+class ResponseExtractor:
+    """
+    编译后的解析模板：一次编译，可批量应用到大量原始响应
+    规则写法：
+      {"answer": "choices.0.message.content"}                         单一路径
+      {"answer": ["choices.0.message.content", "answer.0.value"]}     依次尝试，取第一个有值的
+      {"tokens": {"path": "usage.total_tokens", "default": 0}}        带默认值
+      {"answer": "candidates.*.content.parts.*.text"}                 通配符展开为列表
+    """
+
+    def __init__(self, mapping_rules=None):
+        self.rules = parse_mapping_rules(mapping_rules)
+        self.fields = {}
+        for field, rule in self.rules.items():
+            default = None
+            if isinstance(rule, dict):
+                default = rule.get("default")
+                rule = rule.get("path")
+            paths = rule if isinstance(rule, list) else [rule]
+            compiled = tuple(compile_path(p) for p in paths if isinstance(p, str) and p)
+            self.fields[field] = (compiled, default)
+
+    def get(self, raw_response, field, default=None):
+        """提取单个字段"""
+        if field not in self.fields:
+            return default
+        compiled, rule_default = self.fields[field]
+        for path in compiled:
+            value = path.get(raw_response, _MISSING)
+            if value is not _MISSING:
+                return value
+        return rule_default if rule_default is not None else default
+
+    def extract(self, raw_response):
+        """按全部规则提取字段，返回 {字段名: 值}"""
+        return {field: self.get(raw_response, field) for field in self.fields}
+
+    def extract_many(self, raw_responses):
+        """批量提取，返回与输入顺序一致的列表"""
+        return [self.extract(raw) for raw in raw_responses]
+
+@lru_cache(maxsize=256)
+def _cached_extractor(template_id, mapping_rules):
+    return ResponseExtractor(mapping_rules)
+
+def get_extractor(template=None):
+    """
+    取模板对应的解析器，按 (模板 id, 规则内容) 缓存
+    模板规则被修改后内容不同，会自动编译新版本
+    """
+    if template is None or not getattr(template, "mapping_rules", None):
+        return _cached_extractor(None, None)
+    return _cached_extractor(getattr(template, "id", None), template.mapping_rules)
+
+def _as_text(value):
+    # 通配符路径会展开为列表，拼接成一段文本
+    if isinstance(value, list):
+        return "\n".join(str(v) for v in value if v is not None and str(v) != "")
+    return value
+
+def _as_tokens(value):
+    if isinstance(value, list):
+        return sum(_as_tokens(v) for v in value)
+    try:
+        return int(value) if value is not None else 0
+    except (TypeError, ValueError):
+        return 0
+
+def interpret_response(raw_res, extractor):
+    """
+    用编译好的解析器把原始响应解释为 (answer, tokens, status)
+    抓取入库与批量重新解析（services/reparse.py）共用这一套规则
+    """
+    fields = extractor.extract(raw_res)
+    answer = _as_text(fields.get("answer"))
+    tokens = _as_tokens(fields.get("tokens"))
+
+    # 处理空返回逻辑
+    if not answer or str(answer).strip() == "":
+        finish_reason = get_value_by_path(raw_res, "choices.0.finish_reason")
+        error_msg = get_value_by_path(raw_res, "error.message")
+        if error_msg:
+            answer = f"⚠️ API错误: {error_msg}"
+        else:
+            answer = f"⚠️ 无内容。状态: {finish_reason}。建议检查 max_output_tokens 设置。"
+        status = "failed"
+    else:
+        answer = str(answer)
+        # 检查是否有联网证据
+        grounding = get_value_by_path(raw_res, "choices.0.message.tool_calls")
+        if grounding:
+            answer += "\n\n[注：该回答使用了外部工具查询]"
+        status = "success"
+    return answer, tokens, status
+
+_usage_extractor = ResponseExtractor(USAGE_RULES)
+
+def extract_usage(raw_res, extractor=None):
+    """
+    提取 finish_reason 与输入/输出/推理 Token 拆分，返回字典；响应中没有的字段为 None
+    模板规则里写了同名字段（如 {"input_tokens": "cost_info.in"}）时优先使用模板规则
+    """
+    usage = {}
+    for field in USAGE_RULES:
+        value = extractor.get(raw_res, field) if extractor is not None else None
+        if value is None:
+            value = _usage_extractor.get(raw_res, field)
+        if field == "finish_reason":
+            usage[field] = str(value)[:32] if value is not None else None
+        else:
+            usage[field] = _as_tokens(value) if value is not None else None
+    return usage
+
 def extract_standard_data(raw_response, mapping_rules=None):
     """
     根据映射规则提取标准字段
     mapping_rules 示例: {"answer": "answer.0.value", "tokens": "cost_info.total_tokens"}
     如果 mapping_rules 为空，默认按标准 OpenAI 格式解析
     """
-    # 如果没传规则，默认回退到 OpenAI/Gemini 标准格式
-    if mapping_rules is None:
-        mapping_rules = {
-            "answer": "choices.0.message.content", 
-            "tokens": "usage.total_tokens"
-        }
-    # 如果传的是字符串 JSON，转为字典
-    if isinstance(mapping_rules, str):
-        try:
-            mapping_rules = json.loads(mapping_rules)
-        except:
-            mapping_rules = {"answer": "choices.0.message.content", "tokens": "usage.total_tokens"}
-    
-    answer = get_value_by_path(raw_response, mapping_rules.get("answer", ""))
-    tokens = get_value_by_path(raw_response, mapping_rules.get("tokens", ""))
-    
+    if isinstance(mapping_rules, (str, type(None))):
+        extractor = _cached_extractor(None, mapping_rules or None)
+    else:
+        extractor = ResponseExtractor(mapping_rules)
+
+    answer = extractor.get(raw_response, "answer")
+    tokens = extractor.get(raw_response, "tokens")
+
     # 强制转换 tokens 为整数，如果解析失败默认为 0
     try:
         tokens = int(tokens) if tokens is not None else 0
     except:
         tokens = 0
-        
+
     return {
         "answer": str(answer) if answer is not None else "解析失败：未找到内容",
         "tokens": tokens
-    }
\ No newline at end of file
+    }
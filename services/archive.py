@@ -0,0 +1,260 @@
+# services/archive.py
+"""
+冷存储归档
+把创建时间早于 N 天、已结束的任务连同其结果迁移到按年月分区的 Parquet 文件，
+并从数据库中删除，让在线库保持小而快：
+
+    data/archive/year=2026/month=01/task_12.parquet
+
+归档目录表 archived_tasks 记录每个任务的文件位置与汇总信息；
+归档数据仍可通过 /archive 页面查询，或按 CSV / NDJSON / Excel 导出。
+
+    python -m services.archive --days 90 --dry-run   # 只列出将被归档的任务
+    python -m services.archive --days 90 --vacuum    # 归档并回收数据库空间
+"""
+import os
+import sys
+import logging
+import argparse
+import datetime
+
+from sqlalchemy import select, text
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+import log_utils
+from database import SessionLocal, engine
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow 为可选依赖，只有归档功能需要
+    pa = None
+
+ARCHIVE_DIR = os.getenv("GEMINI_ARCHIVE_DIR", "./data/archive")
+ARCHIVE_AFTER_DAYS = int(os.getenv("GEMINI_ARCHIVE_AFTER_DAYS", "90"))
+# 只归档已经结束的任务
+ARCHIVABLE_STATUSES = ("completed", "failed", "cancelled")
+# 每批从数据库读取并写入 Parquet 的行数
+BATCH_SIZE = 2000
+# 查询结果中回答的预览长度
+ANSWER_PREVIEW_CHARS = 1500
+
+# 每行除结果字段外还冗余任务名称，导出归档数据时无需再关联任务表；
+# 请求元数据（耗时、重试、状态码、Token 拆分）一并归档，归档后仍可用于分析
+ENTRY_COLUMNS = [
+    "id", "task_id", "task_name", "prompt_index", "prompt", "answer", "raw_response",
+    "tokens_used", "status", "from_cache", "ttft_ms", "latency_ms", "started_at", "finished_at",
+    "attempts", "http_status", "finish_reason", "input_tokens", "output_tokens", "reasoning_tokens",
+    "created_at",
+]
+
+logger = logging.getLogger(__name__)
+
+def available() -> bool:
+    return pa is not None
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("归档功能需要安装 pyarrow：pip install pyarrow")
+
+def _schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("task_id", pa.int64()),
+        ("task_name", pa.string()),
+        ("prompt_index", pa.int64()),
+        ("prompt", pa.string()),
+        ("answer", pa.string()),
+        ("raw_response", pa.string()),
+        ("tokens_used", pa.int64()),
+        ("status", pa.string()),
+        ("from_cache", pa.bool_()),
+        ("ttft_ms", pa.int64()),
+        ("latency_ms", pa.int64()),
+        ("started_at", pa.timestamp("us")),
+        ("finished_at", pa.timestamp("us")),
+        ("attempts", pa.int64()),
+        ("http_status", pa.int64()),
+        ("finish_reason", pa.string()),
+        ("input_tokens", pa.int64()),
+        ("output_tokens", pa.int64()),
+        ("reasoning_tokens", pa.int64()),
+        ("created_at", pa.timestamp("us")),
+    ])
+
+def _relative_path(task) -> str:
+    created = task.created_at or datetime.datetime.now()
+    return os.path.join(f"year={created.year:04d}", f"month={created.month:02d}", f"task_{task.id}.parquet")
+
+def archivable_task_ids(s, days: int = ARCHIVE_AFTER_DAYS):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    rows = (
+        s.query(db.ScrapeTask.id)
+        .filter(db.ScrapeTask.status.in_(ARCHIVABLE_STATUSES), db.ScrapeTask.created_at < cutoff)
+        .order_by(db.ScrapeTask.id)
+        .all()
+    )
+    return [r[0] for r in rows]
+
+def archive_task(task_id: int) -> dict:
+    """
+    把单个任务写入 Parquet 后从数据库删除
+    先写临时文件再原子改名，文件落盘后才删除数据库记录；中途失败时数据库保持不变，可直接重跑
+    """
+    _require_pyarrow()
+    s = SessionLocal()
+    try:
+        task = s.get(db.ScrapeTask, task_id)
+        if task is None:
+            raise ValueError(f"任务不存在: {task_id}")
+        relative = _relative_path(task)
+        path = os.path.join(ARCHIVE_DIR, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 以下划线开头的文件会被 pyarrow dataset 忽略，写到一半的文件不会被查询到
+        tmp_path = os.path.join(os.path.dirname(path), f"_{os.path.basename(path)}.tmp")
+
+        stmt = (
+            select(*[getattr(db.TaskEntry, c) for c in ENTRY_COLUMNS if c != "task_name"])
+            .where(db.TaskEntry.task_id == task_id)
+            .order_by(db.TaskEntry.prompt_index, db.TaskEntry.id)
+        )
+        schema = _schema()
+        entry_count = total_tokens = 0
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            result = s.execute(stmt, execution_options={"yield_per": BATCH_SIZE})
+            for rows in result.partitions():
+                batch = [dict(row._mapping, task_name=task.name, from_cache=bool(row.from_cache)) for row in rows]
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                entry_count += len(batch)
+                total_tokens += sum(r["tokens_used"] or 0 for r in batch)
+        os.replace(tmp_path, path)
+
+        s.merge(db.ArchivedTask(
+            id=task.id, name=task.name, platform_type=task.platform_type, model=task.model,
+            thinking_level=task.thinking_level, status=task.status, entry_count=entry_count,
+            total_tokens=total_tokens, path=relative, created_at=task.created_at,
+            archived_at=datetime.datetime.now(),
+        ))
+        s.query(db.TaskEntry).filter(db.TaskEntry.task_id == task_id).delete(synchronize_session=False)
+        s.query(db.QueueItem).filter(db.QueueItem.task_id == task_id).delete(synchronize_session=False)
+        s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).delete(synchronize_session=False)
+        s.commit()
+        return {"task_id": task_id, "entries": entry_count, "path": relative}
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+def archive_old_tasks(days: int = ARCHIVE_AFTER_DAYS, dry_run: bool = False, vacuum: bool = False) -> dict:
+    """归档所有早于 days 天且已结束的任务，返回汇总信息"""
+    _require_pyarrow()
+    s = SessionLocal()
+    try:
+        task_ids = archivable_task_ids(s, days)
+    finally:
+        s.close()
+    report = {"task_ids": task_ids, "tasks": 0, "entries": 0, "dry_run": dry_run}
+    if dry_run:
+        return report
+    for task_id in task_ids:
+        result = archive_task(task_id)
+        report["tasks"] += 1
+        report["entries"] += result["entries"]
+        logger.info("🗄️ 已归档任务 #%s: %d 条 → %s", task_id, result["entries"], result["path"])
+    if vacuum and report["tasks"]:
+        # 删除的页需要 VACUUM 才会归还给文件系统
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    return report
+
+# --- 查询与导出 ---
+def _dataset():
+    # 显式指定结构：早期归档文件没有请求元数据列，读取时这些列为空
+    return ds.dataset(ARCHIVE_DIR, format="parquet", partitioning="hive", schema=_schema())
+
+def _filter(search: str = "", task_id: int = 0):
+    expr = None
+    if task_id and task_id > 0:
+        # 每个文件只含一个任务，Parquet 的 min/max 统计可以直接跳过无关文件
+        expr = ds.field("task_id") == task_id
+    if search:
+        matched = (
+            pc.match_substring(ds.field("prompt"), search, ignore_case=True)
+            | pc.match_substring(ds.field("answer"), search, ignore_case=True)
+        )
+        expr = matched if expr is None else expr & matched
+    return expr
+
+def _has_files() -> bool:
+    return os.path.isdir(ARCHIVE_DIR) and any(
+        f.endswith(".parquet") and not f.startswith("_")
+        for _, _, files in os.walk(ARCHIVE_DIR) for f in files
+    )
+
+def iter_entries(search: str = "", task_id: int = 0, columns=None):
+    """按批扫描归档文件，逐行产出字典；内存占用只与单批大小有关"""
+    _require_pyarrow()
+    if not _has_files():
+        return
+    scanner = _dataset().scanner(
+        columns=columns or [c for c in ENTRY_COLUMNS if c != "raw_response"],
+        filter=_filter(search, task_id),
+        batch_size=BATCH_SIZE,
+    )
+    for batch in scanner.to_batches():
+        yield from batch.to_pylist()
+
+def query_entries(search: str = "", task_id: int = 0, limit: int = 50, offset: int = 0) -> list:
+    """查询归档结果（不含原始响应），回答截断为预览"""
+    items = []
+    for i, row in enumerate(iter_entries(search, task_id)):
+        if i < offset:
+            continue
+        answer = row.get("answer") or ""
+        row["truncated"] = len(answer) > ANSWER_PREVIEW_CHARS
+        row["answer_preview"] = answer[:ANSWER_PREVIEW_CHARS]
+        row.pop("answer", None)
+        items.append(row)
+        if len(items) >= limit:
+            break
+    return items
+
+def iter_export_rows(search: str = "", task_id: int = 0):
+    """与 exporter.iter_rows 相同格式的行，供流式导出复用"""
+    columns = ["task_name", "prompt", "answer", "tokens_used", "created_at"]
+    for row in iter_entries(search, task_id, columns=columns):
+        created_at = row["created_at"]
+        yield [
+            row["task_name"] or "未归类",
+            row["prompt"],
+            row["answer"],
+            row["tokens_used"],
+            created_at.strftime("%Y-%m-%d %H:%M") if created_at else "",
+        ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="把旧任务归档到 Parquet 冷存储")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="归档创建时间早于 N 天的已结束任务")
+    parser.add_argument("--dry-run", action="store_true", help="只列出将被归档的任务")
+    parser.add_argument("--vacuum", action="store_true", help="归档后执行 VACUUM 回收数据库空间")
+    args = parser.parse_args(argv)
+
+    log_utils.setup_logging()
+    db.init_db()
+    try:
+        report = archive_old_tasks(args.days, dry_run=args.dry_run, vacuum=args.vacuum)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    if args.dry_run:
+        print(f"📋 将归档 {len(report['task_ids'])} 个任务: {report['task_ids']}")
+    else:
+        print(f"✅ 归档完成：{report['tasks']} 个任务，{report['entries']} 条结果")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# services/data_query.py
+"""
+数据中心查询工具：数据中心页面与导出接口共用的筛选、全文检索逻辑
+搜索优先走 FTS5 索引（按 bm25 相关度排序并生成摘要），
+FTS 不可用或关键词过短时退回 LIKE 模糊匹配
+"""
+import datetime
+
+from markupsafe import Markup, escape
+from sqlalchemy import select, table, column, literal_column, func, or_, and_, case
+
+import database as db
+
+# 摘要高亮使用的占位符，渲染时先转义正文再替换为 <mark>，避免注入回答中的 HTML
+SNIPPET_OPEN, SNIPPET_CLOSE = "\x02", "\x03"
+SNIPPET_TOKENS = 24
+
+def _fts_terms(search: str):
+    """把用户输入拆成 FTS 词组；trigram 分词下少于 3 个字符的词无法命中索引，返回 None"""
+    terms = [t for t in search.split() if t]
+    if not terms:
+        return None
+    if db.FTS_TOKENIZER == "trigram" and any(len(t) < 3 for t in terms):
+        return None
+    # 每个词作为短语加引号，避免 FTS 语法字符（如 - * :）被解释
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def fts_match(search: str):
+    """
+    返回全文检索子查询 (entry_id, rank, snippet)；不可用时返回 None
+    """
+    if not db.FTS_ENABLED or not search:
+        return None
+    expr = _fts_terms(search)
+    if expr is None:
+        return None
+    fts = table(db.FTS_TABLE, column("rowid"), column("rank"))
+    fts_ref = literal_column(db.FTS_TABLE)
+    return (
+        select(
+            fts.c.rowid.label("entry_id"),
+            fts.c.rank.label("rank"),
+            func.snippet(fts_ref, -1, SNIPPET_OPEN, SNIPPET_CLOSE, "…", SNIPPET_TOKENS).label("snippet"),
+        )
+        .select_from(fts)
+        .where(fts_ref.op("MATCH")(expr))
+        .subquery("fts_match")
+    )
+
+def like_filter(search: str):
+    return (db.TaskEntry.prompt.contains(search)) | (db.TaskEntry.answer.contains(search))
+
+def apply_entry_filters(query, search: str = "", task_id: int = 0):
+    """按任务与关键词筛选 TaskEntry 查询（不改变排序）"""
+    if task_id and task_id > 0:
+        query = query.filter(db.TaskEntry.task_id == task_id)
+    if search:
+        match = fts_match(search)
+        if match is not None:
+            query = query.filter(db.TaskEntry.id.in_(select(match.c.entry_id)))
+        else:
+            query = query.filter(like_filter(search))
+    return query
+
+def render_snippet(snippet: str) -> Markup:
+    """转义摘要正文，并把高亮占位符替换为 <mark> 标签"""
+    if not snippet:
+        return Markup("")
+    html = str(escape(snippet))
+    return Markup(html.replace(SNIPPET_OPEN, "<mark>").replace(SNIPPET_CLOSE, "</mark>"))
+
+# --- 分页列表 (Keyset) ---
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# 列表只取回答的前 N 个字符，完整内容在预览时按需加载
+ANSWER_PREVIEW_CHARS = 1500
+
+def encode_cursor(kind: str, key, entry_id: int) -> str:
+    """游标格式：t|<created_at ISO>|<id>（时间倒序）或 r|<rank>|<id>（相关度排序）"""
+    if kind == "t":
+        key = key.isoformat() if key else ""
+    return f"{kind}|{key}|{entry_id}"
+
+def decode_cursor(cursor: str):
+    """解析游标，非法游标返回 None（等同于第一页）"""
+    try:
+        kind, key, entry_id = cursor.split("|", 2)
+        entry_id = int(entry_id)
+        if kind == "t":
+            return kind, (datetime.datetime.fromisoformat(key) if key else None), entry_id
+        if kind == "r":
+            return kind, float(key), entry_id
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+def entry_stats(s, search: str = "", task_id: int = 0) -> dict:
+    """在 SQL 中计算筛选结果的条数与 Token 合计，不加载任何行"""
+    query = s.query(
+        func.count(db.TaskEntry.id),
+        func.coalesce(func.sum(db.TaskEntry.tokens_used), 0),
+    ).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+    total_count, total_tokens = apply_entry_filters(query, search, task_id).one()
+    return {
+        "total_count": total_count,
+        "total_tokens": int(total_tokens),
+        "avg_tokens": round(total_tokens / total_count, 1) if total_count else 0,
+    }
+
+def list_entries(s, search: str = "", task_id: int = 0, cursor: str = None, limit: int = PAGE_SIZE) -> dict:
+    """
+    分页列出 TaskEntry 摘要：只查询列表需要的列，raw_response 与完整回答不会被读取
+    无搜索词时按 (created_at, id) 倒序做 keyset 分页；全文检索时按 (rank, id) 分页
+    返回 {"items": [dict, ...], "next_cursor": str | None, "ranked": bool}
+    """
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+    columns = [
+        db.TaskEntry.id,
+        db.TaskEntry.task_id,
+        db.ScrapeTask.name.label("task_name"),
+        db.TaskEntry.prompt,
+        func.substr(db.TaskEntry.answer, 1, ANSWER_PREVIEW_CHARS).label("answer_preview"),
+        func.length(db.TaskEntry.answer).label("answer_length"),
+        db.TaskEntry.tokens_used,
+        db.TaskEntry.status,
+        db.TaskEntry.created_at,
+    ]
+    query = s.query(*columns).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+    query = apply_entry_filters(query, task_id=task_id)
+    position = decode_cursor(cursor) if cursor else None
+
+    match = fts_match(search) if search else None
+    if match is not None:
+        query = query.join(match, match.c.entry_id == db.TaskEntry.id).add_columns(
+            match.c.rank, match.c.snippet
+        )
+        if position and position[0] == "r":
+            _, rank, last_id = position
+            query = query.filter(or_(match.c.rank > rank, and_(match.c.rank == rank, db.TaskEntry.id > last_id)))
+        query = query.order_by(match.c.rank, db.TaskEntry.id)
+    else:
+        if search:
+            query = query.filter(like_filter(search))
+        if position and position[0] == "t" and position[1] is not None:
+            _, created_at, last_id = position
+            query = query.filter(or_(
+                db.TaskEntry.created_at < created_at,
+                and_(db.TaskEntry.created_at == created_at, db.TaskEntry.id < last_id),
+            ))
+        query = query.order_by(db.TaskEntry.created_at.desc(), db.TaskEntry.id.desc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = []
+    for row in rows:
+        item = dict(row._mapping)
+        item["truncated"] = (item.pop("answer_length") or 0) > ANSWER_PREVIEW_CHARS
+        if match is not None:
+            item["snippet"] = render_snippet(item.pop("snippet"))
+        items.append(item)
+
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = (
+            encode_cursor("r", last.rank, last.id) if match is not None
+            else encode_cursor("t", last.created_at, last.id)
+        )
+    return {"items": items, "next_cursor": next_cursor, "ranked": match is not None}
+
+# --- 耗时与 Token 分析 ---
+ANALYTICS_GROUPS = ("task", "model")
+# 视为输出被截断的 finish_reason（标准协议 / Gemini 原生）
+TRUNCATED_REASONS = ("length", "MAX_TOKENS")
+
+def _percentile(value, rank, count, p):
+    """最近秩法百分位：各分组内 rank >= ceil(p% * count) 的最小值"""
+    return func.min(case((rank * 100 >= count * p, value)))
+
+def entry_analytics(s, search: str = "", task_id: int = 0, group_by: str = "task") -> list:
+    """
+    按任务或按 模型 + 思考等级 汇总耗时与 Token，聚合全部在 SQL 中完成：
+    窗口函数给每组内的耗时排序，外层按组求 p50/p95，不把结果行读进内存
+    """
+    if group_by not in ANALYTICS_GROUPS:
+        raise ValueError(f"不支持的分组方式: {group_by}")
+    if group_by == "task":
+        keys = [db.TaskEntry.task_id, db.ScrapeTask.name, db.ScrapeTask.model, db.ScrapeTask.thinking_level]
+    else:
+        keys = [db.ScrapeTask.model, db.ScrapeTask.thinking_level]
+    # 耗时为空的行（缓存命中等）单独分区，排序与计数只针对有耗时的行
+    partition = keys + [db.TaskEntry.latency_ms.is_(None)]
+    ranked = s.query(
+        *keys,
+        db.TaskEntry.status, db.TaskEntry.from_cache, db.TaskEntry.latency_ms, db.TaskEntry.ttft_ms,
+        db.TaskEntry.attempts, db.TaskEntry.finish_reason, db.TaskEntry.tokens_used,
+        db.TaskEntry.input_tokens, db.TaskEntry.output_tokens, db.TaskEntry.reasoning_tokens,
+        func.row_number().over(partition_by=partition, order_by=db.TaskEntry.latency_ms).label("latency_rank"),
+        func.count().over(partition_by=partition).label("latency_count"),
+    ).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+    r = apply_entry_filters(ranked, search, task_id).subquery("ranked")
+
+    group_columns = [r.c[k.key] for k in keys]
+    rows = s.execute(
+        select(
+            *group_columns,
+            func.count().label("entries"),
+            func.sum(case((r.c.status == "success", 1), else_=0)).label("success"),
+            func.sum(case((r.c.from_cache.is_(True), 1), else_=0)).label("cached"),
+            func.avg(r.c.latency_ms).label("latency_avg_ms"),
+            _percentile(r.c.latency_ms, r.c.latency_rank, r.c.latency_count, 50).label("latency_p50_ms"),
+            _percentile(r.c.latency_ms, r.c.latency_rank, r.c.latency_count, 95).label("latency_p95_ms"),
+            func.max(r.c.latency_ms).label("latency_max_ms"),
+            func.avg(r.c.ttft_ms).label("ttft_avg_ms"),
+            func.avg(r.c.attempts).label("attempts_avg"),
+            func.sum(case((r.c.attempts > 1, 1), else_=0)).label("retried"),
+            func.sum(case((r.c.finish_reason.in_(TRUNCATED_REASONS), 1), else_=0)).label("truncated"),
+            func.coalesce(func.sum(r.c.tokens_used), 0).label("tokens"),
+            func.sum(r.c.input_tokens).label("input_tokens"),
+            func.sum(r.c.output_tokens).label("output_tokens"),
+            func.sum(r.c.reasoning_tokens).label("reasoning_tokens"),
+        )
+        .group_by(*group_columns)
+        .order_by(func.count().desc())
+    ).all()
+
+    items = []
+    for row in rows:
+        item = dict(row._mapping)
+        if "name" in item:
+            item["task_name"] = item.pop("name")
+        for key in ("latency_avg_ms", "ttft_avg_ms"):
+            item[key] = round(item[key]) if item[key] is not None else None
+        item["attempts_avg"] = round(item["attempts_avg"], 2) if item["attempts_avg"] is not None else None
+        item["success_rate"] = round(item["success"] / item["entries"] * 100, 1) if item["entries"] else 0
+        item["avg_tokens"] = round(item["tokens"] / item["entries"], 1) if item["entries"] else 0
+        items.append(item)
+    return items
+
+def task_timing_from_entries(s, task_id: int):
+    """
+    从结果表持久化的请求元数据汇总单个任务的耗时，与执行该任务的进程无关（独立 Worker 执行的任务同样可查）
+    排队等待来自 task_queue 的入队 / 认领时间；任务没有任何结果时返回 None
+    """
+    row = s.query(
+        func.count(db.TaskEntry.id).label("requests"),
+        func.sum(case((db.TaskEntry.from_cache.is_(True), 1), else_=0)).label("cache_hits"),
+        func.sum(case((db.TaskEntry.status.in_(("failed", "partial")), 1), else_=0)).label("failed"),
+        func.coalesce(func.sum(case((db.TaskEntry.attempts > 1, db.TaskEntry.attempts - 1), else_=0)), 0).label("retries"),
+        func.count(db.TaskEntry.latency_ms).label("sent"),
+        func.coalesce(func.sum(db.TaskEntry.latency_ms), 0).label("upstream_ms"),
+        func.avg(db.TaskEntry.ttft_ms).label("ttft_avg_ms"),
+        func.coalesce(func.sum(db.TaskEntry.tokens_used), 0).label("tokens"),
+        func.min(db.TaskEntry.started_at).label("first_started"),
+        func.max(db.TaskEntry.finished_at).label("last_finished"),
+    ).filter(db.TaskEntry.task_id == task_id).one()
+    if not row.requests:
+        return None
+    # SQLite 的 julianday 差值单位为天
+    queue_wait_days = s.query(
+        func.coalesce(func.sum(func.julianday(db.QueueItem.claimed_at) - func.julianday(db.QueueItem.created_at)), 0)
+    ).filter(db.QueueItem.task_id == task_id, db.QueueItem.claimed_at.isnot(None)).scalar()
+    upstream_seconds = row.upstream_ms / 1000
+    queue_wait_seconds = queue_wait_days * 86400
+    wall = (row.last_finished - row.first_started).total_seconds() if row.first_started and row.last_finished else None
+    return {
+        "source": "database",
+        "requests": row.requests,
+        "cache_hits": int(row.cache_hits or 0),
+        "failed": int(row.failed or 0),
+        "retries": int(row.retries),
+        "upstream_seconds": round(upstream_seconds, 3),
+        "avg_upstream_seconds": round(upstream_seconds / row.sent, 4) if row.sent else 0,
+        "avg_ttft_ms": round(row.ttft_avg_ms) if row.ttft_avg_ms is not None else None,
+        "queue_wait_seconds": round(queue_wait_seconds, 3),
+        "avg_queue_wait_seconds": round(queue_wait_seconds / row.requests, 4),
+        "tokens": int(row.tokens),
+        "wall_seconds": round(wall, 3) if wall is not None else None,
+    }
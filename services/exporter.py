@@ -0,0 +1,119 @@
+# services/exporter.py
+"""
+流式数据导出
+按 yield_per 分批从数据库读取，逐批写出 CSV / NDJSON 字节块或 write-only 工作簿，
+无论导出多少行，内存占用都只与单批大小有关
+"""
+import io
+import csv
+import json
+import tempfile
+
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+import database as db
+from database import SessionLocal
+from services.data_query import apply_entry_filters
+from services import archive
+
+EXPORT_BATCH_SIZE = 1000
+# 读取临时 xlsx 文件时每次发送的字节数
+CHUNK_SIZE = 64 * 1024
+# 小于该大小的工作簿留在内存里，超过后自动落盘
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+EXPORT_HEADERS = ["任务名称", "Prompt", "AI结果", "Tokens", "抓取时间"]
+
+EXPORT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+def _export_query(s, search: str, task_id: int):
+    query = s.query(
+        db.ScrapeTask.name,
+        db.TaskEntry.prompt,
+        db.TaskEntry.answer,
+        db.TaskEntry.tokens_used,
+        db.TaskEntry.created_at,
+    ).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+    return apply_entry_filters(query, search=search, task_id=task_id).order_by(db.TaskEntry.id)
+
+def has_rows(s, search: str = "", task_id: int = 0) -> bool:
+    return _export_query(s, search, task_id).first() is not None
+
+def iter_rows(search: str = "", task_id: int = 0):
+    """逐行产出导出数据；使用独立 Session，生成器被完整消费或关闭时释放连接"""
+    s = SessionLocal()
+    try:
+        query = _export_query(s, search, task_id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        for name, prompt, answer, tokens, created_at in query:
+            yield [
+                name or "未归类",
+                prompt,
+                answer,
+                tokens,
+                created_at.strftime("%Y-%m-%d %H:%M") if created_at else "",
+            ]
+    finally:
+        s.close()
+
+def stream_csv(rows):
+    """CSV 字节流；带 UTF-8 BOM，Excel 直接打开不会乱码"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield "\ufeff".encode("utf-8")
+    writer.writerow(EXPORT_HEADERS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+def stream_ndjson(rows):
+    """每行一个 JSON 对象"""
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(EXPORT_HEADERS, row)), ensure_ascii=False))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ("\n".join(chunk) + "\n").encode("utf-8")
+            chunk = []
+    if chunk:
+        yield ("\n".join(chunk) + "\n").encode("utf-8")
+
+def _clean_cell(value):
+    # openpyxl 拒绝写入控制字符，这里直接剔除
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return value
+
+def stream_xlsx(rows):
+    """
+    write-only 模式逐行写入工作簿（行数据直接落到临时文件），
+    xlsx 本质是 zip，需写完后才能发送，因此保存到临时文件再分块读出
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("数据报表")
+    ws.append(EXPORT_HEADERS)
+    for row in rows:
+        ws.append([_clean_cell(v) for v in row])
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+STREAMERS = {"xlsx": stream_xlsx, "csv": stream_csv, "ndjson": stream_ndjson}
+
+def stream_export(fmt: str, search: str = "", task_id: int = 0, archived: bool = False):
+    """按格式返回字节块生成器；archived 为 True 时从 Parquet 冷存储读取"""
+    if archived:
+        return STREAMERS[fmt](archive.iter_export_rows(search, task_id))
+    return STREAMERS[fmt](iter_rows(search, task_id))
@@ -0,0 +1,59 @@
+# services/http_client.py
+"""
+共享 HTTP 连接池
+按目标站点 (scheme + host) 复用 requests.Session，开启 keep-alive 后
+同一网关的后续请求不再重复 TCP/TLS 握手；抓取线程与探测接口共用同一套连接
+"""
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 连接池大小：单个站点最多保持的空闲连接数，可被 ApiConfig.max_concurrency 放大
+POOL_SIZE = int(os.getenv("GEMINI_HTTP_POOL_SIZE", "16"))
+# 是否启用 keep-alive；关闭后每个请求都会带上 Connection: close
+KEEP_ALIVE = os.getenv("GEMINI_HTTP_KEEP_ALIVE", "1") != "0"
+
+_sessions = {}
+_lock = threading.Lock()
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def _build_session(pool_size: int, keep_alive: bool) -> requests.Session:
+    session = requests.Session()
+    # 重试由 make_api_request 统一控制，这里不在连接层重复重试
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    session.pool_size = pool_size
+    return session
+
+def get_session(url: str, pool_size: int = None, keep_alive: bool = None) -> requests.Session:
+    """获取 url 所在站点的共享 Session；请求的池大小超过现有值时会重建连接池"""
+    pool_size = max(pool_size or 0, POOL_SIZE)
+    keep_alive = KEEP_ALIVE if keep_alive is None else keep_alive
+    key = (_origin(url), keep_alive)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None or session.pool_size < pool_size:
+            # 旧 Session 可能仍有在途请求，不主动关闭，交给垃圾回收
+            session = _build_session(pool_size, keep_alive)
+            _sessions[key] = session
+        return session
+
+def post(url: str, pool_size: int = None, keep_alive: bool = None, **kwargs) -> requests.Response:
+    """通过共享连接池发送 POST 请求，参数与 requests.post 一致"""
+    return get_session(url, pool_size, keep_alive).post(url, **kwargs)
+
+def close_all():
+    """关闭所有连接池（进程退出时调用）"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,183 @@
+# services/job_queue.py
+"""
+持久化任务队列
+- 创建任务时每个 Prompt 写入一行 task_queue，而不是只存在于内存列表里
+- 执行端按 prompt_index 顺序原子认领条目，结果入库与条目完成在同一事务内提交
+- 支持暂停 / 继续 / 取消；进程重启后未完成的条目会被重新排队
+"""
+import os
+import datetime
+import uuid
+
+from sqlalchemy import select, update, exists, func
+
+import database as db
+from database import SessionLocal
+
+# 任务仍可被调度执行的状态
+ACTIVE_TASK_STATUSES = ("pending", "running")
+# 队列条目的终态
+FINISHED_ITEM_STATUSES = ("done", "failed", "cancelled")
+# 条目被认领后超过该秒数未续约，视为执行者已失联并重新排队；执行中的条目由 task_manager 定期续约
+LEASE_SECONDS = int(os.getenv("GEMINI_QUEUE_LEASE_SECONDS", "900"))
+
+def enqueue_prompts(s, task_id: int, prompts: list):
+    """为任务批量写入队列条目（调用方负责 commit）"""
+    s.execute(
+        db.QueueItem.__table__.insert(),
+        [
+            {"task_id": task_id, "prompt_index": i, "prompt": p, "status": "pending", "attempts": 0,
+             "created_at": datetime.datetime.now()}
+            for i, p in enumerate(prompts)
+        ]
+    )
+
+def claim_items(task_id: int, worker_id: str, limit: int = 1):
+    """
+    原子认领最多 limit 条待处理条目
+    只有任务处于 running 状态时才会认领，因此暂停/取消后各工作线程会自然停下
+    """
+    claim_token = f"{worker_id}:{uuid.uuid4().hex[:8]}"
+    pending_ids = (
+        select(db.QueueItem.id)
+        .where(db.QueueItem.task_id == task_id, db.QueueItem.status == "pending")
+        .order_by(db.QueueItem.prompt_index)
+        .limit(limit)
+        .scalar_subquery()
+    )
+    task_running = exists().where(db.ScrapeTask.id == task_id, db.ScrapeTask.status == "running")
+    s = SessionLocal()
+    try:
+        s.execute(
+            update(db.QueueItem)
+            .where(db.QueueItem.id.in_(pending_ids), db.QueueItem.status == "pending", task_running)
+            .values(
+                status="running", worker_id=claim_token, claimed_at=datetime.datetime.now(),
+                attempts=db.QueueItem.attempts + 1
+            )
+            .execution_options(synchronize_session=False)
+        )
+        s.commit()
+        items = (
+            s.query(db.QueueItem)
+            .filter(db.QueueItem.worker_id == claim_token, db.QueueItem.status == "running")
+            .order_by(db.QueueItem.prompt_index)
+            .all()
+        )
+        s.expunge_all()
+        return items
+    finally:
+        s.close()
+
+def _owned(item_id: int, claim_token: str = None):
+    """条目仍由该次认领持有：状态为 running 且 worker_id 与认领令牌一致"""
+    conditions = [db.QueueItem.id == item_id, db.QueueItem.status == "running"]
+    if claim_token is not None:
+        conditions.append(db.QueueItem.worker_id == claim_token)
+    return conditions
+
+def finish_item(s, item_id: int, success: bool, claim_token: str = None) -> bool:
+    """
+    在调用方的事务中把条目标记为完成，与 TaskEntry 入库一起提交
+    只有仍持有该条目时才会更新：租约过期后条目可能已被重新排队或由其他执行者认领，
+    此时返回 False，调用方应丢弃这次过期的结果
+    """
+    return s.query(db.QueueItem).filter(*_owned(item_id, claim_token)).update(
+        {"status": "done" if success else "failed", "finished_at": datetime.datetime.now()},
+        synchronize_session=False
+    ) > 0
+
+def renew_leases(claims: dict) -> int:
+    """为仍在执行的条目续约（claims: {条目 id: 认领令牌}），返回续约成功的条数"""
+    if not claims:
+        return 0
+    now = datetime.datetime.now()
+    s = SessionLocal()
+    try:
+        renewed = sum(
+            s.query(db.QueueItem).filter(*_owned(item_id, token)).update(
+                {"claimed_at": now}, synchronize_session=False
+            )
+            for item_id, token in claims.items()
+        )
+        s.commit()
+        return renewed
+    finally:
+        s.close()
+
+def release_item(item_id: int, claim_token: str = None):
+    """未执行完的条目放回队列（例如工作线程异常退出）；条目已被重新认领时不做修改"""
+    s = SessionLocal()
+    try:
+        s.query(db.QueueItem).filter(*_owned(item_id, claim_token)).update(
+            {"status": "pending", "worker_id": None, "claimed_at": None}, synchronize_session=False
+        )
+        s.commit()
+    finally:
+        s.close()
+
+def requeue_orphaned(s):
+    """把上次进程遗留的 running 条目放回 pending，返回受影响的行数（调用方负责 commit）"""
+    return s.query(db.QueueItem).filter(db.QueueItem.status == "running").update(
+        {"status": "pending", "worker_id": None, "claimed_at": None}, synchronize_session=False
+    )
+
+def requeue_stale(s, lease_seconds: int = LEASE_SECONDS):
+    """把认领时间超过租约的 running 条目放回 pending（Worker 崩溃或失联），调用方负责 commit"""
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=lease_seconds)
+    return s.query(db.QueueItem).filter(
+        db.QueueItem.status == "running", db.QueueItem.claimed_at < deadline
+    ).update({"status": "pending", "worker_id": None, "claimed_at": None}, synchronize_session=False)
+
+def remaining_count(s, task_id: int) -> int:
+    """尚未结束（pending/running）的条目数"""
+    return s.query(func.count(db.QueueItem.id)).filter(
+        db.QueueItem.task_id == task_id,
+        db.QueueItem.status.notin_(FINISHED_ITEM_STATUSES)
+    ).scalar()
+
+def resumable_task_ids(s):
+    """仍有未完成条目且未被暂停/取消的任务"""
+    rows = (
+        s.query(db.QueueItem.task_id)
+        .join(db.ScrapeTask, db.ScrapeTask.id == db.QueueItem.task_id)
+        .filter(db.ScrapeTask.status.in_(ACTIVE_TASK_STATUSES), db.QueueItem.status == "pending")
+        .distinct()
+        .all()
+    )
+    return [r[0] for r in rows]
+
+def pause_task(s, task):
+    """暂停：不再认领新条目，在途请求完成后自然停止"""
+    if task.status in ACTIVE_TASK_STATUSES:
+        task.status = "paused"
+        s.commit()
+        return True
+    return False
+
+def resume_task(s, task):
+    """
+    继续：任务回到 pending，由调用方重新调度执行
+    暂停时在途条目已全部跑完（没有剩余条目）的任务直接标记为 completed，与执行线程的收尾逻辑一致
+    返回是否需要重新调度
+    """
+    if task.status != "paused":
+        return False
+    if remaining_count(s, task.id) == 0:
+        task.status = "completed"
+        s.commit()
+        return False
+    task.status = "pending"
+    s.commit()
+    return True
+
+def cancel_task(s, task):
+    """取消：剩余未执行条目全部标记为 cancelled"""
+    if task.status in ("completed", "failed", "cancelled"):
+        return False
+    s.query(db.QueueItem).filter(
+        db.QueueItem.task_id == task.id, db.QueueItem.status == "pending"
+    ).update({"status": "cancelled", "finished_at": datetime.datetime.now()}, synchronize_session=False)
+    task.status = "cancelled"
+    s.commit()
+    return True
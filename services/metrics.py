@@ -0,0 +1,213 @@
+# services/metrics.py
+"""
+请求级指标
+每次抓取记录排队等待、限流等待、上游耗时、重试次数、收发字节数、解析耗时、写库耗时与 Token 数，
+按 API 配置、模型、思考等级打标签，以 Prometheus 文本格式从 /metrics 暴露；
+同时按任务累计各阶段耗时，供 /api/tasks/{id}/timing 查看。
+
+指标只保存在当前进程内存中：独立 Worker 进程通过 serve() 在各自的端口上暴露 /metrics，
+任务耗时明细在其他进程中执行时可改用 data_query.task_timing 从结果表汇总。
+"""
+import time
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 耗时直方图的桶边界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FAST_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# 抓取指标共用的标签
+LABELS = ("api_config", "model", "thinking_level")
+# 内存中最多保留的任务耗时明细
+MAX_TASK_TIMINGS = 500
+
+_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # label_values -> [各桶计数..., 总和, 次数]
+
+    def observe(self, value, label_values=()):
+        if value is None:
+            return
+        with _lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, state in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, state):
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, {'le': bound})} {count}"
+            yield f"{self.name}_bucket{_format_labels(self.labels, label_values, {'le': '+Inf'})} {state[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {state[-2]:.6f}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {state[-1]}"
+
+REQUESTS = Counter("gemini_requests_total", "抓取次数，按结果分类", LABELS + ("result",))
+RETRIES = Counter("gemini_request_retries_total", "上游请求重试次数", LABELS)
+TOKENS = Counter("gemini_tokens_total", "消耗的 Token 数", LABELS)
+BYTES_OUT = Counter("gemini_request_bytes_total", "发送给上游的请求体字节数", LABELS)
+BYTES_IN = Counter("gemini_response_bytes_total", "从上游收到的响应字节数", LABELS)
+QUEUE_WAIT = Histogram("gemini_queue_wait_seconds", "Prompt 从入队到被认领的等待时间", LABELS)
+LIMITER_WAIT = Histogram("gemini_limiter_wait_seconds", "等待限流名额（并发/RPM/TPM/冷却）的时间", LABELS)
+UPSTREAM = Histogram("gemini_upstream_latency_seconds", "请求上游的总耗时（含重试）", LABELS)
+TTFT = Histogram("gemini_ttft_seconds", "流式请求的首字耗时", LABELS)
+PARSE = Histogram("gemini_parse_seconds", "按解析模板提取结果的耗时", LABELS, FAST_BUCKETS)
+DB_WRITE = Histogram("gemini_db_write_seconds", "结果批量写库耗时（每次刷盘）", (), FAST_BUCKETS)
+DB_ROWS = Counter("gemini_db_rows_written_total", "批量写入的结果行数")
+
+ALL_METRICS = (REQUESTS, RETRIES, TOKENS, BYTES_OUT, BYTES_IN, QUEUE_WAIT, LIMITER_WAIT, UPSTREAM, TTFT, PARSE,
+               DB_WRITE, DB_ROWS)
+
+# 任务维度的耗时明细：task_id -> 各阶段累计值
+_task_timings = {}
+
+def label_values(task, api_config) -> tuple:
+    return (
+        getattr(api_config, "name", None) or "",
+        getattr(task, "model", None) or "",
+        getattr(task, "thinking_level", None) or "",
+    )
+
+def _task_timing(task_id):
+    timing = _task_timings.get(task_id)
+    if timing is None:
+        if len(_task_timings) >= MAX_TASK_TIMINGS:
+            _task_timings.pop(next(iter(_task_timings)))
+        timing = _task_timings[task_id] = {
+            "requests": 0, "cache_hits": 0, "shared": 0, "failed": 0, "retries": 0,
+            "queue_wait_seconds": 0.0, "limiter_wait_seconds": 0.0, "upstream_seconds": 0.0,
+            "parse_seconds": 0.0, "db_write_seconds": 0.0, "bytes_out": 0, "bytes_in": 0, "tokens": 0,
+            "started_at": time.time(), "updated_at": time.time(),
+        }
+    return timing
+
+def observe_queue_wait(task_id, labels, seconds):
+    QUEUE_WAIT.observe(seconds, labels)
+    with _lock:
+        _task_timing(task_id)["queue_wait_seconds"] += seconds or 0
+
+def observe_request(task_id, labels, result, stats=None, upstream_seconds=None, parse_seconds=None, tokens=0):
+    """
+    记录一次抓取
+    result: success / failed / partial / cache_hit / shared
+    stats: make_api_request 写入的统计字典（attempts、limiter_wait_seconds、bytes_out、bytes_in、ttft_ms）
+    """
+    stats = stats or {}
+    retries = max(0, stats.get("attempts", 1) - 1) if stats.get("attempts") else 0
+    REQUESTS.inc(labels + (result,))
+    if retries:
+        RETRIES.inc(labels, retries)
+    if tokens:
+        TOKENS.inc(labels, tokens)
+    if stats.get("bytes_out"):
+        BYTES_OUT.inc(labels, stats["bytes_out"])
+    if stats.get("bytes_in"):
+        BYTES_IN.inc(labels, stats["bytes_in"])
+    LIMITER_WAIT.observe(stats.get("limiter_wait_seconds"), labels)
+    UPSTREAM.observe(upstream_seconds, labels)
+    if stats.get("ttft_ms") is not None:
+        TTFT.observe(stats["ttft_ms"] / 1000, labels)
+    PARSE.observe(parse_seconds, labels)
+
+    with _lock:
+        timing = _task_timing(task_id)
+        timing["requests"] += 1
+        timing["cache_hits"] += result == "cache_hit"
+        timing["shared"] += result == "shared"
+        timing["failed"] += result in ("failed", "partial")
+        timing["retries"] += retries
+        timing["limiter_wait_seconds"] += stats.get("limiter_wait_seconds") or 0
+        timing["upstream_seconds"] += upstream_seconds or 0
+        timing["parse_seconds"] += parse_seconds or 0
+        timing["bytes_out"] += stats.get("bytes_out") or 0
+        timing["bytes_in"] += stats.get("bytes_in") or 0
+        timing["tokens"] += tokens or 0
+        timing["updated_at"] = time.time()
+
+def observe_db_write(seconds, rows, task_rows=None):
+    """记录一次刷盘；task_rows 为 {task_id: 行数}，写库耗时按行数分摊到各任务"""
+    DB_WRITE.observe(seconds)
+    DB_ROWS.inc((), rows)
+    if task_rows and rows:
+        with _lock:
+            for task_id, count in task_rows.items():
+                _task_timing(task_id)["db_write_seconds"] += seconds * count / rows
+
+def task_breakdown(task_id):
+    """单个任务各阶段的累计耗时与平均值（source=process）；本进程没有执行过该任务时返回 None"""
+    with _lock:
+        timing = _task_timings.get(task_id)
+        if timing is None:
+            return None
+        timing = {k: round(v, 6) if isinstance(v, float) else v for k, v in timing.items()}
+    timing["source"] = "process"
+    sent = max(1, timing["requests"] - timing["cache_hits"] - timing["shared"])
+    timing["avg_upstream_seconds"] = round(timing["upstream_seconds"] / sent, 4)
+    timing["avg_limiter_wait_seconds"] = round(timing["limiter_wait_seconds"] / sent, 4)
+    timing["avg_queue_wait_seconds"] = round(timing["queue_wait_seconds"] / max(1, timing["requests"]), 4)
+    timing["avg_parse_seconds"] = round(timing["parse_seconds"] / max(1, timing["requests"]), 6)
+    timing["wall_seconds"] = round(timing["updated_at"] - timing["started_at"], 3)
+    return timing
+
+def render() -> str:
+    """Prometheus 文本格式"""
+    with _lock:
+        lines = [line for metric in ALL_METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port: int, host: str = "0.0.0.0"):
+    """在后台线程中以 HTTP 暴露本进程的 /metrics（供独立 Worker 进程使用），返回 server"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name=f"metrics-{port}", daemon=True).start()
+    logger.info("📈 指标已暴露: http://%s:%d/metrics", host, port)
+    return server
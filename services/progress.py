@@ -0,0 +1,230 @@
+# services/progress.py
+"""
+任务进度推送
+任务列表与结果页通过 SSE 订阅进度，不再整页刷新。
+进度只用聚合 SQL 计算，不加载任务的 entries 关系：
+  - 队列计数：task_queue 按 (task_id, status) 分组，走 ix_task_queue_claim 覆盖索引
+  - 结果与 Token：首次全量聚合，之后每轮只读取主键大于上次位置、属于被跟踪任务的新结果
+  - 结果页：首屏只渲染按主键分页的前 ENTRY_PAGE_SIZE 条，其余结果由推送分批补齐
+"""
+import json
+import time
+from collections import deque
+
+from sqlalchemy import func, case, select
+
+import database as db
+from database import SessionLocal
+
+# 推送轮询间隔（秒）
+POLL_INTERVAL = 1.0
+# 无变化时发送心跳注释的间隔（秒），防止代理断开空闲连接
+HEARTBEAT_INTERVAL = 15
+# 估算 ETA 使用的滑动窗口（秒）
+RATE_WINDOW = 60
+# 仍可能产生新结果的任务状态
+ACTIVE_STATUSES = ("pending", "running", "paused")
+# 结果页展示与推送时回答的最大长度，超出部分通过原始 JSON 查看
+ENTRY_ANSWER_CHARS = 20000
+# 结果页首屏渲染的结果条数，其余由推送补齐
+ENTRY_PAGE_SIZE = 50
+# 每轮推送的最大结果条数，存量较多时分批推送
+ENTRY_PUSH_LIMIT = 200
+
+def queue_counts(s, task_ids):
+    """各任务的队列状态计数与首次认领、最后完成时间"""
+    rows = s.execute(
+        select(
+            db.QueueItem.task_id,
+            func.count(db.QueueItem.id),
+            func.sum(case((db.QueueItem.status == "done", 1), else_=0)),
+            func.sum(case((db.QueueItem.status == "failed", 1), else_=0)),
+            func.sum(case((db.QueueItem.status.in_(("pending", "running")), 1), else_=0)),
+            func.min(db.QueueItem.claimed_at),
+            func.max(db.QueueItem.finished_at),
+        )
+        .where(db.QueueItem.task_id.in_(task_ids))
+        .group_by(db.QueueItem.task_id)
+    ).all()
+    return {
+        r[0]: {"total": r[1], "done": r[2] or 0, "failed": r[3] or 0, "remaining": r[4] or 0,
+               "first_claimed": r[5], "last_finished": r[6]}
+        for r in rows
+    }
+
+def entry_page(s, task_ids, after_id=0, limit=None, upper=None):
+    """
+    按主键键集分页读取结果（id > after_id，按 id 升序，最多 limit 条）
+    回答在 SQL 中截断为 ENTRY_ANSWER_CHARS 个字符，不加载 ORM 对象与完整回答
+    """
+    query = (
+        select(
+            db.TaskEntry.id, db.TaskEntry.task_id, db.TaskEntry.tokens_used, db.TaskEntry.prompt_index,
+            db.TaskEntry.prompt, func.substr(db.TaskEntry.answer, 1, ENTRY_ANSWER_CHARS),
+            func.length(db.TaskEntry.answer) > ENTRY_ANSWER_CHARS,
+            db.TaskEntry.status, db.TaskEntry.from_cache, db.TaskEntry.ttft_ms, db.TaskEntry.latency_ms,
+        )
+        .where(db.TaskEntry.task_id.in_(task_ids), db.TaskEntry.id > (after_id or 0))
+        .order_by(db.TaskEntry.id)
+        .limit(limit or ENTRY_PAGE_SIZE)
+    )
+    if upper is not None:
+        query = query.where(db.TaskEntry.id <= upper)
+    return [
+        {
+            "id": row[0], "task_id": row[1], "tokens_used": row[2] or 0, "prompt_index": row[3],
+            "prompt": row[4], "answer": row[5] or "", "truncated": bool(row[6]), "status": row[7],
+            "from_cache": bool(row[8]), "ttft_ms": row[9], "latency_ms": row[10],
+        }
+        for row in s.execute(query).all()
+    ]
+
+class ProgressTracker:
+    """
+    一个订阅连接对应一个跟踪器，保存结果表的读取位置与各任务的累计值
+    snapshot() 每轮返回发生变化的任务进度，new_entries 为本轮新写入的结果
+    """
+
+    def __init__(self, task_ids=None, with_entries: bool = False, after_entry_id: int = None):
+        # task_ids 为 None 时跟踪所有未结束的任务以及本连接期间新建的任务
+        self.task_ids = set(task_ids) if task_ids else None
+        self.with_entries = with_entries
+        # 结果页传入首屏最后一条结果的位置，之后的结果（含首屏之外的存量）都会推送
+        self.last_entry_id = after_entry_id
+        self.pushed_entry_id = after_entry_id
+        self.loaded = set()  # 已完成全量聚合的任务
+        self.totals = {}   # task_id -> {"entries": n, "tokens": n}
+        self.samples = {}  # task_id -> deque[(monotonic, finished)]
+        self.sent = {}     # task_id -> 上次推送的进度，用于只推送变化
+        self.new_entries = []
+
+    def _watched(self, s):
+        if self.task_ids is not None:
+            return sorted(self.task_ids)
+        ids = set(s.scalars(select(db.ScrapeTask.id).where(db.ScrapeTask.status.in_(ACTIVE_STATUSES))))
+        return sorted(ids | set(self.sent))
+
+    def _load_totals(self, s, task_ids):
+        """新跟踪的任务全量聚合一次（截至当前读取位置），之后只做增量"""
+        rows = s.execute(
+            select(db.TaskEntry.task_id, func.count(db.TaskEntry.id), func.coalesce(func.sum(db.TaskEntry.tokens_used), 0))
+            .where(db.TaskEntry.task_id.in_(task_ids), db.TaskEntry.id <= self.last_entry_id)
+            .group_by(db.TaskEntry.task_id)
+        ).all()
+        for task_id, count, tokens in rows:
+            self.totals[task_id] = {"entries": count, "tokens": int(tokens)}
+        self.loaded.update(task_ids)
+
+    def _read_new_entries(self, s, task_ids):
+        """
+        合计：主键大于上次位置、属于被跟踪任务的结果按任务聚合后累加（主键范围扫描，不读回答文本）
+        结果推送：另有一个推送位置，每轮最多读取 ENTRY_PUSH_LIMIT 条，结果页首屏之后的存量分批补齐
+        """
+        # 先确定本轮的读取上界，再只取被跟踪任务的行：其它任务的结果（及其回答文本）不会被读出
+        upper = s.scalar(select(func.coalesce(func.max(db.TaskEntry.id), 0)))
+        if upper > self.last_entry_id:
+            rows = s.execute(
+                select(db.TaskEntry.task_id, func.count(db.TaskEntry.id), func.coalesce(func.sum(db.TaskEntry.tokens_used), 0))
+                .where(db.TaskEntry.id > self.last_entry_id, db.TaskEntry.id <= upper, db.TaskEntry.task_id.in_(task_ids))
+                .group_by(db.TaskEntry.task_id)
+            ).all()
+            for task_id, count, tokens in rows:
+                totals = self.totals.setdefault(task_id, {"entries": 0, "tokens": 0})
+                totals["entries"] += count
+                totals["tokens"] += int(tokens)
+            self.last_entry_id = upper
+        self.new_entries = []
+        if self.with_entries and self.pushed_entry_id < self.last_entry_id:
+            self.new_entries = entry_page(s, task_ids, self.pushed_entry_id, ENTRY_PUSH_LIMIT, upper=self.last_entry_id)
+            full = len(self.new_entries) == ENTRY_PUSH_LIMIT
+            self.pushed_entry_id = self.new_entries[-1]["id"] if full else self.last_entry_id
+
+    @property
+    def entries_pending(self) -> bool:
+        """还有已写入但尚未推送的结果"""
+        return self.with_entries and self.pushed_entry_id is not None and self.pushed_entry_id < self.last_entry_id
+
+    def _eta(self, task_id, counts, now):
+        """按最近 RATE_WINDOW 秒的完成速度估算剩余时间；样本不足时用队列的认领/完成时间估算"""
+        finished = counts["done"] + counts["failed"]
+        samples = self.samples.setdefault(task_id, deque())
+        samples.append((now, finished))
+        while len(samples) > 2 and now - samples[0][0] > RATE_WINDOW:
+            samples.popleft()
+        if not counts["remaining"]:
+            return 0
+        first_time, first_finished = samples[0]
+        if now - first_time >= 5 and finished > first_finished:
+            rate = (finished - first_finished) / (now - first_time)
+        elif finished and counts["first_claimed"] and counts["last_finished"]:
+            elapsed = (counts["last_finished"] - counts["first_claimed"]).total_seconds()
+            rate = finished / elapsed if elapsed > 0 else None
+        else:
+            rate = None
+        return int(counts["remaining"] / rate) if rate else None
+
+    def snapshot(self, s):
+        """返回本轮发生变化的任务进度列表"""
+        task_ids = self._watched(s)
+        if not task_ids:
+            self.new_entries = []
+            return []
+        if self.last_entry_id is None:
+            self.last_entry_id = s.scalar(select(func.coalesce(func.max(db.TaskEntry.id), 0)))
+            self.pushed_entry_id = self.last_entry_id
+        unloaded = [t for t in task_ids if t not in self.loaded]
+        if unloaded:
+            self._load_totals(s, unloaded)
+        self._read_new_entries(s, task_ids)
+        statuses = dict(s.execute(select(db.ScrapeTask.id, db.ScrapeTask.status).where(db.ScrapeTask.id.in_(task_ids))).all())
+        counts = queue_counts(s, task_ids)
+        now = time.monotonic()
+        changed = []
+        for task_id in task_ids:
+            if task_id not in statuses:
+                continue  # 任务已被删除或归档
+            totals = self.totals.get(task_id, {"entries": 0, "tokens": 0})
+            # 早期任务没有队列记录，以结果数作为进度
+            c = counts.get(task_id) or {
+                "total": totals["entries"], "done": totals["entries"], "failed": 0, "remaining": 0,
+                "first_claimed": None, "last_finished": None,
+            }
+            progress = {
+                "task_id": task_id,
+                "status": statuses[task_id],
+                "total": c["total"],
+                "done": c["done"],
+                "failed": c["failed"],
+                "remaining": c["remaining"],
+                "entries": totals["entries"],
+                "tokens": totals["tokens"],
+                "eta_seconds": self._eta(task_id, c, now) if statuses[task_id] == "running" else None,
+            }
+            if self.sent.get(task_id) != progress:
+                self.sent[task_id] = progress
+                changed.append(progress)
+        return changed
+
+    def finished(self) -> bool:
+        """跟踪的任务都已结束且结果已推送完（只对指定了任务的订阅有意义）"""
+        return self.task_ids is not None and not self.entries_pending and all(
+            self.sent.get(t, {}).get("status") not in ACTIVE_STATUSES for t in self.task_ids
+        )
+
+def initial_progress(s, task_ids):
+    """页面首次渲染用的进度（与推送的格式相同）"""
+    tracker = ProgressTracker(task_ids)
+    return {p["task_id"]: p for p in tracker.snapshot(s)} if task_ids else {}
+
+def poll(tracker):
+    """执行一轮查询，返回 (变化的进度, 新结果)；在线程池中调用"""
+    s = SessionLocal()
+    try:
+        changed = tracker.snapshot(s)
+        return changed, tracker.new_entries
+    finally:
+        s.close()
+
+def format_event(event: str, data) -> str:
+    """编码为一条 SSE 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
@@ -0,0 +1,188 @@
+# services/rate_limiter.py
+"""
+按 ApiConfig 共享的限流器
+- 令牌桶：分别控制每分钟请求数 (RPM) 与每分钟 Token 数 (TPM)
+- AIMD 自适应并发：遇到 429/503 并发减半，连续成功后逐步 +1
+- Retry-After：网关要求冷却时，同一配置下的所有线程一起暂停
+同一进程内所有任务通过 get_limiter 拿到同一个实例，从而共享额度
+"""
+import time
+import threading
+import datetime
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# 单次 Retry-After 等待的上限，防止异常值把任务卡死
+MAX_RETRY_AFTER = 300
+
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 64
+
+def resolve_concurrency(config) -> int:
+    """读取 ApiConfig 上的并发上限，并限制在 [1, MAX_CONCURRENCY] 区间"""
+    try:
+        level = int(getattr(config, "max_concurrency", None) or DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        level = DEFAULT_CONCURRENCY
+    return max(1, min(level, MAX_CONCURRENCY))
+
+def parse_retry_after(value):
+    """解析 Retry-After 头：支持秒数和 HTTP 日期两种格式，无法解析返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        seconds = (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return max(0.0, min(seconds, MAX_RETRY_AFTER))
+
+class TokenBucket:
+    """经典令牌桶：容量为一分钟的额度，按秒匀速回填"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1):
+        """阻塞直到桶内有足够额度；单次申请超过容量时按容量计"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def debit(self, amount: float):
+        """事后补扣（或退还）额度，允许余额为负，后续请求会相应等待"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+class AdaptiveConcurrency:
+    """AIMD 并发闸门：加性增、乘性减"""
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        # 每成功 limit 次（约一个窗口）并发 +1
+        with self._cond:
+            if self.limit >= self.max_limit:
+                return
+            self._successes += 1
+            if self._successes >= self.limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(self.min_limit, self.limit // 2)
+            self._successes = 0
+
+    def resize(self, max_limit: int):
+        with self._cond:
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+            self._cond.notify_all()
+
+class ApiRateLimiter:
+    """单个 ApiConfig 的完整限流状态"""
+
+    def __init__(self, max_concurrency: int, rpm_limit: int = 0, tpm_limit: int = 0):
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.rpm_limit = rpm_limit or 0
+        self.tpm_limit = tpm_limit or 0
+        self.rpm_bucket = TokenBucket(rpm_limit) if rpm_limit and rpm_limit > 0 else None
+        self.tpm_bucket = TokenBucket(tpm_limit) if tpm_limit and tpm_limit > 0 else None
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_cooldown(self):
+        while True:
+            with self._lock:
+                wait = self._cooldown_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    @contextmanager
+    def slot(self, estimated_tokens: int = 0):
+        """占用一个请求名额：冷却 -> 并发闸门 -> RPM -> TPM"""
+        self._wait_cooldown()
+        self.concurrency.acquire()
+        try:
+            if self.rpm_bucket:
+                self.rpm_bucket.acquire(1)
+            if self.tpm_bucket and estimated_tokens:
+                self.tpm_bucket.acquire(estimated_tokens)
+            yield
+        finally:
+            self.concurrency.release()
+
+    def record_tokens(self, actual: int, estimated: int = 0):
+        """用实际消耗校正 TPM 预估"""
+        if self.tpm_bucket and actual is not None:
+            self.tpm_bucket.debit(actual - estimated)
+
+    def on_success(self):
+        self.concurrency.on_success()
+
+    def on_throttle(self, retry_after: float = None):
+        """429/503：并发减半，并让同一网关的所有请求冷却 retry_after 秒"""
+        self.concurrency.on_throttle()
+        if retry_after:
+            with self._lock:
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + retry_after)
+
+_limiters = {}
+_registry_lock = threading.Lock()
+
+def get_limiter(api_config) -> ApiRateLimiter:
+    """按 ApiConfig.id 取共享限流器；配置被修改后自动按新参数重建"""
+    max_concurrency = resolve_concurrency(api_config)
+    rpm = getattr(api_config, "rpm_limit", 0) or 0
+    tpm = getattr(api_config, "tpm_limit", 0) or 0
+    key = getattr(api_config, "id", None) or api_config.base_url
+    with _registry_lock:
+        limiter = _limiters.get(key)
+        if limiter is None or limiter.rpm_limit != rpm or limiter.tpm_limit != tpm:
+            limiter = ApiRateLimiter(max_concurrency, rpm, tpm)
+            _limiters[key] = limiter
+        elif limiter.concurrency.max_limit != max_concurrency:
+            limiter.concurrency.resize(max_concurrency)
+        return limiter
@@ -0,0 +1,272 @@
+# services/reparse.py
+"""
+批量重新解析
+TaskEntry.raw_response 保存了接口原始返回，修正解析模板后可以直接用新模板
+重新提取 answer / tokens_used，无需重新抓取、重复消耗 Token：
+
+    python -m services.reparse --template 3 --task 12 --dry-run   # 只预览差异
+    python -m services.reparse --template 3 --task 12             # 写回数据库
+
+按主键 keyset 分批读取原始响应，JSON 解析与字段提取分发到多个进程并行执行，
+有变化的行再按主键批量 UPDATE 回库。
+
+Web 端通过 start_job() 在后台线程中执行，页面轮询 get_job() 获取进度。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import datetime
+import threading
+import itertools
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import update, type_coerce, LargeBinary, func
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+from database import SessionLocal
+from parser_utils import get_extractor, _cached_extractor, interpret_response, extract_usage
+from compress_utils import decompress_text
+from services.data_query import apply_entry_filters
+
+BATCH_SIZE = 500
+# dry-run 时返回的差异样例条数与预览长度
+DIFF_LIMIT = 50
+DIFF_PREVIEW_CHARS = 200
+# 抓取异常时本地写入的占位 raw_response，其中没有接口返回，重新解析没有意义
+LOCAL_FAILURE_KEYS = {"error", "last_level"}
+# 与回答一起重新提取的用量列（user-023 的请求元数据）
+USAGE_COLUMNS = ("finish_reason", "input_tokens", "output_tokens", "reasoning_tokens")
+# Web 端后台任务的解析进程数：在 uvicorn 进程内 spawn 子进程会让每个子进程重新导入整个应用，
+# 因此 Web 端只在后台线程内解析，大批量数据请使用命令行（默认按 CPU 核数并行）
+WEB_WORKERS = 1
+# 内存中保留的后台任务数量，超出后淘汰最早的任务
+MAX_JOBS = 20
+
+logger = logging.getLogger(__name__)
+
+_jobs = OrderedDict()  # job_id -> 进度报告
+_jobs_lock = threading.Lock()
+
+def _reparse_rows(template_id, mapping_rules, rows):
+    """
+    在子进程中执行：解析一批 (id, raw_response, answer, tokens_used, status, *USAGE_COLUMNS)
+    返回 (有变化的行, 跳过的行数)；finish_reason 与 Token 拆分随回答一起按新模板重新提取
+    partial（流式中途超时）的行保留原状态，只更新回答、Tokens 与用量字段
+    """
+    extractor = _cached_extractor(template_id, mapping_rules)
+    changes, skipped = [], 0
+    for entry_id, stored, old_answer, old_tokens, old_status, *old_usage in rows:
+        try:
+            raw_text = decompress_text(stored)
+            raw = json.loads(raw_text) if raw_text else None
+        except Exception:
+            raw = None
+        if raw is None or (isinstance(raw, dict) and raw and set(raw) <= LOCAL_FAILURE_KEYS):
+            skipped += 1
+            continue
+        answer, tokens, status = interpret_response(raw, extractor)
+        if old_status == "partial":
+            status = old_status
+        usage = extract_usage(raw, extractor) if isinstance(raw, dict) else dict.fromkeys(USAGE_COLUMNS)
+        if (answer, tokens, status) != (old_answer, old_tokens or 0, old_status) or \
+                [usage[c] for c in USAGE_COLUMNS] != old_usage:
+            changes.append((entry_id, answer, tokens, status, old_answer, old_tokens, old_status, usage))
+    return changes, skipped
+
+def _iter_batches(search: str, task_id: int, batch_size: int):
+    """按主键 keyset 分批读取，每批使用独立的短事务，不会长时间占用读快照"""
+    last_id = 0
+    while True:
+        s = SessionLocal()
+        try:
+            # raw_response 按存储原样（压缩字节）取出，解压与解析一起放到子进程中执行
+            query = s.query(
+                db.TaskEntry.id, type_coerce(db.TaskEntry.raw_response, LargeBinary), db.TaskEntry.answer,
+                db.TaskEntry.tokens_used, db.TaskEntry.status, *[getattr(db.TaskEntry, c) for c in USAGE_COLUMNS]
+            ).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+            query = apply_entry_filters(query, search=search, task_id=task_id)
+            rows = [tuple(r) for r in query.filter(db.TaskEntry.id > last_id).order_by(db.TaskEntry.id).limit(batch_size)]
+        finally:
+            s.close()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
+        if len(rows) < batch_size:
+            return
+
+def _write_changes(changes):
+    s = SessionLocal()
+    now = datetime.datetime.now()
+    try:
+        s.execute(
+            update(db.TaskEntry),
+            [{"id": c[0], "answer": c[1], "tokens_used": c[2], "status": c[3], **c[7], "updated_at": now}
+             for c in changes]
+        )
+        s.commit()
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+def _preview(text):
+    text = text or ""
+    return text if len(text) <= DIFF_PREVIEW_CHARS else text[:DIFF_PREVIEW_CHARS] + "…"
+
+def _load_rules(template_id):
+    """校验解析模板并返回传给子进程的 (模板 ID, 映射规则)"""
+    s = SessionLocal()
+    try:
+        template = s.get(db.ResponseTemplate, template_id) if template_id else None
+        if template_id and template is None:
+            raise ValueError(f"解析模板不存在: {template_id}")
+        extractor = get_extractor(template)
+        rules_key = (template.id, template.mapping_rules) if template and template.mapping_rules else (None, None)
+    finally:
+        s.close()
+    if not extractor.fields:
+        raise ValueError("解析模板没有可用的字段规则")
+    return rules_key
+
+def _count_rows(search: str, task_id: int) -> int:
+    s = SessionLocal()
+    try:
+        query = s.query(func.count(db.TaskEntry.id)).join(db.ScrapeTask, db.ScrapeTask.id == db.TaskEntry.task_id)
+        return apply_entry_filters(query, search=search, task_id=task_id).scalar()
+    finally:
+        s.close()
+
+def reparse_entries(template_id: int = None, task_id: int = 0, search: str = "", dry_run: bool = False,
+                    batch_size: int = BATCH_SIZE, workers: int = None, diff_limit: int = DIFF_LIMIT,
+                    report: dict = None) -> dict:
+    """
+    用指定解析模板重新解析匹配的 TaskEntry
+    template_id 为空时使用默认规则；workers<=1 时在当前进程内解析
+    返回统计信息，dry_run 时附带前 diff_limit 条差异；传入 report 时就地更新，供后台任务查询进度
+    """
+    rules_key = _load_rules(template_id)
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    report = report if report is not None else {}
+    report.update({"scanned": 0, "changed": 0, "skipped": 0, "updated": 0, "dry_run": dry_run, "diff": []})
+    started = time.perf_counter()
+
+    def _collect(rows_count, result):
+        changes, skipped = result
+        report["scanned"] += rows_count
+        report["skipped"] += skipped
+        report["changed"] += len(changes)
+        if not changes:
+            return
+        if dry_run:
+            for c in changes[:max(0, diff_limit - len(report["diff"]))]:
+                report["diff"].append({
+                    "id": c[0],
+                    "old_answer": _preview(c[4]), "new_answer": _preview(c[1]),
+                    "old_tokens": c[5], "new_tokens": c[2],
+                    "old_status": c[6], "new_status": c[3],
+                })
+        else:
+            _write_changes(changes)
+            report["updated"] += len(changes)
+
+    batches = _iter_batches(search, task_id, batch_size)
+    first = next(batches, [])
+    batches = itertools.chain([first], batches) if first else iter(())
+    # 只有一批数据时启动进程池得不偿失，直接在当前进程解析
+    if workers <= 1 or len(first) < batch_size:
+        for rows in batches:
+            _collect(len(rows), _reparse_rows(*rules_key, rows))
+    else:
+        # 使用 spawn 启动子进程，避免 fork 继承父进程的数据库连接与线程
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            # 控制在途批次数量，读取、解析与写回流水线进行，内存只与批大小有关
+            pending = deque()
+            for rows in batches:
+                pending.append((len(rows), pool.submit(_reparse_rows, *rules_key, rows)))
+                if len(pending) >= workers * 2:
+                    count, future = pending.popleft()
+                    _collect(count, future.result())
+            while pending:
+                count, future = pending.popleft()
+                _collect(count, future.result())
+
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+def start_job(template_id: int = None, task_id: int = 0, search: str = "", dry_run: bool = False) -> dict:
+    """
+    在后台线程中执行重新解析，立即返回任务信息；模板无效时直接抛出 ValueError
+    进度通过 get_job() 查询：state 为 running / done / error，total 为匹配的行数
+    """
+    _load_rules(template_id)
+    job = {"job_id": uuid.uuid4().hex[:12], "state": "running", "total": None, "dry_run": dry_run,
+           "scanned": 0, "changed": 0, "skipped": 0, "updated": 0, "diff": [], "seconds": None}
+    with _jobs_lock:
+        _jobs[job["job_id"]] = job
+        while len(_jobs) > MAX_JOBS:
+            _jobs.popitem(last=False)
+
+    def _run():
+        try:
+            job["total"] = _count_rows(search, task_id)
+            reparse_entries(template_id, task_id=task_id, search=search, dry_run=dry_run,
+                            workers=WEB_WORKERS, report=job)
+            job["state"] = "done"
+        except Exception as e:
+            logger.exception("Reparse job %s failed: %s", job["job_id"], e)
+            job["error"] = str(e)
+            job["state"] = "error"
+
+    # 先取副本再启动线程：小批量任务可能在返回前就已完成
+    started = dict(job)
+    threading.Thread(target=_run, name=f"reparse-{job['job_id']}", daemon=True).start()
+    return started
+
+def get_job(job_id: str):
+    """后台任务的当前进度（副本）；任务不存在或已被淘汰时返回 None"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    return None if job is None else {**job, "diff": list(job["diff"])}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="用解析模板批量重新解析已保存的原始响应")
+    parser.add_argument("--template", type=int, default=None, help="解析模板 ID（缺省为默认 OpenAI 规则）")
+    parser.add_argument("--task", type=int, default=0, help="只处理指定任务")
+    parser.add_argument("--search", default="", help="只处理匹配关键词的记录")
+    parser.add_argument("--dry-run", action="store_true", help="只预览差异，不写回数据库")
+    parser.add_argument("--workers", type=int, default=None, help="解析进程数（默认 CPU 核数）")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每批读取的行数")
+    args = parser.parse_args(argv)
+
+    db.init_db()
+    try:
+        report = reparse_entries(
+            args.template, task_id=args.task, search=args.search, dry_run=args.dry_run,
+            batch_size=args.batch_size, workers=args.workers
+        )
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    for item in report["diff"]:
+        print(f"#{item['id']} [{item['old_status']} → {item['new_status']}] tokens {item['old_tokens']} → {item['new_tokens']}")
+        print(f"  - {item['old_answer']}")
+        print(f"  + {item['new_answer']}")
+    action = "将更新" if args.dry_run else "已更新"
+    print(
+        f"📊 扫描 {report['scanned']} 条，跳过 {report['skipped']} 条，"
+        f"{action} {report['changed'] if args.dry_run else report['updated']} 条，耗时 {report['seconds']}s"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# services/response_cache.py
+"""
+响应缓存
+同一 Prompt + 模型 + 系统指令 + 思考等级的请求在不同任务中经常重复，
+这里以规范化请求内容的 sha256 作为键缓存上游原始响应，命中时不再请求上游。
+
+缓存键不包含易变字段：HMAC 协议的 request_id、请求头里的签名与时间，
+以及系统指令中由 apply_template 展开的时间变量（键使用未展开的指令原文）。
+"""
+import os
+import json
+import hashlib
+import logging
+import datetime
+import threading
+
+from sqlalchemy import func
+
+import database as db
+from database import SessionLocal
+
+# 缓存有效期（小时），0 表示关闭缓存
+TTL_HOURS = float(os.getenv("GEMINI_CACHE_TTL_HOURS", "168"))
+# 最多保留的缓存条数，超出后按最近命中时间淘汰
+MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "20000"))
+# 每写入多少条执行一次淘汰，避免每次写入都统计总数
+EVICT_EVERY = 200
+# 不参与缓存键计算的请求字段
+VOLATILE_FIELDS = ("request_id",)
+
+logger = logging.getLogger(__name__)
+
+_puts_since_evict = 0
+_evict_lock = threading.Lock()
+
+def enabled() -> bool:
+    return TTL_HOURS > 0 and MAX_ENTRIES > 0
+
+def make_key(base_url: str, platform_type: str, payload: dict) -> str:
+    """规范化请求内容（去掉易变字段、按键排序）后计算 sha256"""
+    normalized = {k: v for k, v in payload.items() if k not in VOLATILE_FIELDS}
+    material = json.dumps(
+        {"url": (base_url or "").rstrip("/"), "platform": platform_type, "payload": normalized},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def get(cache_key: str):
+    """返回未过期的原始响应文本，未命中返回 None"""
+    if not enabled():
+        return None
+    now = datetime.datetime.now()
+    s = SessionLocal()
+    try:
+        row = s.query(db.ResponseCache.raw_response).filter(
+            db.ResponseCache.cache_key == cache_key,
+            (db.ResponseCache.expires_at.is_(None)) | (db.ResponseCache.expires_at > now)
+        ).first()
+        if row is None:
+            return None
+        s.query(db.ResponseCache).filter(db.ResponseCache.cache_key == cache_key).update(
+            {"hit_count": db.ResponseCache.hit_count + 1, "last_hit_at": now}, synchronize_session=False
+        )
+        s.commit()
+        return row[0]
+    except Exception as e:
+        s.rollback()
+        logger.warning("⚠️ 读取响应缓存失败: %s", e)
+        return None
+    finally:
+        s.close()
+
+def put(cache_key: str, raw_response: str, tokens_used: int = 0):
+    """写入（或刷新）一条缓存；缓存写入失败不影响抓取结果"""
+    global _puts_since_evict
+    if not enabled():
+        return
+    now = datetime.datetime.now()
+    s = SessionLocal()
+    try:
+        s.merge(db.ResponseCache(
+            cache_key=cache_key, raw_response=raw_response, tokens_used=tokens_used or 0,
+            hit_count=0, created_at=now, last_hit_at=now,
+            expires_at=now + datetime.timedelta(hours=TTL_HOURS)
+        ))
+        s.commit()
+    except Exception as e:
+        s.rollback()
+        logger.warning("⚠️ 写入响应缓存失败: %s", e)
+        return
+    finally:
+        s.close()
+
+    with _evict_lock:
+        _puts_since_evict += 1
+        due = _puts_since_evict >= EVICT_EVERY
+        if due:
+            _puts_since_evict = 0
+    if due:
+        evict()
+
+def evict() -> int:
+    """删除过期条目，并在超出容量时淘汰最久未命中的条目，返回删除的行数"""
+    s = SessionLocal()
+    try:
+        removed = s.query(db.ResponseCache).filter(
+            db.ResponseCache.expires_at <= datetime.datetime.now()
+        ).delete(synchronize_session=False)
+        overflow = s.query(func.count(db.ResponseCache.cache_key)).scalar() - MAX_ENTRIES
+        if overflow > 0:
+            oldest = (
+                s.query(db.ResponseCache.cache_key)
+                .order_by(db.ResponseCache.last_hit_at)
+                .limit(overflow)
+                .scalar_subquery()
+            )
+            removed += s.query(db.ResponseCache).filter(
+                db.ResponseCache.cache_key.in_(oldest)
+            ).delete(synchronize_session=False)
+        s.commit()
+        return removed
+    except Exception as e:
+        s.rollback()
+        logger.warning("⚠️ 清理响应缓存失败: %s", e)
+        return 0
+    finally:
+        s.close()
+
+def clear() -> int:
+    """清空全部缓存"""
+    s = SessionLocal()
+    try:
+        removed = s.query(db.ResponseCache).delete(synchronize_session=False)
+        s.commit()
+        return removed
+    finally:
+        s.close()
+
+def stats(s) -> dict:
+    """缓存条数与累计命中次数"""
+    count, hits = s.query(
+        func.count(db.ResponseCache.cache_key),
+        func.coalesce(func.sum(db.ResponseCache.hit_count), 0)
+    ).one()
+    return {"entries": count, "hits": int(hits)}
@@ -0,0 +1,153 @@
+# services/result_writer.py
+"""
+批量结果写入器
+抓取线程只把 TaskEntry 行放进内存缓冲区，由后台线程按数量或时间阈值
+批量 INSERT，并在同一事务内把对应的 task_queue 条目标记为完成。
+批量写入失败时退回逐行写入，单行出错不影响同批其他结果。
+"""
+import time
+import atexit
+import logging
+import datetime
+import threading
+import weakref
+from collections import Counter
+
+from sqlalchemy import insert
+
+import database as db
+from database import SessionLocal
+from services import job_queue, metrics
+
+logger = logging.getLogger(__name__)
+
+# 所有仍在工作的写入器，进程退出时统一刷盘
+_live_writers = weakref.WeakSet()
+# 进程内所有写入器的累计统计（基准测试据此计算写库耗时）
+_totals = {"rows": 0, "flushes": 0, "seconds": 0.0}
+_totals_lock = threading.Lock()
+
+def totals() -> dict:
+    """进程内所有写入器累计写入的行数、刷盘次数与写库耗时"""
+    with _totals_lock:
+        return dict(_totals)
+
+class ResultWriter:
+    def __init__(self, batch_size: int = 50, flush_interval: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        # 统计信息：写入行数、刷盘次数、累计写库耗时
+        self.rows_written = 0
+        self.flush_count = 0
+        self.write_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, name="result-writer", daemon=True)
+        self._thread.start()
+        _live_writers.add(self)
+
+    def add(self, row: dict, queue_item_id: int = None, success: bool = True, claim_token: str = None):
+        """
+        缓冲一行 TaskEntry（字段字典）；缓冲区满时唤醒后台线程立即写入
+        claim_token: 认领该队列条目时的令牌，写入时条目已不归该令牌所有则丢弃这行结果
+        """
+        row.setdefault("created_at", datetime.datetime.now())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ResultWriter 已关闭")
+            self._buffer.append((row, queue_item_id, success, claim_token))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """把当前缓冲区全部写入数据库"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            started = time.perf_counter()
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.warning("⚠️ 批量写入 %d 条结果失败，改为逐行写入: %s", len(batch), e)
+                for item in batch:
+                    try:
+                        self._write([item])
+                    except Exception as row_error:
+                        logger.error("❌ 结果写入失败 (prompt_index=%s): %s", item[0].get("prompt_index"), row_error)
+                        self._mark_failed(item[1], item[3])
+            elapsed = time.perf_counter() - started
+            self.write_seconds += elapsed
+            self.flush_count += 1
+            with _totals_lock:
+                _totals["rows"] += len(batch)
+                _totals["flushes"] += 1
+                _totals["seconds"] += elapsed
+            metrics.observe_db_write(elapsed, len(batch), Counter(item[0].get("task_id") for item in batch))
+
+    def _write(self, batch):
+        s = SessionLocal()
+        try:
+            # 先按认领令牌完成队列条目，租约已过期（条目被重新排队或由其他执行者认领）的结果不入库，
+            # 避免同一 Prompt 出现两条结果、后完成者覆盖条目状态
+            rows = []
+            for row, qid, ok, token in batch:
+                if qid and not job_queue.finish_item(s, qid, ok, token):
+                    logger.warning("⌛ 队列条目 %s 已不归本次认领所有，丢弃过期结果 (prompt_index=%s)", qid, row.get("prompt_index"))
+                    continue
+                rows.append(row)
+            if rows:
+                s.execute(insert(db.TaskEntry), rows)
+            s.commit()
+            self.rows_written += len(rows)
+        except Exception:
+            s.rollback()
+            raise
+        finally:
+            s.close()
+
+    def _mark_failed(self, queue_item_id, claim_token=None):
+        # 结果无法入库时把队列条目标记为失败，避免其一直停留在 running
+        if not queue_item_id:
+            return
+        s = SessionLocal()
+        try:
+            job_queue.finish_item(s, queue_item_id, False, claim_token)
+            s.commit()
+        except Exception:
+            s.rollback()
+        finally:
+            s.close()
+
+    def close(self):
+        """停止后台线程并写入剩余结果"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        _live_writers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+@atexit.register
+def _flush_all():
+    for writer in list(_live_writers):
+        writer.close()
@@ -1,17 +1,24 @@
 import json
 import datetime
+import logging
 import requests
 import uuid
 import sys
 import os
 import time
+from contextlib import nullcontext
 from enum import Enum
 from database import SessionLocal, TaskEntry
+from services import http_client, job_queue, response_cache, streaming, metrics
+from services.rate_limiter import get_limiter, parse_retry_after
+from services.singleflight import SingleFlight
 
 # 导入工具类
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from auth_utils import get_hmac_auth
-from parser_utils import get_value_by_path
+from auth_utils import get_signer, generate_hmac_headers, dumps_body
+from parser_utils import get_value_by_path, get_extractor, interpret_response, extract_usage
+
+logger = logging.getLogger(__name__)
 
 class GeminiModel(Enum):
     PRO = "gemini-3-pro-preview"
@@ -36,41 +43,88 @@ def apply_template(content: str):
         content = content.replace(placeholder, value)
     return content
 
-def make_api_request(url, headers, payload, max_retries=3, base_timeout=180):
+# 进程内的请求合并器，按响应缓存键合并并发的相同请求
+_inflight = SingleFlight()
+
+# 视为限流信号的状态码：触发并发减半与共享冷却，而不是直接判定失败
+THROTTLE_STATUS = (429, 503)
+
+def estimate_tokens(*texts):
+    """粗略估算输入 Token 数（约 4 字符 / Token），仅用于 TPM 预扣"""
+    return sum(len(t) for t in texts if t) // 4 + 1
+
+def make_api_request(url, headers, payload, max_retries=3, base_timeout=180, pool_size=None,
+                     limiter=None, estimated_tokens=0, stream=False, timing=None):
     """
     执行API请求，带重试和递增超时机制
+    请求经由 http_client 的共享连接池发出，同一网关复用 keep-alive 连接
+    limiter: 该 ApiConfig 的共享限流器；每次尝试前占用名额，429/503 时按 Retry-After 冷却
+    payload: 请求体字典，或 dumps_body 序列化好的字节
+    stream: 以 SSE 流式读取响应；超时时间为整个流的总时长，收到部分回答后超时抛出 StreamInterrupted
+    timing: 可选字典，写入本次请求的统计：attempts、limiter_wait_seconds、bytes_out、bytes_in、
+            http_status，流式请求另有首个文本块耗时 ttft_ms
     """
+    timing = {} if timing is None else timing
     for attempt in range(max_retries):
         try:
             # 递增超时时间
             timeout = base_timeout + (attempt * 60)
-            print(f"🔄 尝试 {attempt + 1}/{max_retries}，超时设置: {timeout}秒")
+            logger.debug("🔄 尝试 %d/%d，超时设置: %d秒", attempt + 1, max_retries, timeout)
+            timing["attempts"] = attempt + 1
             
-            resp = requests.post(
-                url, 
-                headers=headers, 
-                json=payload, 
-                timeout=timeout
-            )
+            slot = limiter.slot(estimated_tokens) if limiter else nullcontext()
+            wait_started = time.monotonic()
+            with slot:
+                started = time.monotonic()
+                timing["limiter_wait_seconds"] = timing.get("limiter_wait_seconds", 0) + started - wait_started
+                resp = http_client.post(
+                    url, 
+                    pool_size=pool_size,
+                    headers=headers, 
+                    # 已序列化的字节原样发送（签名请求体模式要求发送的字节与签名的字节一致）
+                    **({"data": payload} if isinstance(payload, bytes) else {"json": payload}),
+                    timeout=(streaming.CONNECT_TIMEOUT, streaming.IDLE_TIMEOUT) if stream else timeout,
+                    stream=stream
+                )
+                timing["http_status"] = resp.status_code
+                timing["bytes_out"] = timing.get("bytes_out", 0) + len(resp.request.body or b"")
+                if stream and resp.status_code == 200:
+                    # 在名额内读完整个流，并发闸门统计的是真实占用上游的请求数
+                    result = streaming.read_stream(resp, started + timeout, started, timing)
             
             if resp.status_code != 200:
                 error_msg = f"HTTP {resp.status_code}: {resp.text[:500]}"
-                print(f"❌ {error_msg}")
-                if 400 <= resp.status_code < 500:
+                timing["bytes_in"] = timing.get("bytes_in", 0) + len(resp.content)
+                logger.warning("❌ %s", error_msg)
+                throttled = resp.status_code in THROTTLE_STATUS
+                if 400 <= resp.status_code < 500 and not throttled:
                     raise Exception(error_msg)
-                
+
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                wait_time = retry_after if retry_after is not None else 2 ** attempt
+                if throttled and limiter:
+                    # 每次被限流都通知限流器（包括最后一次尝试），同一网关的其他请求也会一起降速、冷却
+                    limiter.on_throttle(wait_time)
                 if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt
-                    print(f"⏳ 等待 {wait_time}秒 后重试...")
-                    time.sleep(wait_time)
+                    if throttled and limiter:
+                        # 冷却由限流器统一执行，下一次尝试占用名额时等待
+                        logger.warning("🚦 网关限流，并发降至 %d，冷却 %s秒 后重试...", limiter.concurrency.limit, wait_time)
+                    else:
+                        logger.info("⏳ 等待 %s秒 后重试...", wait_time)
+                        time.sleep(wait_time)
                     continue
                 else:
                     raise Exception(error_msg)
             
+            if limiter:
+                limiter.on_success()
+            if stream:
+                return result
+            timing["bytes_in"] = timing.get("bytes_in", 0) + len(resp.content)
             return resp.json()
             
         except requests.exceptions.Timeout:
-            print(f"⏱️ 请求超时 (第{attempt + 1}次尝试)")
+            logger.warning("⏱️ 请求超时 (第%d次尝试)", attempt + 1)
             if attempt < max_retries - 1:
                 time.sleep(5)
             else:
@@ -79,11 +133,104 @@ def make_api_request(url, headers, payload, max_retries=3, base_timeout=180):
             raise e
     raise Exception("未知错误：请求未能完成")
 
-def run_single_scrape(task, api_config, prompt, system_instruction):
+def build_headers(task, api_config, body: bytes = None):
     """
-    完整修复版：解决 NameError 并优化 Pro 模型配置
+    按协议类型构造请求头（HMAC 签名与时间相关，由共享签名器在同一秒内复用）
+    body: 序列化后的请求体，签名请求体模式 (api_signed) 对这份字节签名
     """
+    if task.platform_type == "api_hmac":
+        # --- 模式 A: 私有 HMAC 协议 ---
+        return get_signer(api_config.api_key, api_config.api_user).headers()
+    if task.platform_type == "api_signed":
+        # --- 模式 C: 请求体 HMAC-SHA256 签名，请求体格式同标准协议 ---
+        return {
+            **generate_hmac_headers(api_config.api_key, api_config.api_user, body),
+            "Content-Type": "application/json"
+        }
+    # --- 模式 B: 标准协议 ---
+    return {
+        "Authorization": f"Bearer {api_config.api_key}",
+        "Content-Type": "application/json"
+    }
+
+def build_payload(task, prompt, system_content, generation_config, tools=None, stream=False):
+    """按协议类型构造请求体；stream 为 True 时要求上游以 SSE 流式返回"""
+    if task.platform_type == "api_hmac":
+        #full_prompt = f"{system_content}\n\nUser Query: {prompt}"
+        # 注意：由于私有网关过滤 role:system，必须将指令强制拼接入 user.value
+        combined_value = f"SYSTEM_INSTRUCTION:\n{system_content}\n\nUSER_QUERY:\n{prompt}"
+        payload = {
+            "request_id": str(uuid.uuid4()),
+            "model_marker": task.model,
+            "messages": [
+                {"role": "system", "content": [{"type": "text", "value": system_content}]},
+                #{"role": "user", "content": [{"type": "text", "value": prompt}]}
+                {"role": "user", "content": [{"type": "text", "value": combined_value}]}
+            ],
+            "generation_config": generation_config, # HMAC 模式使用下划线
+        }
+    else:
+        payload = {
+            "model": task.model,
+            "messages": [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": prompt}
+            ],
+            "generationConfig": generation_config, # 标准模式使用驼峰
+        }
+    if tools:
+        payload["tools"] = tools
+    if stream:
+        payload["stream"] = True
+        if task.platform_type != "api_hmac":
+            # 让最后一个数据块带上 usage，流式模式下同样能统计 Token
+            payload["stream_options"] = {"include_usage": True}
+    return payload
+
+def _save_entry(row, writer=None, queue_item_id=None, success=True, claim_token=None):
+    """结果入库：有批量写入器时交给写入器缓冲，否则单独开事务写入；条目已不归本次认领所有时丢弃"""
+    if writer is not None:
+        writer.add(row, queue_item_id, success, claim_token)
+        return
     db = SessionLocal()
+    try:
+        if queue_item_id and not job_queue.finish_item(db, queue_item_id, success, claim_token):
+            logger.warning("⌛ 队列条目 %s 已不归本次认领所有，丢弃过期结果", queue_item_id)
+            db.rollback()
+            return
+        db.add(TaskEntry(**row))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def _request_meta(timing, started_at=None, raw_res=None, extractor=None):
+    """
+    TaskEntry 的请求元数据列：起止时间、尝试次数、HTTP 状态码、finish_reason 与 Token 拆分
+    各入库路径都返回相同的键，批量 INSERT 要求每行字段一致
+    """
+    usage = extract_usage(raw_res, extractor) if isinstance(raw_res, dict) else dict.fromkeys(
+        ("finish_reason", "input_tokens", "output_tokens", "reasoning_tokens")
+    )
+    return dict(
+        started_at=started_at,
+        finished_at=datetime.datetime.now(),
+        attempts=timing.get("attempts"),
+        http_status=timing.get("http_status"),
+        **usage
+    )
+
+def run_single_scrape(task, api_config, prompt, system_instruction, prompt_index=None, queue_item_id=None,
+                      writer=None, claim_token=None):
+    """
+    完整修复版：解决 NameError 并优化 Pro 模型配置
+    prompt_index: Prompt 在批次中的序号，并发执行时用于保持结果顺序
+    queue_item_id: 对应的持久化队列条目，结果入库时在同一事务内标记完成
+    writer: 可选的 ResultWriter，批量任务中由它合并写库
+    claim_token: 认领队列条目时的令牌；租约过期、条目已被其他执行者认领时，本次结果不会入库
+    """
 
     # --- 【关键修复 1】：前置定义所有变量，确保任何路径下 print/except 都能访问 ---
     thinking_level = "minimal"
@@ -91,11 +238,17 @@ def run_single_scrape(task, api_config, prompt, system_instruction):
     tokens = 0
     status = "failed"
     system_content = ""
+    # 请求统计：timing 由 make_api_request 写入重试次数、字节数、首字耗时等，request_started 在真正请求上游前记录
+    timing = {}
+    request_started = None
+    started_at = None
+    labels = metrics.label_values(task, api_config)
 
     try:
         # 1. 变量初始化（安全提取）
         thinking_level = getattr(task, 'thinking_level', 'minimal') or 'minimal'
         use_search = getattr(task, 'use_google_search', False)
+        stream = bool(getattr(task, 'stream_mode', False))
         
         # 2. 指令预处理
         if system_instruction:
@@ -117,121 +270,152 @@ def run_single_scrape(task, api_config, prompt, system_instruction):
         # Google Search工具配置
         tools = [{"google_search": {}}] if use_search else None
 
-        # 4. 准备请求头和负载
-        if task.platform_type == "api_hmac":
-            # --- 模式 A: 私有 HMAC 协议 ---
-            auth_header, dt = get_hmac_auth(api_config.api_key, api_config.api_user)
-            headers = {
-                'Authorization': auth_header,
-                'Date': dt,
-                'Source': 'test_api',
-                'Apiversion': 'v2.03',
-                'Content-Type': 'application/json'
-            }
-            #full_prompt = f"{system_content}\n\nUser Query: {prompt}"
-            # 注意：由于私有网关过滤 role:system，必须将指令强制拼接入 user.value
-            combined_value = f"SYSTEM_INSTRUCTION:\n{system_content}\n\nUSER_QUERY:\n{prompt}"
-            payload = {
-                "request_id": str(uuid.uuid4()),
-                "model_marker": task.model,
-                "messages": [
-                    {"role": "system", "content": [{"type": "text", "value": system_content}]},
-                    #{"role": "user", "content": [{"type": "text", "value": prompt}]}
-                    {"role": "user", "content": [{"type": "text", "value": combined_value}]}
-                ],
-                "generation_config": generation_config, # HMAC 模式使用下划线
-            }
-            print(f"📝 请求头: {combined_value}")
-            if tools:
-                payload["tools"] = tools
-        else:
-            # --- 模式 B: 标准协议 ---
-            headers = {
-                "Authorization": f"Bearer {api_config.api_key}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "model": task.model,
-                "messages": [
-                    {"role": "system", "content": system_content},
-                    {"role": "user", "content": prompt}
-                ],
-                "generationConfig": generation_config, # 标准模式使用驼峰
-            }
-            if tools:
-                payload["tools"] = tools
+        # 4. 准备请求负载（请求头在发送前按序列化后的请求体生成）
+        payload = build_payload(task, prompt, system_content, generation_config, tools, stream=stream)
+
+        # 命中响应缓存时直接复用，不再请求上游；缓存键使用未展开时间变量的系统指令
+        # 流式与非流式请求合并后的响应结构相同，缓存键不区分两者
+        cache_key = response_cache.make_key(
+            api_config.base_url, task.platform_type,
+            build_payload(task, prompt, system_instruction or "", generation_config, tools)
+        )
+        raw_text = None if getattr(task, "bypass_cache", False) else response_cache.get(cache_key)
+        if raw_text is not None:
+            parse_started = time.perf_counter()
+            raw_res = json.loads(raw_text)
+            answer, tokens, status = interpret_response(raw_res, get_extractor(task.template))
+            metrics.observe_request(task.id, labels, "cache_hit", parse_seconds=time.perf_counter() - parse_started)
+            entry = dict(
+                task_id=task.id,
+                prompt=prompt,
+                prompt_index=prompt_index,
+                answer=str(answer),
+                raw_response=raw_text,
+                tokens_used=int(tokens),
+                status=status,
+                from_cache=True,
+                ttft_ms=None,
+                latency_ms=None,
+                **_request_meta(timing, raw_res=raw_res, extractor=get_extractor(task.template))
+            )
+            _save_entry(entry, writer, queue_item_id, status == "success", claim_token)
+            logger.info("♻️ 命中响应缓存，跳过请求: %s", prompt[:30])
+            return True
 
         # 5. 执行请求
-        print(f"📤 发送请求到: {api_config.base_url}")
+        logger.debug("📤 发送请求到: %s", api_config.base_url)
         # 【关键修复 2】：这里直接使用前面统一定义的变量，不再访问 task.thinking_level
-        print(f"📝 模型: {task.model}, 思考等级: {thinking_level}, 搜索: {use_search}")
-        print(f"📝 系统指令: {system_content}")
+        logger.debug("📝 模型: %s, 思考等级: %s, 搜索: %s, 流式: %s", task.model, thinking_level, use_search, stream)
+        logger.debug("📝 系统指令: %s", system_content)
         
-        raw_res = make_api_request(
+        limiter = get_limiter(api_config)
+        estimated = estimate_tokens(system_content, prompt)
+        # 请求体只序列化一次，签名与发送（含重试）共用同一份字节
+        body = dumps_body(payload)
+        headers = build_headers(task, api_config, body)
+        # 并发中完全相同的请求只发送一次，其余调用共享结果（各自仍写入自己的 TaskEntry）
+        request_started = time.monotonic()
+        started_at = datetime.datetime.now()
+        raw_res, shared = _inflight.do(
+            cache_key,
+            make_api_request,
             api_config.base_url, 
             headers, 
-            payload,
+            body,
             max_retries=3,
-            base_timeout=180
+            base_timeout=180,
+            pool_size=getattr(api_config, "max_concurrency", None),
+            limiter=limiter,
+            estimated_tokens=estimated,
+            stream=stream,
+            timing=timing
         )
+        latency_ms = int((time.monotonic() - request_started) * 1000)
 
-        # 6. 解析结果
-        mapping_rules = {"answer": "choices.0.message.content", "tokens": "usage.total_tokens"}
-        if task.template and task.template.mapping_rules:
-            try:
-                mapping_rules = json.loads(task.template.mapping_rules)
-            except: pass
-
-        answer = get_value_by_path(raw_res, mapping_rules.get("answer", ""))
-        tokens = get_value_by_path(raw_res, mapping_rules.get("tokens", "")) or 0
-        
-        # 处理空返回逻辑
-        if not answer or str(answer).strip() == "":
-            finish_reason = get_value_by_path(raw_res, "choices.0.finish_reason")
-            error_msg = get_value_by_path(raw_res, "error.message")
-            if error_msg:
-                answer = f"⚠️ API错误: {error_msg}"
-            else:
-                answer = f"⚠️ 无内容。状态: {finish_reason}。建议检查 max_output_tokens 设置。"
-            status = "failed"
+        # 6. 解析结果（解析模板按 id + 规则内容编译缓存，不再逐条 json.loads）
+        parse_started = time.perf_counter()
+        answer, tokens, status = interpret_response(raw_res, get_extractor(task.template))
+        parse_seconds = time.perf_counter() - parse_started
+        if shared:
+            logger.info("🔗 与进行中的相同请求合并，共享上游响应: %s", prompt[:30])
         else:
-            # 检查是否有联网证据
-            grounding = get_value_by_path(raw_res, "choices.0.message.tool_calls")
-            if grounding:
-                answer += "\n\n[注：该回答使用了外部工具查询]"
-            status = "success"
-
-        # 7. 数据入库
-        entry = TaskEntry(
+            limiter.record_tokens(tokens, estimated)
+        # 共享结果的调用没有实际请求上游，不重复计入流量与 Token
+        metrics.observe_request(
+            task.id, labels, "shared" if shared else ("success" if status == "success" else "failed"),
+            stats=None if shared else timing, upstream_seconds=latency_ms / 1000,
+            parse_seconds=parse_seconds, tokens=0 if shared else int(tokens)
+        )
+
+        # 7. 数据入库（只缓存解析成功的响应，由实际发出请求的调用写入）
+        raw_text = json.dumps(raw_res, ensure_ascii=False)
+        if status == "success" and not shared:
+            response_cache.put(cache_key, raw_text, tokens)
+        entry = dict(
             task_id=task.id,
             prompt=prompt,
+            prompt_index=prompt_index,
             answer=str(answer),
-            raw_response=json.dumps(raw_res, ensure_ascii=False),
+            raw_response=raw_text,
             tokens_used=int(tokens),
-            status=status
+            status=status,
+            from_cache=shared,
+            ttft_ms=timing.get("ttft_ms"),
+            latency_ms=latency_ms,
+            **_request_meta(timing, started_at, raw_res, get_extractor(task.template))
+        )
+        _save_entry(entry, writer, queue_item_id, status == "success", claim_token)
+        logger.info(
+            "✅ 抓取成功，Tokens: %s，耗时: %dms%s", tokens, latency_ms,
+            f"，首字: {timing['ttft_ms']}ms" if "ttft_ms" in timing else ""
         )
-        db.add(entry)
-        db.commit()
-        print(f"✅ 抓取成功，Tokens: {tokens}")
         return True
 
+    except streaming.StreamInterrupted as e:
+        # 流式读取中途超时：保存已收到的部分回答，队列条目记为失败以便重跑
+        answer, tokens, _ = interpret_response(e.partial, get_extractor(task.template))
+        logger.warning("✂️ 流式响应中断，保存部分回答（%d 字）: %s", len(str(answer)), e)
+        metrics.observe_request(
+            task.id, labels, "partial", stats=timing,
+            upstream_seconds=time.monotonic() - request_started, tokens=int(tokens)
+        )
+        entry = dict(
+            task_id=task.id,
+            prompt=prompt,
+            prompt_index=prompt_index,
+            answer=str(answer),
+            raw_response=json.dumps(e.partial, ensure_ascii=False),
+            tokens_used=int(tokens),
+            status="partial",
+            from_cache=False,
+            ttft_ms=timing.get("ttft_ms"),
+            latency_ms=int((time.monotonic() - request_started) * 1000),
+            **_request_meta(timing, started_at, e.partial, get_extractor(task.template))
+        )
+        _save_entry(entry, writer, queue_item_id, False, claim_token)
+        return False
+
     except Exception as e:
-        if db: db.rollback()
         error_detail = str(e)
-        print(f"❌ 抓取失败: {error_detail}")
+        logger.error("❌ 抓取失败: %s", error_detail)
+        metrics.observe_request(
+            task.id, labels, "failed", stats=timing,
+            upstream_seconds=time.monotonic() - request_started if request_started else None
+        )
         
         # 记录失败信息（此时变量已安全定义）
-        entry = TaskEntry(
+        entry = dict(
             task_id=task.id,
             prompt=prompt,
+            prompt_index=prompt_index,
             answer=f"抓取异常: {error_detail}",
             raw_response=json.dumps({"error": error_detail, "last_level": thinking_level}, ensure_ascii=False),
             status="failed",
-            tokens_used=0
+            tokens_used=0,
+            from_cache=False,
+            ttft_ms=None,
+            latency_ms=int((time.monotonic() - request_started) * 1000) if request_started else None,
+            **_request_meta(timing, started_at)
         )
-        if db:
-            db.add(entry)
-            db.commit()
-        return False
-    finally:
-        if db: db.close()
\ No newline at end of file
+        _save_entry(entry, writer, queue_item_id, False, claim_token)
+        return False
\ No newline at end of file
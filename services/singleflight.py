@@ -0,0 +1,60 @@
+# services/singleflight.py
+"""
+进程内请求合并 (single-flight)
+多个任务同时发起完全相同的请求（缓存键相同）时，只有第一个调用真正请求上游，
+其余调用等待并共享同一个结果或异常；调用结束后立即移除，不做缓存。
+"""
+import threading
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # 被合并（未实际发出）的调用次数
+        self.shared_count = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        执行 fn(*args, **kwargs)，相同 key 的并发调用只执行一次
+        返回 (结果, shared)；shared 为 True 表示结果来自其他调用
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared_count += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,136 @@
+# services/streaming.py
+"""
+流式 (SSE) 响应读取
+上游以 text/event-stream 逐块返回增量结果（每行 `data: {...}`，以 `data: [DONE]` 结束），
+这里边读边把增量块合并成与非流式响应相同结构的 JSON，已有的解析模板无需修改即可使用：
+
+    {"choices": [{"delta": {"content": "你"}}]}
+    {"choices": [{"delta": {"content": "好"}, "finish_reason": "stop"}], "usage": {...}}
+    => {"choices": [{"message": {"content": "你好"}, "finish_reason": "stop"}], "usage": {...}}
+
+标准协议与 HMAC 协议的增量块结构相同，HMAC 的 content 为 [{"type": "text", "value": ...}] 列表，同样按位置合并。
+"""
+import os
+import json
+import time
+
+import requests
+
+# 两个数据块之间允许的最长空闲时间（秒），超过视为读取超时
+IDLE_TIMEOUT = float(os.getenv("GEMINI_STREAM_IDLE_TIMEOUT", "120"))
+# 建立连接的超时时间（秒）
+CONNECT_TIMEOUT = 15
+# 增量块中需要拼接（而不是覆盖）的文本字段
+TEXT_FIELDS = ("content", "value", "text", "reasoning_content")
+
+class StreamInterrupted(Exception):
+    """流在中途中断（超时或断开），partial 为已收到部分合并出的响应"""
+
+    def __init__(self, message, partial):
+        super().__init__(message)
+        self.partial = partial
+
+def _merge(acc, chunk, in_delta=False):
+    """把一个增量块合并进累积结果：delta 内的文本字段拼接，列表按 index（或位置）合并，其余字段以最新值为准"""
+    if isinstance(chunk, dict) and isinstance(acc, dict):
+        for key, value in chunk.items():
+            if key in acc:
+                if in_delta and key in TEXT_FIELDS and isinstance(value, str) and isinstance(acc[key], str):
+                    acc[key] += value
+                else:
+                    acc[key] = _merge(acc[key], value, in_delta or key == "delta")
+            else:
+                acc[key] = value
+        return acc
+    if isinstance(chunk, list) and isinstance(acc, list):
+        for position, item in enumerate(chunk):
+            slot = item.get("index", position) if isinstance(item, dict) else position
+            if isinstance(slot, int) and slot < len(acc):
+                acc[slot] = _merge(acc[slot], item, in_delta)
+            else:
+                acc.append(item)
+        return acc
+    return chunk if chunk is not None else acc
+
+def _finalize(value):
+    """把累积结果中的 delta 改名为 message，得到与非流式响应一致的结构"""
+    if isinstance(value, dict):
+        return {("message" if k == "delta" else k): _finalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_finalize(v) for v in value]
+    return value
+
+def _has_text(value) -> bool:
+    if isinstance(value, dict):
+        return any(
+            (k in TEXT_FIELDS and isinstance(v, str) and v) or _has_text(v)
+            for k, v in value.items() if k != "role"
+        )
+    if isinstance(value, list):
+        return any(_has_text(v) for v in value)
+    return False
+
+def _iter_events(resp, timing: dict = None):
+    """按行解析 SSE，产出每个事件的 (event, data)；注释行与心跳被忽略"""
+    buffer = b""
+    event, data = None, []
+    # chunk_size=None：分块传输时每收到一个块立即返回，不等缓冲区填满
+    for chunk in resp.iter_content(chunk_size=None):
+        if timing is not None:
+            timing["bytes_in"] = timing.get("bytes_in", 0) + len(chunk)
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line = line.rstrip(b"\r").decode("utf-8")
+            if not line:
+                if data:
+                    yield event, "\n".join(data)
+                event, data = None, []
+            elif line.startswith(":"):
+                continue
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].lstrip())
+    if data:
+        yield event, "\n".join(data)
+
+def read_stream(resp, deadline: float, started: float, timing: dict = None):
+    """
+    读取 SSE 响应并返回合并后的 JSON
+    deadline: time.monotonic() 截止时间，超过后中断读取
+    timing: 可选字典，写入首个文本块的耗时 ttft_ms（从 started 开始计）与收到的字节数 bytes_in
+    收到部分文本后超时或断开时抛出 StreamInterrupted；尚未收到任何文本时抛出 Timeout，由调用方重试
+    """
+    if "application/json" in resp.headers.get("Content-Type", ""):
+        # 网关不支持流式时会直接返回完整 JSON
+        try:
+            if timing is not None:
+                timing["bytes_in"] = timing.get("bytes_in", 0) + len(resp.content)
+            return resp.json()
+        finally:
+            resp.close()
+    acc, chunks = {}, 0
+    try:
+        for event, data in _iter_events(resp, timing):
+            if data == "[DONE]":
+                break
+            message = json.loads(data)
+            error = message.get("error") if isinstance(message, dict) else None
+            if event == "error" or error:
+                raise Exception(f"流式响应返回错误: {json.dumps(error or message, ensure_ascii=False)[:500]}")
+            _merge(acc, message)
+            chunks += 1
+            if timing is not None and "ttft_ms" not in timing and _has_text(message):
+                timing["ttft_ms"] = int((time.monotonic() - started) * 1000)
+            if time.monotonic() > deadline:
+                raise requests.exceptions.Timeout("流式读取超过总超时时间")
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        if _has_text(acc):
+            partial = _finalize(acc)
+            partial["stream_interrupted"] = {"reason": str(e)[:200], "chunks": chunks}
+            raise StreamInterrupted(f"流式响应中断，已收到 {chunks} 个数据块: {e}", partial) from e
+        raise requests.exceptions.Timeout(str(e)) from e
+    finally:
+        resp.close()
+    return _finalize(acc)
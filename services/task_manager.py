@@ -9,7 +9,10 @@ import hmac
 import hashlib
 import base64
 import datetime
+import socket
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import Session
 import database as db
 from database import SessionLocal
@@ -24,23 +27,53 @@ from parser_utils import extract_standard_data # 完美利用你的新文件
 # 在 task_manager.py 顶部添加
 from auth_utils import get_hmac_auth
 from services.scraper import run_single_scrape
+from services.rate_limiter import resolve_concurrency
+from services import job_queue, metrics
+from services.result_writer import ResultWriter
 
-def start_batch_task(task_id: int, api_id: int, prompts: list, system_instruction: str, thinking: str = "minimal"):
+logger = logging.getLogger(__name__)
+
+# 进程级退出标记：置位后各工作线程不再认领新条目
+_shutdown = threading.Event()
+# 本进程内正在执行的任务 {task_id: 执行线程数}，租约巡检据此只为没有执行线程的任务重新拉起
+_active_tasks = {}
+_active_lock = threading.Lock()
+_sweeper_started = False
+
+def request_shutdown():
+    """通知本进程内所有批量任务停止认领新 Prompt，在途请求会正常完成"""
+    _shutdown.set()
+
+def start_batch_task(task_id: int, api_id: int = None, prompts: list = None, system_instruction: str = None, thinking: str = "minimal"):
     """
     后台批量处理逻辑 - 完整修复版
     1. 增加了 thinking 参数接收，防止参数个数不匹配崩溃
     2. 增强了 task 对象的健壮性
+    3. 按 ApiConfig.max_concurrency 并发执行，返回值按 prompt_index 排序
+    4. 从持久化队列 task_queue 认领 Prompt，可在进程重启或暂停后继续执行；
+       prompts 仅用于兼容旧调用方式，任务尚无队列条目时才会写入队列
     """
     s = SessionLocal()
     task = None  # 提前声明，防止 finally 块报错
-    
+    with _active_lock:
+        _active_tasks[task_id] = _active_tasks.get(task_id, 0) + 1
+
     try:
         # 1. 获取任务
         task = s.query(db.ScrapeTask).filter(db.ScrapeTask.id == task_id).first()
         if not task:
-            print(f"❌ 错误：找不到任务 ID {task_id}")
+            logger.error("❌ 错误：找不到任务 ID %s", task_id)
+            return
+        if task.status not in job_queue.ACTIVE_TASK_STATUSES:
+            logger.info("⏸️ 任务 %s 当前状态为 %s，跳过执行", task_id, task.status)
             return
 
+        has_queue = s.query(db.QueueItem.id).filter(db.QueueItem.task_id == task.id).first() is not None
+        if prompts and not has_queue:
+            job_queue.enqueue_prompts(s, task.id, prompts)
+        if system_instruction is None:
+            system_instruction = task.system_instruction or ""
+
         # 2. 补全 task 对象的 thinking_level (以防万一)
         # 如果数据库里的值为 None，将传进来的 thinking 值补给它
         if not task.thinking_level:
@@ -51,7 +84,7 @@ def start_batch_task(task_id: int, api_id: int, prompts: list, system_instructio
         template = task.template
 
         if not config:
-            print(f"❌ 错误：任务 {task_id} 未关联有效的 API 配置")
+            logger.error("❌ 错误：任务 %s 未关联有效的 API 配置", task_id)
             task.status = "failed"
             s.commit()
             return
@@ -62,24 +95,94 @@ def start_batch_task(task_id: int, api_id: int, prompts: list, system_instructio
         task.use_google_search = True 
         s.commit()
 
-        # 5. 循环执行抓取
-        for p_text in prompts:
-            # 调用 scraper.py 里的函数
-            # 注意：这里的 task 对象在当前 Session(s) 中是活的
-            success = run_single_scrape(
-                task=task, 
-                api_config=config, 
-                prompt=p_text, 
-                system_instruction=system_instruction
+        # 5. 并发执行抓取
+        # commit 之后 ORM 属性会过期，先在主线程内重新加载，
+        # 避免多个工作线程同时触发同一个 Session 的懒加载
+        s.refresh(task)
+        _ = (task.model, task.platform_type, task.thinking_level, task.template, config.base_url)
+        if template is not None:
+            _ = template.mapping_rules
+
+        results = {}
+        labels = metrics.label_values(task, config)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:task{task_id}"
+        # 执行中的条目 {id: 认领令牌}，由续约线程定期刷新租约，
+        # 单个条目的重试、Retry-After 冷却与限流等待再长也不会被当作失联而重新排队
+        held, held_lock = {}, threading.Lock()
+        stop_renewal = threading.Event()
+
+        def _renew_leases():
+            while not stop_renewal.wait(job_queue.LEASE_SECONDS / 3):
+                with held_lock:
+                    claims = dict(held)
+                try:
+                    job_queue.renew_leases(claims)
+                except Exception as e:
+                    logger.warning("⚠️ 续约队列条目失败: %s", e)
+
+        def _worker():
+            # 每个工作线程循环认领条目，任务被暂停/取消或队列耗尽时退出
+            while not _shutdown.is_set():
+                items = job_queue.claim_items(task_id, worker_id, limit=1)
+                if not items:
+                    return
+                item = items[0]
+                if item.claimed_at and item.created_at:
+                    metrics.observe_queue_wait(task_id, labels, (item.claimed_at - item.created_at).total_seconds())
+                with held_lock:
+                    held[item.id] = item.worker_id
+                try:
+                    success = run_single_scrape(
+                        task=task, 
+                        api_config=config, 
+                        prompt=item.prompt, 
+                        system_instruction=system_instruction,
+                        prompt_index=item.prompt_index,
+                        queue_item_id=item.id,
+                        writer=writer,
+                        claim_token=item.worker_id
+                    )
+                except Exception:
+                    job_queue.release_item(item.id, item.worker_id)
+                    raise
+                finally:
+                    with held_lock:
+                        held.pop(item.id, None)
+                results[item.prompt_index] = success
+                logger.debug("📊 Prompt #%s: %s... | 执行结果: %s", item.prompt_index, item.prompt[:20], "✅ 成功" if success else "❌ 失败")
+
+        concurrency = resolve_concurrency(config)
+        logger.info("🚀 任务 %s 开始执行：剩余 %s 条 Prompt，并发数 %s", task_id, job_queue.remaining_count(s, task_id), concurrency)
+        # 结果统一交给批量写入器，按条数/时间阈值合并提交；退出前确保全部刷盘
+        renewal = threading.Thread(target=_renew_leases, name=f"lease-task{task_id}", daemon=True)
+        renewal.start()
+        try:
+            with ResultWriter(batch_size=max(concurrency * 2, 20)) as writer:
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"task{task_id}") as pool:
+                    futures = [pool.submit(_worker) for _ in range(concurrency)]
+                    for f in futures:
+                        f.result()
+        finally:
+            stop_renewal.set()
+        breakdown = metrics.task_breakdown(task_id)
+        if breakdown:
+            logger.info(
+                "⏱️ 任务 %s 耗时明细：请求 %d 次（缓存 %d，合并 %d，失败 %d，重试 %d），排队 %.1fs，限流等待 %.1fs，"
+                "上游 %.1fs，解析 %.3fs，写库 %.3fs，Token %d",
+                task_id, breakdown["requests"], breakdown["cache_hits"], breakdown["shared"], breakdown["failed"],
+                breakdown["retries"], breakdown["queue_wait_seconds"], breakdown["limiter_wait_seconds"],
+                breakdown["upstream_seconds"], breakdown["parse_seconds"], breakdown["db_write_seconds"], breakdown["tokens"]
             )
-            print(f"📊 Prompt: {p_text[:20]}... | 执行结果: {'✅ 成功' if success else '❌ 失败'}")
 
-        # 6. 任务正常结束
-        task.status = "completed"
-        s.commit()
+        # 6. 队列全部结束才算完成；暂停/取消时保留对应状态
+        s.refresh(task)
+        if task.status == "running" and job_queue.remaining_count(s, task_id) == 0:
+            task.status = "completed"
+            s.commit()
+        return [results[i] for i in sorted(results)]
 
     except Exception as e:
-        print(f"🚨 任务主循环崩溃: {str(e)}")
+        logger.exception("🚨 任务主循环崩溃: %s", e)
         if s and task:
             try:
                 task.status = "failed"
@@ -87,5 +190,56 @@ def start_batch_task(task_id: int, api_id: int, prompts: list, system_instructio
             except:
                 pass
     finally:
+        with _active_lock:
+            _active_tasks[task_id] -= 1
+            if not _active_tasks[task_id]:
+                del _active_tasks[task_id]
         if s:
-            s.close()
\ No newline at end of file
+            s.close()
+
+def _resume_idle_tasks(requeue_all: bool = False):
+    """
+    回收条目并为仍有待处理条目、但本进程内没有执行线程的任务拉起执行线程
+    默认只回收租约过期的 running 条目：独立 Worker 正在执行的条目会持续续约，不会被抢走
+    """
+    s = SessionLocal()
+    try:
+        if requeue_all:
+            requeued = job_queue.requeue_orphaned(s)
+        else:
+            requeued = job_queue.requeue_stale(s, job_queue.LEASE_SECONDS)
+        s.commit()
+        task_ids = job_queue.resumable_task_ids(s)
+    finally:
+        s.close()
+    if requeued:
+        logger.info("♻️ 已重新排队 %d 条中断的 Prompt", requeued)
+    with _active_lock:
+        task_ids = [t for t in task_ids if t not in _active_tasks]
+    for task_id in task_ids:
+        logger.info("♻️ 恢复未完成任务 %s", task_id)
+        threading.Thread(target=start_batch_task, args=(task_id,), daemon=True, name=f"resume-task{task_id}").start()
+    return task_ids
+
+def _sweep_stale_leases():
+    # 上次进程崩溃时遗留的条目要等租约过期才能回收，因此需要周期性巡检
+    while not _shutdown.wait(job_queue.LEASE_SECONDS / 3):
+        try:
+            _resume_idle_tasks()
+        except Exception as e:
+            logger.warning("⚠️ 巡检队列租约失败: %s", e)
+
+def resume_pending_tasks(requeue_all: bool = False):
+    """
+    Web 进程内执行抓取时在启动阶段调用：回收租约过期的条目，为未完成的任务重新拉起执行线程，
+    并启动后台巡检，之后过期的租约（包括上次进程崩溃遗留的条目）也会被回收
+    requeue_all: 立即回收所有 running 条目，不等租约过期；只适用于确认没有其他进程
+                 （独立 Worker）在执行的单进程部署，否则会抢走正在执行的条目、重复请求上游
+    """
+    global _sweeper_started
+    task_ids = _resume_idle_tasks(requeue_all)
+    with _active_lock:
+        start_sweeper, _sweeper_started = not _sweeper_started, True
+    if start_sweeper:
+        threading.Thread(target=_sweep_stale_leases, daemon=True, name="lease-sweeper").start()
+    return task_ids
@@ -0,0 +1,126 @@
+# services/worker.py
+"""
+独立抓取 Worker 进程
+Web 进程只负责写入 task_queue 和展示结果，实际请求由本模块执行：
+
+    python -m services.worker                 # 单进程
+    python -m services.worker --processes 4   # 本机启动 4 个 Worker 进程
+    python -m services.worker --processes 4 --metrics-port 9100   # 各进程依次在 9100~9103 暴露 /metrics
+
+多个 Worker（可分布在不同机器上，只要指向同一个数据库）通过原子认领
+task_queue 条目来分担任务；某个 Worker 崩溃后，其占用的条目超过租约时间
+会被其他 Worker 重新排队。
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+import log_utils
+from database import SessionLocal
+from services import job_queue
+from services import task_manager
+from services import metrics
+
+# 条目超过租约时间未续约，视为 Worker 已失联并重新排队（执行中的条目会定期续约）
+LEASE_SECONDS = job_queue.LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+def run_worker(poll_interval: float = 2.0, max_tasks: int = 4, metrics_port: int = 0):
+    """
+    Worker 主循环：定期回收过期条目，并为每个有待处理条目的任务启动一个执行线程
+    max_tasks: 单个进程同时执行的任务数上限
+    metrics_port: 大于 0 时在该端口暴露本进程的 Prometheus /metrics
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+
+    def _handle_signal(signum, frame):
+        logger.info("🛑 Worker %s 收到退出信号，等待在途请求完成...", worker_id)
+        stop.set()
+        task_manager.request_shutdown()
+
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+    # spawn 出的子进程不继承父进程的日志配置，每个进程各自初始化
+    log_utils.setup_logging()
+    db.init_db()
+    if metrics_port:
+        metrics.serve(metrics_port)
+    running = {}
+    logger.info("👷 Worker %s 已启动，轮询间隔 %s秒", worker_id, poll_interval)
+    while not stop.is_set():
+        s = SessionLocal()
+        try:
+            requeued = job_queue.requeue_stale(s, LEASE_SECONDS)
+            s.commit()
+            if requeued:
+                logger.info("♻️ 回收 %d 条租约过期的 Prompt", requeued)
+            task_ids = job_queue.resumable_task_ids(s)
+        except Exception as e:
+            s.rollback()
+            logger.warning("⚠️ 轮询队列失败: %s", e)
+            task_ids = []
+        finally:
+            s.close()
+
+        for task_id, thread in list(running.items()):
+            if not thread.is_alive():
+                del running[task_id]
+        for task_id in task_ids:
+            if task_id in running or len(running) >= max_tasks:
+                continue
+            thread = threading.Thread(
+                target=task_manager.start_batch_task, args=(task_id,), name=f"worker-task{task_id}"
+            )
+            thread.start()
+            running[task_id] = thread
+
+        stop.wait(poll_interval)
+
+    for thread in running.values():
+        thread.join()
+    logger.info("👋 Worker %s 已退出", worker_id)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gemini 批量抓取 Worker")
+    parser.add_argument("--processes", type=int, default=1, help="本机启动的 Worker 进程数")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="队列轮询间隔（秒）")
+    parser.add_argument("--max-tasks", type=int, default=4, help="单进程同时执行的任务数")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("GEMINI_WORKER_METRICS_PORT", "0")),
+                        help="暴露 /metrics 的端口，多进程时依次 +1；0 表示不暴露")
+    args = parser.parse_args(argv)
+
+    if args.processes <= 1:
+        run_worker(args.poll_interval, args.max_tasks, args.metrics_port)
+        return
+
+    # 使用 spawn 启动子进程，避免 fork 继承父进程的数据库连接
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(
+            target=run_worker, name=f"worker-{i}",
+            args=(args.poll_interval, args.max_tasks, args.metrics_port + i if args.metrics_port else 0),
+        )
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    # 子进程各自处理信号，父进程忽略，等待全部退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in procs])
+    for p in procs:
+        p.join()
+
+if __name__ == "__main__":
+    main()
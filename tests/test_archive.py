@@ -0,0 +1,65 @@
+import os
+import datetime
+
+import pytest
+
+import database as db
+from services import archive
+
+pytestmark = pytest.mark.skipif(not archive.available(), reason="需要 pyarrow")
+
+def test_archive_old_tasks_moves_every_task(tmp_path, monkeypatch, session, make_task):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    old = datetime.datetime.now() - datetime.timedelta(days=200)
+    task_ids = [make_task(name=f"old-{i}", status="completed", entries=3, created_at=old) for i in range(3)]
+    recent_id = make_task(name="recent", status="completed", entries=2)
+
+    report = archive.archive_old_tasks(90)
+
+    assert set(task_ids) <= set(report["task_ids"])
+    assert report["tasks"] == len(report["task_ids"])
+    assert recent_id not in report["task_ids"]
+    remaining = session.query(db.TaskEntry.task_id).filter(db.TaskEntry.task_id.in_(task_ids + [recent_id])).all()
+    assert {r[0] for r in remaining} == {recent_id}
+    archived = {t.id: t for t in session.query(db.ArchivedTask).filter(db.ArchivedTask.id.in_(task_ids))}
+    assert set(archived) == set(task_ids)
+    assert all(t.entry_count == 3 for t in archived.values())
+
+    rows = archive.query_entries(task_id=task_ids[1])
+    assert [r["prompt_index"] for r in rows] == [0, 1, 2]
+    assert rows[0]["task_name"] == "old-1"
+
+def test_archive_keeps_request_metadata(tmp_path, monkeypatch, session, make_task):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    started = datetime.datetime(2025, 1, 2, 3, 4, 5)
+    task_id = make_task(name="meta", status="completed", created_at=started)
+    metadata = {
+        "ttft_ms": 120, "latency_ms": 900, "started_at": started, "finished_at": started + datetime.timedelta(seconds=1),
+        "attempts": 2, "http_status": 200, "finish_reason": "length",
+        "input_tokens": 11, "output_tokens": 22, "reasoning_tokens": 5,
+    }
+    session.add(db.TaskEntry(task_id=task_id, prompt="p", prompt_index=0, answer="a", tokens_used=38,
+                             status="success", **metadata))
+    session.commit()
+
+    archive.archive_task(task_id)
+
+    (row,) = archive.query_entries(task_id=task_id)
+    assert {k: row[k] for k in metadata} == metadata
+
+def test_old_archive_files_read_without_metadata(tmp_path, monkeypatch, session, make_task):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+    task_id = make_task(name="new", status="completed", entries=1, created_at=datetime.datetime(2025, 1, 1))
+    archive.archive_task(task_id)
+    # 模拟加入请求元数据之前写入的归档文件
+    legacy = pa.table({"id": [10 ** 9], "task_id": [10 ** 9], "task_name": ["legacy"], "prompt_index": [0],
+                       "prompt": ["p"], "answer": ["a"], "raw_response": [None], "tokens_used": [1],
+                       "status": ["success"], "from_cache": [False], "created_at": [datetime.datetime(2024, 1, 1)]})
+    os.makedirs(tmp_path / "year=2024" / "month=01")
+    pq.write_table(legacy, tmp_path / "year=2024" / "month=01" / "task_legacy.parquet")
+
+    rows = {r["task_id"]: r for r in archive.query_entries(limit=10)}
+    assert rows[10 ** 9]["latency_ms"] is None and rows[10 ** 9]["answer_preview"] == "a"
+    assert rows[task_id]["task_name"] == "new"
@@ -0,0 +1,32 @@
+import auth_utils
+from auth_utils import dumps_body, generate_hmac_headers, get_signer
+from benchmarks import mock_gateway
+
+PAYLOAD = {"model": "gemini-3-flash", "messages": [{"role": "user", "content": "你好，世界"}]}
+
+def test_signed_body_passes_gateway_check():
+    body = dumps_body(PAYLOAD)
+    headers = generate_hmac_headers(mock_gateway.HMAC_SECRET, mock_gateway.HMAC_USER, body)
+    assert mock_gateway._check_signed_body(headers, body)
+    # 传入字典时按 dumps_body 得到的同一份字节签名
+    assert mock_gateway._check_signed_body(generate_hmac_headers(mock_gateway.HMAC_SECRET, mock_gateway.HMAC_USER, PAYLOAD), body)
+
+def test_signed_body_rejects_other_bytes_or_key():
+    body = dumps_body(PAYLOAD)
+    headers = generate_hmac_headers(mock_gateway.HMAC_SECRET, mock_gateway.HMAC_USER, body)
+    assert not mock_gateway._check_signed_body(headers, body + b" ")
+    wrong = generate_hmac_headers("wrong-secret", mock_gateway.HMAC_USER, body)
+    assert not mock_gateway._check_signed_body(wrong, body)
+
+def test_signer_headers_pass_gateway_check():
+    headers = get_signer(mock_gateway.HMAC_SECRET, mock_gateway.HMAC_USER).headers()
+    assert mock_gateway._check_hmac(headers)
+
+def test_signer_cache_is_bounded_lru(monkeypatch):
+    monkeypatch.setattr(auth_utils, "MAX_SIGNERS", 2)
+    monkeypatch.setattr(auth_utils, "_signers", type(auth_utils._signers)())
+    first = get_signer("k1", "u")
+    get_signer("k2", "u")
+    assert get_signer("k1", "u") is first  # 命中后成为最近使用
+    get_signer("k3", "u")
+    assert list(auth_utils._signers) == [("u", "k1"), ("u", "k3")]
@@ -0,0 +1,115 @@
+import datetime
+
+import pytest
+
+import database as db
+import migrate_tool
+
+@pytest.fixture
+def backup_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(migrate_tool, "BACKUP_DIR", str(tmp_path))
+    monkeypatch.setattr(migrate_tool, "BACKUP_STATE_PATH", str(tmp_path / "backup_state.json"))
+    return tmp_path
+
+def _entries(session):
+    session.expire_all()
+    return {e.id: (e.task_id, e.answer, e.status) for e in session.query(db.TaskEntry)}
+
+def _backup_ids(path, table_name):
+    return [values[0] for table, _, values in migrate_tool._iter_backup(path) if table.name == table_name]
+
+def test_incremental_chain_round_trip(backup_dir, session, make_task):
+    task_id = make_task(name="backup", entries=2)
+    full = migrate_tool.export_data()
+    assert full.endswith(".full.ndjson.gz")
+
+    # 新增一行，并像重新解析那样原地修改一行旧结果
+    session.add(db.TaskEntry(task_id=task_id, prompt="new", prompt_index=2, answer="new answer", status="success"))
+    edited = session.query(db.TaskEntry).filter(db.TaskEntry.task_id == task_id, db.TaskEntry.prompt_index == 0).one()
+    edited.answer = "reparsed"
+    session.commit()
+    incremental = migrate_tool.export_data(incremental=True)
+    assert incremental.endswith(".incremental.ndjson.gz")
+    assert edited.id in _backup_ids(incremental, "task_entries")
+    assert len(_backup_ids(incremental, "task_entries")) == 2
+
+    expected = _entries(session)
+    session.query(db.TaskEntry).delete()
+    session.commit()
+    migrate_tool.restore_chain()
+    assert _entries(session) == expected
+    assert expected[edited.id][1] == "reparsed"
+
+def test_deletion_forces_full_backup(backup_dir, session, make_task):
+    task_id = make_task(name="deleted", entries=2)
+    migrate_tool.export_data()
+    unchanged = migrate_tool.export_data(incremental=True)
+    assert unchanged.endswith(".incremental.ndjson.gz")
+    assert _backup_ids(unchanged, "task_entries") == []
+
+    session.query(db.TaskEntry).filter(db.TaskEntry.task_id == task_id, db.TaskEntry.prompt_index == 0).delete()
+    session.commit()
+    path = migrate_tool.export_data(incremental=True)
+    assert path.endswith(".full.ndjson.gz")
+    assert migrate_tool._load_state()["chain"] == [path]
+
+def test_updated_at_is_set_on_write(session, make_task):
+    task_id = make_task(entries=1)
+    entry = session.query(db.TaskEntry).filter(db.TaskEntry.task_id == task_id).one()
+    assert entry.updated_at is not None
+    before = entry.updated_at
+    entry.answer = "changed"
+    session.commit()
+    assert entry.updated_at >= before and entry.updated_at > datetime.datetime.now() - datetime.timedelta(minutes=1)
+
+def test_queue_transitions_reach_incremental_backup(backup_dir, session, make_task):
+    from services import job_queue
+    task_id = make_task(status="running")
+    job_queue.enqueue_prompts(session, task_id, ["a"])
+    session.commit()
+    item = job_queue.claim_items(task_id, "w1")[0]
+    migrate_tool.export_data()
+
+    # 重新排队会清空 claimed_at，仍然必须出现在增量中
+    job_queue.release_item(item.id, item.worker_id)
+    path = migrate_tool.export_data(incremental=True)
+    assert path.endswith(".incremental.ndjson.gz")
+    assert item.id in _backup_ids(path, "task_queue")
+
+    session.query(db.QueueItem).filter(db.QueueItem.id == item.id).update({"status": "running"})
+    session.commit()
+    assert migrate_tool.restore_chain()
+    session.expire_all()
+    assert session.get(db.QueueItem, item.id).status == "pending"
+
+def test_failed_export_keeps_backup_state(backup_dir, session, make_task, monkeypatch):
+    make_task(entries=1)
+    first = migrate_tool.export_data()
+    state = migrate_tool._load_state()
+
+    def _broken(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(migrate_tool, "_export_table", _broken)
+    assert migrate_tool.export_data(incremental=True) is None
+    assert migrate_tool._load_state() == state
+    assert not [p for p in backup_dir.iterdir() if p.name.endswith(".tmp")]
+    assert state["chain"] == [first]
+
+def test_restore_chain_stops_at_first_failure(backup_dir, session, make_task, monkeypatch):
+    make_task(entries=1)
+    migrate_tool.export_data()
+    migrate_tool.export_data(incremental=True)
+    migrate_tool.export_data(incremental=True)
+    imported = []
+
+    def _import(path):
+        imported.append(path)
+        return len(imported) < 2
+    monkeypatch.setattr(migrate_tool, "import_data", _import)
+    assert migrate_tool.restore_chain() is False
+    chain = migrate_tool._load_state()["chain"]
+    assert len(set(chain)) == 3
+    assert imported == chain[:2]
+    with pytest.raises(SystemExit) as exc:
+        migrate_tool.main(["import", "--chain"])
+    assert exc.value.code == 1
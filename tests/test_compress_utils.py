@@ -0,0 +1,65 @@
+import json
+
+import pytest
+from sqlalchemy import text
+
+import compress_utils
+import database as db
+from compress_utils import compress_text, decompress_text, MAGIC
+
+LONG = json.dumps({"choices": [{"message": {"content": "你好，世界 " * 200}}], "usage": {"total_tokens": 42}},
+                  ensure_ascii=False)
+
+def test_short_text_is_stored_raw():
+    value = compress_text("short")
+    assert value == MAGIC + compress_utils.RAW + b"short"
+    assert decompress_text(value) == "short"
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd", "none"])
+def test_round_trip_for_each_codec(monkeypatch, codec):
+    if codec == "zstd" and compress_utils.zstandard is None:
+        pytest.skip("需要 zstandard")
+    monkeypatch.setattr(compress_utils, "CODEC", codec)
+    value = compress_text(LONG)
+    assert value.startswith(MAGIC)
+    if codec != "none":
+        assert len(value) < len(LONG.encode("utf-8"))
+    assert decompress_text(value) == LONG
+
+def test_legacy_values_are_returned_as_is():
+    assert decompress_text(None) is None
+    assert decompress_text('{"legacy": true}') == '{"legacy": true}'
+    assert decompress_text(b'{"legacy": true}') == '{"legacy": true}'
+
+@pytest.mark.skipif(compress_utils.zstandard is None, reason="需要 zstandard")
+def test_trained_dictionary_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(compress_utils, "DICT_DIR", str(tmp_path))
+    monkeypatch.setattr(compress_utils, "CODEC", "zstd")
+    # train_dictionary 会修改模块级的当前字典状态，测试结束后由 monkeypatch 还原
+    monkeypatch.setattr(compress_utils, "_dicts", {})
+    monkeypatch.setattr(compress_utils, "_active_dict_id", compress_utils._active_dict_id)
+    monkeypatch.setattr(compress_utils, "_dict_generation", compress_utils._dict_generation)
+    samples = [json.dumps({"id": f"chatcmpl-{i}", "object": "chat.completion", "model": "gemini-3-flash",
+                           "choices": [{"index": 0, "message": {"role": "assistant", "content": f"answer number {i} " * (i % 7 + 1)},
+                                        "finish_reason": "stop"}],
+                           "usage": {"prompt_tokens": i, "completion_tokens": i * 2, "total_tokens": i * 3}})
+               for i in range(400)]
+    dict_id = compress_utils.train_dictionary(samples, dict_size=4096)
+
+    value = compress_text(samples[0] * 2)
+    assert value[:2] == MAGIC + compress_utils.ZSTD_DICT
+    # 新进程只凭帧头里的字典 ID 从磁盘加载字典
+    compress_utils._dicts.clear()
+    assert decompress_text(value) == samples[0] * 2
+    assert dict_id in compress_utils._dicts
+
+def test_compressed_text_column_round_trip(session, make_task):
+    task_id = make_task()
+    entry = db.TaskEntry(task_id=task_id, prompt="p", prompt_index=0, answer="a", raw_response=LONG, status="success")
+    session.add(entry)
+    session.commit()
+
+    stored = session.execute(text("SELECT raw_response FROM task_entries WHERE id = :id"), {"id": entry.id}).scalar()
+    assert isinstance(stored, bytes) and stored.startswith(MAGIC) and len(stored) < len(LONG.encode("utf-8"))
+    session.expire_all()
+    assert session.get(db.TaskEntry, entry.id).raw_response == LONG
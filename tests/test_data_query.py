@@ -0,0 +1,70 @@
+import datetime
+
+import database as db
+from services.data_query import list_entries, entry_stats, decode_cursor
+
+def _add_entries(session, task_id, answers, created_at=None):
+    entries = [db.TaskEntry(task_id=task_id, prompt=f"prompt {i}", prompt_index=i, answer=answer, tokens_used=i,
+                            status="success", created_at=created_at or datetime.datetime.now())
+               for i, answer in enumerate(answers)]
+    session.add_all(entries)
+    session.commit()
+    return [e.id for e in entries]
+
+def _all_pages(session, limit, **filters):
+    ids, cursor, pages = [], None, 0
+    while True:
+        page = list_entries(session, cursor=cursor, limit=limit, **filters)
+        ids += [item["id"] for item in page["items"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids, pages, page
+
+def test_keyset_pages_cover_every_row_once(session, make_task):
+    task_id = make_task()
+    same_time = datetime.datetime(2026, 1, 1, 12, 0, 0)
+    ids = _add_entries(session, task_id, [f"answer {i}" for i in range(7)], created_at=same_time)
+
+    seen, pages, _ = _all_pages(session, 3, task_id=task_id)
+    # created_at 相同时按 id 倒序分页，不重复也不遗漏
+    assert seen == sorted(ids, reverse=True)
+    assert pages == 3
+
+def test_invalid_cursor_starts_from_first_page(session, make_task):
+    task_id = make_task(entries=2)
+    assert decode_cursor("garbage") is None
+    page = list_entries(session, task_id=task_id, cursor="garbage")
+    assert len(page["items"]) == 2 and page["next_cursor"] is None
+
+def test_fulltext_search_ranks_and_paginates(session, make_task):
+    task_id = make_task()
+    answers = [f"the zebracorn appears {i}" for i in range(5)] + ["nothing to see"]
+    ids = _add_entries(session, task_id, answers)
+
+    seen, _, last_page = _all_pages(session, 2, search="zebracorn")
+    assert sorted(seen) == sorted(ids[:5])
+    assert last_page["ranked"] == db.FTS_ENABLED
+    if db.FTS_ENABLED:
+        assert "<mark>" in str(last_page["items"][0]["snippet"])
+    stats = entry_stats(session, search="zebracorn")
+    assert (stats["total_count"], stats["total_tokens"]) == (5, sum(range(5)))
+
+def test_short_terms_fall_back_to_like(session, make_task):
+    task_id = make_task()
+    ids = _add_entries(session, task_id, ["contains qx here", "does not"])
+    page = list_entries(session, search="qx", task_id=task_id)
+    assert [item["id"] for item in page["items"]] == [ids[0]]
+    assert page["ranked"] is False
+
+def test_fts_index_follows_updates_and_deletes(session, make_task):
+    task_id = make_task()
+    (entry_id,) = _add_entries(session, task_id, ["original wombatique"])
+    entry = session.get(db.TaskEntry, entry_id)
+    entry.answer = "rewritten platypusoid"
+    session.commit()
+    assert list_entries(session, search="wombatique")["items"] == []
+    assert [i["id"] for i in list_entries(session, search="platypusoid")["items"]] == [entry_id]
+    session.delete(entry)
+    session.commit()
+    assert list_entries(session, search="platypusoid")["items"] == []
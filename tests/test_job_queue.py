@@ -0,0 +1,122 @@
+import datetime
+
+import database as db
+from services import job_queue
+from services.result_writer import ResultWriter
+
+def _running_task(session, make_task, prompts=("a", "b")):
+    task_id = make_task(status="running")
+    job_queue.enqueue_prompts(session, task_id, list(prompts))
+    session.commit()
+    return task_id
+
+def _expire(session, item_id):
+    session.query(db.QueueItem).filter(db.QueueItem.id == item_id).update(
+        {"claimed_at": datetime.datetime.now() - datetime.timedelta(hours=1)}, synchronize_session=False
+    )
+    session.commit()
+
+def _item(session, item_id):
+    session.expire_all()
+    return session.get(db.QueueItem, item_id)
+
+def test_claim_in_prompt_order(session, make_task):
+    task_id = _running_task(session, make_task)
+    first = job_queue.claim_items(task_id, "w1")
+    second = job_queue.claim_items(task_id, "w1")
+    assert [first[0].prompt_index, second[0].prompt_index] == [0, 1]
+    assert first[0].status == "running" and first[0].attempts == 1
+    assert job_queue.claim_items(task_id, "w1") == []
+
+def test_claim_requires_running_task(session, make_task):
+    task_id = make_task(status="paused")
+    job_queue.enqueue_prompts(session, task_id, ["a"])
+    session.commit()
+    assert job_queue.claim_items(task_id, "w1") == []
+
+def test_stale_claim_cannot_finish_after_requeue(session, make_task):
+    task_id = _running_task(session, make_task, ["a"])
+    old = job_queue.claim_items(task_id, "w1")[0]
+    _expire(session, old.id)
+    assert job_queue.requeue_stale(session) == 1
+    session.commit()
+    new = job_queue.claim_items(task_id, "w2")[0]
+    assert new.id == old.id and new.worker_id != old.worker_id and new.attempts == 2
+
+    assert not job_queue.finish_item(session, old.id, True, old.worker_id)
+    assert job_queue.finish_item(session, new.id, False, new.worker_id)
+    session.commit()
+    assert _item(session, old.id).status == "failed"
+    # 已结束的条目不会被再次完成
+    assert not job_queue.finish_item(session, new.id, True, new.worker_id)
+
+def test_renewed_lease_is_not_requeued(session, make_task):
+    task_id = _running_task(session, make_task, ["a"])
+    item = job_queue.claim_items(task_id, "w1")[0]
+    _expire(session, item.id)
+    assert job_queue.renew_leases({item.id: "someone-else"}) == 0
+    assert job_queue.renew_leases({item.id: item.worker_id}) == 1
+    assert job_queue.requeue_stale(session) == 0
+    session.commit()
+    assert _item(session, item.id).status == "running"
+
+def test_release_only_by_owner(session, make_task):
+    task_id = _running_task(session, make_task, ["a"])
+    item = job_queue.claim_items(task_id, "w1")[0]
+    job_queue.release_item(item.id, "someone-else")
+    assert _item(session, item.id).status == "running"
+    job_queue.release_item(item.id, item.worker_id)
+    assert _item(session, item.id).status == "pending"
+
+def test_writer_drops_result_of_expired_claim(session, make_task):
+    task_id = _running_task(session, make_task, ["a"])
+    old = job_queue.claim_items(task_id, "w1")[0]
+    _expire(session, old.id)
+    job_queue.requeue_stale(session)
+    session.commit()
+    new = job_queue.claim_items(task_id, "w2")[0]
+
+    with ResultWriter(batch_size=10) as writer:
+        for token, answer in ((old.worker_id, "late"), (new.worker_id, "owner")):
+            writer.add({"task_id": task_id, "prompt": "a", "prompt_index": 0, "answer": answer,
+                        "tokens_used": 1, "status": "success"}, new.id, True, token)
+
+    answers = [e.answer for e in session.query(db.TaskEntry).filter(db.TaskEntry.task_id == task_id)]
+    assert answers == ["owner"]
+    assert _item(session, new.id).status == "done"
+
+def test_resume_reschedules_remaining_items(session, make_task):
+    task_id = _running_task(session, make_task)
+    task = session.get(db.ScrapeTask, task_id)
+    job_queue.pause_task(session, task)
+    assert task.status == "paused"
+    assert job_queue.resume_task(session, task)
+    assert task.status == "pending"
+
+def test_resume_without_remaining_items_completes_task(session, make_task):
+    task_id = _running_task(session, make_task, ["a"])
+    item = job_queue.claim_items(task_id, "w1")[0]
+    task = session.get(db.ScrapeTask, task_id)
+    job_queue.pause_task(session, task)
+    # 暂停后在途条目才完成，执行线程的收尾看到 paused 不会把任务标记为完成
+    assert job_queue.finish_item(session, item.id, True, item.worker_id)
+    session.commit()
+    assert not job_queue.resume_task(session, task)
+    assert task.status == "completed"
+
+def test_startup_recovery_leaves_live_leases_alone(session, make_task, monkeypatch):
+    from services import task_manager
+    started = []
+    monkeypatch.setattr(task_manager, "start_batch_task", lambda task_id: started.append(task_id))
+    task_id = _running_task(session, make_task, ["live", "crashed"])
+    live = job_queue.claim_items(task_id, "healthy-worker")[0]
+    crashed = job_queue.claim_items(task_id, "dead-worker")[0]
+    _expire(session, crashed.id)
+
+    task_manager._resume_idle_tasks()
+    assert _item(session, live.id).status == "running"
+    assert _item(session, live.id).worker_id == live.worker_id
+    assert _item(session, crashed.id).status == "pending"
+
+    task_manager._resume_idle_tasks(requeue_all=True)
+    assert _item(session, live.id).status == "pending"
@@ -0,0 +1,41 @@
+import datetime
+import urllib.request
+
+import database as db
+from services import job_queue, metrics
+from services.data_query import task_timing_from_entries
+
+def test_timing_from_persisted_entries(session, make_task):
+    task_id = make_task(status="running")
+    job_queue.enqueue_prompts(session, task_id, ["a", "b"])
+    session.commit()
+    start = datetime.datetime(2026, 3, 1, 10, 0, 0)
+    rows = [
+        dict(latency_ms=1000, ttft_ms=200, attempts=1, status="success", from_cache=False, tokens_used=10,
+             started_at=start, finished_at=start + datetime.timedelta(seconds=1)),
+        dict(latency_ms=3000, ttft_ms=400, attempts=3, status="failed", from_cache=False, tokens_used=0,
+             started_at=start + datetime.timedelta(seconds=1), finished_at=start + datetime.timedelta(seconds=4)),
+        dict(latency_ms=None, ttft_ms=None, attempts=None, status="success", from_cache=True, tokens_used=5,
+             started_at=None, finished_at=start + datetime.timedelta(seconds=2)),
+    ]
+    for i, row in enumerate(rows):
+        session.add(db.TaskEntry(task_id=task_id, prompt="p", prompt_index=i, answer="a", **row))
+    session.commit()
+
+    timing = task_timing_from_entries(session, task_id)
+    assert timing["source"] == "database"
+    assert (timing["requests"], timing["cache_hits"], timing["failed"], timing["retries"]) == (3, 1, 1, 2)
+    assert timing["upstream_seconds"] == 4.0 and timing["avg_upstream_seconds"] == 2.0
+    assert timing["avg_ttft_ms"] == 300 and timing["tokens"] == 15 and timing["wall_seconds"] == 4.0
+    assert task_timing_from_entries(session, make_task()) is None
+
+def test_serve_exposes_process_metrics():
+    metrics.REQUESTS.inc(("cfg", "model", "low", "success"))
+    server = metrics.serve(0, host="127.0.0.1")
+    try:
+        port = server.server_address[1]
+        body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'gemini_requests_total{api_config="cfg"' in body
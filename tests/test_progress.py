@@ -0,0 +1,57 @@
+import database as db
+from services.progress import ProgressTracker
+
+def _add_entry(session, task_id, i):
+    session.add(db.TaskEntry(task_id=task_id, prompt=f"p{i}", prompt_index=i, answer=f"a{i}",
+                             tokens_used=5, status="success"))
+    session.commit()
+
+def test_tracker_reads_only_watched_tasks(session, make_task):
+    watched = make_task(status="running", entries=2)
+    other = make_task(status="running", entries=1)
+    tracker = ProgressTracker([watched], with_entries=True)
+
+    first = tracker.snapshot(session)
+    assert [(p["task_id"], p["entries"], p["tokens"]) for p in first] == [(watched, 2, 20)]
+
+    _add_entry(session, other, 1)
+    _add_entry(session, watched, 2)
+    _add_entry(session, other, 2)
+    changed = tracker.snapshot(session)
+    assert [(p["task_id"], p["entries"]) for p in changed] == [(watched, 3)]
+    assert [(e["task_id"], e["prompt_index"], e["answer"]) for e in tracker.new_entries] == [(watched, 2, "a2")]
+    assert tracker.last_entry_id == session.query(db.TaskEntry.id).order_by(db.TaskEntry.id.desc()).first()[0]
+
+    assert tracker.snapshot(session) == [] and tracker.new_entries == []
+
+def test_tracker_pushes_backlog_after_first_page_in_batches(session, make_task, monkeypatch):
+    import services.progress as progress
+    monkeypatch.setattr(progress, "ENTRY_PUSH_LIMIT", 3)
+    task = make_task(status="completed", entries=8)
+    first = progress.entry_page(session, [task], limit=2)
+    assert [e["prompt_index"] for e in first] == [0, 1]
+
+    tracker = ProgressTracker([task], with_entries=True, after_entry_id=first[-1]["id"])
+    tracker.snapshot(session)
+    pushed = [e["prompt_index"] for e in tracker.new_entries]
+    assert pushed == [2, 3, 4] and tracker.entries_pending and not tracker.finished()
+    while tracker.entries_pending:
+        tracker.snapshot(session)
+        pushed += [e["prompt_index"] for e in tracker.new_entries]
+    assert pushed == list(range(2, 8)) and tracker.finished()
+    # 合计不受推送分批影响
+    assert tracker.sent[task]["entries"] == 8
+
+def test_results_page_renders_bounded_first_page(session, make_task, monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+    import services.progress as progress
+    monkeypatch.setattr(progress, "ENTRY_PAGE_SIZE", 3)
+    monkeypatch.setattr(progress, "ENTRY_ANSWER_CHARS", 4)
+    task = make_task(status="completed", entries=5)
+    ids = [i for (i,) in session.query(db.TaskEntry.id).filter(db.TaskEntry.task_id == task).order_by(db.TaskEntry.id)]
+
+    html = TestClient(main.app).get(f"/results/{task}").text
+    assert [f'id="content-{i}"' in html for i in ids] == [True, True, True, False, False]
+    assert f"/tasks/{task}/events?after={ids[2]}" in html
+    assert "test answer" not in html and "仅显示前 4 个字符" in html
@@ -0,0 +1,83 @@
+import json
+import time
+
+import database as db
+from services import reparse
+
+RAW = json.dumps({"choices": [{"message": {"content": "fresh answer"}, "finish_reason": "stop"}],
+                  "usage": {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7}})
+
+def _entry(session, task_id, i, status):
+    entry = db.TaskEntry(task_id=task_id, prompt=f"p{i}", prompt_index=i, answer="stale", raw_response=RAW,
+                         tokens_used=0, status=status)
+    session.add(entry)
+    session.commit()
+    return entry.id
+
+def _wait(job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = reparse.get_job(job_id)
+        if job["state"] != "running":
+            return job
+        time.sleep(0.05)
+    raise AssertionError("重新解析任务未结束")
+
+def test_reparse_keeps_partial_status(session, make_task):
+    task_id = make_task()
+    success_id = _entry(session, task_id, 0, "failed")
+    partial_id = _entry(session, task_id, 1, "partial")
+
+    report = reparse.reparse_entries(task_id=task_id, workers=1)
+
+    assert report["updated"] == 2
+    session.expire_all()
+    success, partial = session.get(db.TaskEntry, success_id), session.get(db.TaskEntry, partial_id)
+    assert (success.answer, success.tokens_used, success.status) == ("fresh answer", 7, "success")
+    assert (partial.answer, partial.tokens_used, partial.status) == ("fresh answer", 7, "partial")
+
+def test_reparse_job_reports_progress(session, make_task):
+    task_id = make_task()
+    entry_id = _entry(session, task_id, 0, "success")
+
+    job = reparse.start_job(task_id=task_id, dry_run=True)
+    assert job["state"] == "running"
+    done = _wait(job["job_id"])
+    assert (done["state"], done["total"], done["scanned"], done["changed"]) == ("done", 1, 1, 1)
+    assert done["diff"][0]["id"] == entry_id and done["diff"][0]["new_answer"] == "fresh answer"
+    session.expire_all()
+    assert session.get(db.TaskEntry, entry_id).answer == "stale"
+
+def test_reparse_job_rejects_unknown_template():
+    try:
+        reparse.start_job(template_id=999999)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("未知模板应直接报错")
+    assert reparse.get_job("missing") is None
+
+def test_reparse_updates_usage_columns(session, make_task):
+    task_id = make_task()
+    entry = db.TaskEntry(task_id=task_id, prompt="p", prompt_index=0, answer="fresh answer", raw_response=RAW,
+                         tokens_used=7, status="success", finish_reason="length", input_tokens=99, output_tokens=None)
+    session.add(entry)
+    session.commit()
+
+    report = reparse.reparse_entries(task_id=task_id, workers=1)
+
+    assert report["updated"] == 1
+    session.expire_all()
+    entry = session.get(db.TaskEntry, entry.id)
+    assert (entry.finish_reason, entry.input_tokens, entry.output_tokens) == ("stop", 3, 4)
+    # 用量已一致时不会重复写回
+    assert reparse.reparse_entries(task_id=task_id, workers=1)["changed"] == 0
+
+def test_web_job_parses_in_process(session, make_task, monkeypatch):
+    calls = []
+    original = reparse.reparse_entries
+    monkeypatch.setattr(reparse, "reparse_entries", lambda *a, **kw: calls.append(kw["workers"]) or original(*a, **kw))
+    task_id = make_task()
+    _entry(session, task_id, 0, "success")
+    assert _wait(reparse.start_job(task_id=task_id, dry_run=True)["job_id"])["state"] == "done"
+    assert calls == [1]
@@ -0,0 +1,47 @@
+import database as db
+from services import job_queue
+from services.result_writer import ResultWriter
+
+def _row(task_id, i, prompt="p"):
+    return {"task_id": task_id, "prompt": prompt, "prompt_index": i, "answer": f"answer {i}",
+            "tokens_used": 1, "status": "success"}
+
+def test_rows_are_written_in_batches(session, make_task):
+    task_id = make_task()
+    writer = ResultWriter(batch_size=5, flush_interval=60)
+    for i in range(12):
+        writer.add(_row(task_id, i))
+    writer.close()
+
+    assert writer.rows_written == 12
+    assert writer.flush_count < 12
+    indexes = [r[0] for r in session.query(db.TaskEntry.prompt_index).filter(db.TaskEntry.task_id == task_id)]
+    assert sorted(indexes) == list(range(12))
+
+def test_failed_batch_falls_back_to_single_rows(session, make_task):
+    task_id = make_task(status="running")
+    job_queue.enqueue_prompts(session, task_id, ["a", "b", "c"])
+    session.commit()
+    items = [job_queue.claim_items(task_id, "w1")[0] for _ in range(3)]
+
+    writer = ResultWriter(batch_size=100, flush_interval=60)
+    for item in items:
+        # prompt 为 NOT NULL，中间这行会让整批 INSERT 失败
+        row = _row(task_id, item.prompt_index, prompt=None if item.prompt_index == 1 else item.prompt)
+        writer.add(row, item.id, True, item.worker_id)
+    writer.close()
+
+    saved = sorted(r[0] for r in session.query(db.TaskEntry.prompt_index).filter(db.TaskEntry.task_id == task_id))
+    assert saved == [0, 2]
+    statuses = {i.prompt_index: i.status for i in session.query(db.QueueItem).filter(db.QueueItem.task_id == task_id)}
+    assert statuses == {0: "done", 1: "failed", 2: "done"}
+
+def test_closed_writer_rejects_rows(make_task):
+    writer = ResultWriter()
+    writer.close()
+    try:
+        writer.add(_row(make_task(), 0))
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("关闭后仍接受写入")
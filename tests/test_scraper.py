@@ -0,0 +1,37 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from services.rate_limiter import ApiRateLimiter
+from services.scraper import make_api_request
+
+class _ThrottleHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"error": "rate limited"}'
+        self.send_response(429)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def throttling_gateway():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ThrottleHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    server.shutdown()
+    server.server_close()
+
+def test_every_429_reaches_the_limiter(throttling_gateway):
+    limiter = ApiRateLimiter(max_concurrency=8)
+    timing = {}
+    with pytest.raises(Exception, match="HTTP 429"):
+        make_api_request(throttling_gateway, {}, {"model": "m"}, max_retries=2, limiter=limiter, timing=timing)
+    assert timing["attempts"] == 2
+    # 两次 429（含最后一次尝试）各减半一次：8 -> 4 -> 2
+    assert limiter.concurrency.limit == 2